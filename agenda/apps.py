@@ -15,7 +15,13 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from django.apps import AppConfig
+import logging
 
 
 class AgendaConfig(AppConfig):
     name = 'agenda'
+
+    @staticmethod
+    def ready():
+        logging.debug("loading agenda signals")
+        from . import signals
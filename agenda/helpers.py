@@ -24,25 +24,32 @@ from dateutil.relativedelta import relativedelta
 from pytz import timezone as pytz_timezone
 from datetime import timedelta
 
+from django.core.cache import cache
 from django.db.models import Q
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.utils.translation import gettext_lazy as _
 
-from gig.models import Gig, Plan, GigStatusChoices
+from gig.models import Gig, Plan, PlanTally, GigStatusChoices
 from band.models import Band, Assoc, Section
 from band.util import AssocStatusChoices
+from member.models import InboxEntry
+from .models import HeatmapYear
 from member.util import AgendaChoices, AgendaLayoutChoices
 
+import hashlib
 import json
 import logging
+import uuid
+from dataclasses import dataclass
 
 from go3.colors import the_colors
 from django.shortcuts import render
-from django.core.paginator import Paginator
 
 # This controls the pagination of gigs on the agenda page. There was strong pushback against the paging
-# mechanism, so this basically defeats it. But I still think the paginator is a good idea, and it may be worth
-# putting it back in as an option. For now, though, instead of ripping it out, it's disabled.
-PAGE_LENGTH = 10000
+# mechanism, so there are no page buttons: the first page renders right away and the rest are loaded as
+# the member scrolls down to them. Members using the classic layout still get everything on one page.
+PAGE_LENGTH = 25
 
 
 def _get_agenda_plans(user, the_type, the_band):
@@ -77,43 +84,134 @@ def _get_agenda_plans(user, the_type, the_band):
     return the_plans, the_title
 
 
+@dataclass
+class AgendaRow:
+    """ everything the agenda template needs for one plan, so rendering never goes back to the database """
+    plan: Plan
+    gig: Gig
+    assoc: Assoc
+    band: Band
+    section: Section
+    year: int
+    band_sections: list
+    feedback_strings: list
+    attending: int
+
+
+def _get_agenda_rows(the_plans, user_timezone):
+    """ load the plans along with their gigs, bands, assocs and sections in one joined query and turn
+        them into a flat list of AgendaRows. Sections for the section dropdown are fetched in one more
+        query, and only if any of the assocs are multisectional; attendance takes one more. """
+    if the_plans is None:
+        return []
+
+    the_plans = list(the_plans.select_related('gig', 'gig__band', 'assoc', 'assoc__band', 'section'))
+
+    multisectional_bands = {p.assoc.band_id for p in the_plans if p.assoc.is_multisectional}
+    band_sections = {}
+    if multisectional_bands:
+        for s in Section.objects.filter(band__in=multisectional_bands):
+            band_sections.setdefault(s.band_id, []).append(s)
+
+    # how many are going comes from the tallies, so it's one small query however many gigs there are
+    attending = PlanTally.objects.attending({p.gig_id for p in the_plans})
+
+    feedback_strings = {}
+    rows = []
+    for p in the_plans:
+        band = p.assoc.band
+        if band.id not in feedback_strings:
+            feedback_strings[band.id] = band.feedback_strings if band.plan_feedback else []
+        rows.append(AgendaRow(
+            plan=p,
+            gig=p.gig,
+            assoc=p.assoc,
+            band=band,
+            section=p.section,
+            year=p.gig.date.astimezone(user_timezone).year,
+            band_sections=band_sections.get(band.id, []),
+            feedback_strings=feedback_strings[band.id],
+            attending=attending.get(p.gig_id, 0),
+        ))
+    return rows
+
+
+def _make_cursor(plan):
+    """ the keyset cursor for the page after this plan - its gig date and its id """
+    return f'{plan.gig.date.isoformat()}_{plan.id}'
+
+
+def _page_after(the_plans, cursor):
+    """ the plans that come after the cursor, in (date, id) order """
+    the_plans = the_plans.order_by('gig__date', 'id')
+    if cursor:
+        date, plan_id = cursor.rsplit('_', 1)
+        date = datetime.datetime.fromisoformat(date)
+        plan_id = uuid.UUID(plan_id)
+        the_plans = the_plans.filter(Q(gig__date__gt=date) | Q(gig__date=date, id__gt=plan_id))
+    return the_plans
+
+
 @login_required
 def agenda_gigs(request, the_type, the_band=None):
 
     the_plans, the_title = _get_agenda_plans(request.user, the_type, the_band)
-
-    # make this the user's preference now
-    request.user.preferences.agenda_layout = the_type
-    request.user.preferences.agenda_band = Band.objects.get(id=the_band) if the_band else None
-    if request.GET.get('show_locations'):
-        if request.GET.get('show_locations').lower() != 'true':
-            request.user.preferences.agenda_show_location = False
-        else:
-            request.user.preferences.agenda_show_location = True
-    request.user.preferences.save()
+    cursor = request.GET.get('cursor')
+
+    if cursor is None:
+        # make this the user's preference now - later pages are just more of the same list
+        request.user.preferences.agenda_layout = the_type
+        # _get_agenda_plans has already checked that the band exists and the member is in it
+        request.user.preferences.agenda_band_id = the_band if the_band and the_plans is not None else None
+        if request.GET.get('show_locations'):
+            if request.GET.get('show_locations').lower() != 'true':
+                request.user.preferences.agenda_show_location = False
+            else:
+                request.user.preferences.agenda_show_location = True
+        request.user.preferences.save()
     user_timezone = pytz_timezone(request.user.timezone)
 
-    # group plans by year
+    next_cursor = None
+    if the_plans is not None and not request.user.preferences.agenda_use_classic:
+        try:
+            the_plans = _page_after(the_plans, cursor)
+            last_year = int(request.GET.get('year', 0))
+        except ValueError:
+            return HttpResponse(status=400)
+        # get one extra so we know whether there's another page
+        the_rows = _get_agenda_rows(the_plans[:PAGE_LENGTH + 1], user_timezone)
+        if len(the_rows) > PAGE_LENGTH:
+            the_rows = the_rows[:PAGE_LENGTH]
+            next_cursor = _make_cursor(the_rows[-1].plan)
+    else:
+        # the classic layout gets the whole list at once
+        the_rows = _get_agenda_rows(the_plans, user_timezone)
+        last_year = None
+
+    # group plans by year - the rows are in date order, so each year's rows are contiguous
     yearly_plans = {}
-    if the_plans:
-        the_plans = list(the_plans)
-        for i, p in enumerate(the_plans):
-            if i == 0 or p.gig.date.astimezone(user_timezone).year != the_plans[i - 1].gig.date.astimezone(user_timezone).year:
-                assert(p.gig.date.astimezone(user_timezone).year not in yearly_plans)
-                yearly_plans[p.gig.date.astimezone(user_timezone).year] = [p]
-            else:
-                assert(p.gig.date.astimezone(user_timezone).year in yearly_plans)
-                yearly_plans[p.gig.date.astimezone(user_timezone).year].append(p)
-
-    return render(request, 'agenda/agenda_gigs.html', 
-                    {
-                        'the_colors:': the_colors,
-                        'yearly_plans': yearly_plans,
-                        'title': the_title,
-                        'single_band': the_type == AgendaLayoutChoices.BY_BAND,
-                        'show_locations': request.user.preferences.agenda_show_location,
-                    }
-    )
+    for row in the_rows:
+        yearly_plans.setdefault(row.year, []).append(row)
+
+    # a year gets a heading when it's not the one the list (or the previous page) ended in
+    if cursor is None:
+        last_year = next(iter(yearly_plans), None)
+
+    context = {
+        'the_colors:': the_colors,
+        'yearly_plans': yearly_plans,
+        'last_year': last_year,
+        'next_cursor': next_cursor,
+        'next_year': next(reversed(yearly_plans), last_year),
+        'title': the_title,
+        'single_band': the_type == AgendaLayoutChoices.BY_BAND,
+        'multiband': request.user.band_count > 1,
+        'show_locations': request.user.preferences.agenda_show_location,
+    }
+
+    if cursor is None:
+        return render(request, 'agenda/agenda_gigs.html', context)
+    return render(request, 'agenda/agenda_gigs_page.html', context)
 
 @login_required
 def update_zone(request):
@@ -122,36 +220,31 @@ def update_zone(request):
     else:
         return redirect('home')
 
-@login_required
-def calendar_events(request, pk):
-    startstr = request.GET['start']
-    endstr = request.GET['end']
-
-    start = parse(startstr)
-    end = parse(endstr)
+# cached calendar events are keyed by everything that goes into them, so they never need to be deleted;
+# this just stops the cache filling up with old windows
+CALENDAR_CACHE_TIMEOUT = 60 * 60 * 24
 
-    user_assocs = request.user.confirmed_assocs
-    hide_canceled_gigs = request.user.preferences.hide_canceled_gigs
-    show_only_confirmed = request.user.preferences.calendar_show_only_confirmed
+# how far on either side of the calendar window to look when prefetching - long enough to cover
+# the whole of the month before and after, since a month view can start and end a week outside its month
+CALENDAR_PREFETCH = timedelta(weeks=6)
 
-    band_colors = {a.band.id: a.colorval for a in user_assocs}
 
-    plans = request.user.calendar_plans
+def _make_calendar_events(user, start, end, band_colors):
+    plans = user.calendar_plans.select_related('gig', 'gig__band')
 
     plans = plans.filter(
         (Q(gig__enddate__lte=end) | Q(gig__enddate=None)),
         gig__date__gte=start,
     )
-    if hide_canceled_gigs:
+    if user.preferences.hide_canceled_gigs:
         plans = plans.exclude(gig__status=GigStatusChoices.CANCELED)
-    if show_only_confirmed:
+    if user.preferences.calendar_show_only_confirmed:
         plans = plans.filter(gig__status=GigStatusChoices.CONFIRMED)
 
-    the_gigs = [p.gig for p in plans]
-
     events = []
-    multiband = len(user_assocs) > 1
-    for g in the_gigs:
+    multiband = len(band_colors) > 1
+    for p in plans:
+        g = p.gig
         gig = {}
         gig['title'] = f'{g.band.shortname or g.band.name}: {g.title}' if multiband else g.title
 
@@ -169,15 +262,60 @@ def calendar_events(request, pk):
 
         # Gig styling
         gig['display'] = 'block'
-        gig['backgroundColor'] = band_colors[g.band.id]
-        if band_colors[g.band.id] == 'white' or band_colors[g.band.id] == '#ffffff':
+        gig['backgroundColor'] = band_colors[g.band_id]
+        if band_colors[g.band_id] == 'white' or band_colors[g.band_id] == '#ffffff':
             gig['textColor'] = '#000'
         else:
             gig['textColor'] = '#fff'
 
         events.append(gig)
 
-    return HttpResponse(json.dumps(events))
+    return json.dumps(events)
+
+
+@login_required
+def calendar_events(request, pk):
+    """ the events for the calendar. If 'prefetch' is set, the months on either side of the window come
+        along too so the calendar can page back and forth without asking again. The answer is cached
+        and tagged with the versions of the member's bands, so unchanged windows come back as 304s. """
+    try:
+        start = parse(request.GET['start'])
+        end = parse(request.GET['end'])
+    except (KeyError, ValueError, OverflowError):
+        return HttpResponse(status=400)
+    if request.GET.get('prefetch'):
+        start = start - CALENDAR_PREFETCH
+        end = end + CALENDAR_PREFETCH
+
+    user_assocs = list(request.user.confirmed_assocs.select_related('band'))
+    band_colors = {a.band_id: a.colorval for a in user_assocs}
+    prefs = request.user.preferences
+
+    state = (
+        request.user.id, start.isoformat(), end.isoformat(),
+        prefs.hide_canceled_gigs, prefs.calendar_show_only_confirmed, prefs.calendar_show_only_committed,
+        sorted((a.band_id, a.band.calendar_version, str(a.band.calendar_changed), a.colorval, a.hide_from_schedule)
+               for a in user_assocs),
+    )
+    etag = f'"{hashlib.sha1(repr(state).encode()).hexdigest()}"'
+    changes = [a.band.calendar_changed for a in user_assocs if a.band.calendar_changed]
+    last_modified = max(changes).timestamp() if changes else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        cache_key = f'calendar-events-{etag[1:-1]}'
+        body = cache.get(cache_key)
+        if body is None:
+            body = _make_calendar_events(request.user, start, end, band_colors)
+            cache.set(cache_key, body, CALENDAR_CACHE_TIMEOUT)
+        response = HttpResponse(body, content_type='application/json')
+
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # the browser has to check back every time, but a 304 is cheap
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required
@@ -197,7 +335,7 @@ def get_plans_count(request, *args, **kw):
         the_plans = the_plans.filter(assoc__hide_from_schedule=False)
         count = the_plans.count()
     elif kw['the_type'] == AgendaLayoutChoices.NEED_RESPONSE:
-        count = request.user.future_noplans.count()
+        count = InboxEntry.objects.future(request.user).count()
     else:
         the_plans = Plan.member_plans.future_plans(request.user)
         the_plans = the_plans.filter(assoc__hide_from_schedule=False)
@@ -209,30 +347,10 @@ def get_plans_count(request, *args, **kw):
 @login_required
 def grid_heatmap(request, *args, **kw):
     year = int(request.POST['year'])
-    band_id = int(request.POST['band'])
+    band = get_object_or_404(Band, id=int(request.POST['band']))
 
-    the_gigs = Gig.objects.filter(
-        date__year=year,
-        band=band_id,
-        trashed_date__isnull=True,
-        ).order_by('date').values('date')
-
-    uncooked_data = {}
-    for g in the_gigs:
-        m = g['date'].month
-        d = g['date'].day
-        cooked_date = f"{year}-{m:02}-{d:02}"
-        if cooked_date in uncooked_data:
-            uncooked_data[cooked_date] += 1
-        else:
-            uncooked_data[cooked_date] = 1
-
-    data = []
-    for d in uncooked_data.keys():
-        data.append({
-            'count': uncooked_data[d],
-            'date': d
-        })
+    counts = HeatmapYear.objects.counts(band, year)
+    data = [{'count': counts[d], 'date': d} for d in sorted(counts)]
 
     return HttpResponse(json.dumps(data))
 
@@ -259,14 +377,24 @@ def grid_section_members(request, *args, **kw):
 
 @login_required
 def grid_gigs(request, *args, **kw):
+    """ the plans for a band's gigs in a month - or a whole year if month is -1 or missing - as columns:
+        * members: the member ids, in the order the rows of the grid are in
+        * gigs: title, date, id and month (0-11, in the band's timezone) of each gig
+        * plans: one string per gig, with one character per member - the plan status as a digit, or '-'
+          if the member has no plan for the gig """
     band_id = int(request.POST['band'])
-    month = int(request.POST['month'])
+    month = int(request.POST.get('month', -1))
     year = int(request.POST['year'])
 
     # can't just filter by date__month because that doesn't seem to work in mariadb
     band = Band.objects.get(id=band_id)
-    start = datetime.datetime(year=year, month=month+1, day=1, tzinfo=pytz_timezone(band.timezone))
-    end = start + relativedelta(months=1)
+    band_timezone = pytz_timezone(band.timezone)
+    if month < 0:
+        start = band_timezone.localize(datetime.datetime(year=year, month=1, day=1))
+        end = band_timezone.localize(datetime.datetime(year=year + 1, month=1, day=1))
+    else:
+        start = band_timezone.localize(datetime.datetime(year=year, month=month+1, day=1))
+        end = band_timezone.localize(datetime.datetime(year=year, month=month+1, day=1) + relativedelta(months=1))
     gigs = Gig.objects.filter(
         date__gte=start,
         date__lt=end,
@@ -276,16 +404,22 @@ def grid_gigs(request, *args, **kw):
         ).order_by('date')
     if request.user.preferences.hide_canceled_gigs:
         gigs = gigs.exclude(status=GigStatusChoices.CANCELED)
-
-    data = []
-    for g in gigs:
-        all_plans = Plan.objects.filter(gig=g).select_related()
-        member_plans = [{'member': p.assoc.member_id,
-                         'plan': p.status} for p in all_plans]
-        data.append({
-            'title': g.title,
-            'date': str(g.date),
-            'id': g.id,
-            'plans': member_plans
-        })
+    gigs = list(gigs.values_list('id', 'title', 'date'))
+
+    members = list(Assoc.objects.filter(band=band_id, status=AssocStatusChoices.CONFIRMED)
+                   .order_by('default_section__order').values_list('member_id', flat=True))
+    member_index = {m: i for i, m in enumerate(members)}
+
+    statuses = {g[0]: ['-'] * len(members) for g in gigs}
+    plans = Plan.objects.filter(gig__in=[g[0] for g in gigs], assoc__band=band_id,
+                                assoc__status=AssocStatusChoices.CONFIRMED)
+    for gig_id, member_id, status in plans.values_list('gig_id', 'assoc__member_id', 'status'):
+        statuses[gig_id][member_index[member_id]] = str(status)
+
+    data = {
+        'members': members,
+        'gigs': [{'id': gig_id, 'title': title, 'date': str(date), 'month': date.astimezone(band_timezone).month - 1}
+                 for gig_id, title, date in gigs],
+        'plans': [''.join(statuses[g[0]]) for g in gigs],
+    }
     return HttpResponse(json.dumps(data))
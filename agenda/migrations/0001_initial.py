@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('band', '0029_band_calendar_changed_band_calendar_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeatmapYear',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('timezone', models.CharField(max_length=200)),
+                ('counts', models.JSONField(default=dict)),
+                ('band', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='heatmap_years', to='band.band')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='heatmapyear',
+            constraint=models.UniqueConstraint(fields=('band', 'year'), name='unique_heatmap_band_year'),
+        ),
+    ]
@@ -14,6 +14,67 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from django.db import models
+import datetime
 
-# Create your models here.
+from django.db import models, transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from pytz import timezone as pytz_timezone
+
+from band.models import Band
+from gig.models import Gig
+
+
+def _count_gigs_by_day(band, start, end):
+    """ count the band's gigs between start and end, by day in the band's timezone """
+    rows = Gig.objects.filter(band=band, date__gte=start, date__lt=end, trashed_date__isnull=True) \
+        .annotate(day=TruncDate('date', tzinfo=pytz_timezone(band.timezone))) \
+        .values('day').annotate(count=Count('id')).order_by()
+    return {str(r['day']): r['count'] for r in rows}
+
+
+class HeatmapYearManager(models.Manager):
+    def counts(self, band, year):
+        """ the number of gigs on each day of the year, as a dict of 'YYYY-MM-DD' to count. Built the first
+            time it's asked for, and again if the band has changed timezone since. """
+        row = self.filter(band=band, year=year).first()
+        if row is None or row.timezone != band.timezone:
+            zone = pytz_timezone(band.timezone)
+            counts = _count_gigs_by_day(band,
+                                        zone.localize(datetime.datetime(year, 1, 1)),
+                                        zone.localize(datetime.datetime(year + 1, 1, 1)))
+            row, _ = self.update_or_create(band=band, year=year,
+                                           defaults={'counts': counts, 'timezone': band.timezone})
+        return row.counts
+
+    def update_day(self, band, date):
+        """ a gig on this date (in the band's timezone) has changed, so count that day again - but only if
+            we already have the year; otherwise it gets built when someone looks at it """
+        with transaction.atomic():
+            row = self.select_for_update().filter(band=band, year=date.year, timezone=band.timezone).first()
+            if row is None:
+                return
+            zone = pytz_timezone(band.timezone)
+            start = zone.localize(datetime.datetime(date.year, date.month, date.day))
+            end = zone.localize(datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(days=1))
+            count = _count_gigs_by_day(band, start, end).get(str(date), 0)
+            if count:
+                row.counts[str(date)] = count
+            else:
+                row.counts.pop(str(date), None)
+            row.save(update_fields=['counts'])
+
+
+class HeatmapYear(models.Model):
+    """ the gig counts behind the grid page heatmap, one row per band and year """
+    band = models.ForeignKey(Band, related_name='heatmap_years', on_delete=models.CASCADE)
+    year = models.IntegerField()
+    timezone = models.CharField(max_length=200)
+    counts = models.JSONField(default=dict)
+
+    objects = HeatmapYearManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['band', 'year'], name='unique_heatmap_band_year'),
+        ]
@@ -0,0 +1,43 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from pytz import timezone as pytz_timezone
+from gig.models import Gig
+from .models import HeatmapYear
+
+
+def _heatmap_day(gig, band=None):
+    return gig.date.astimezone(pytz_timezone((band or gig.band).timezone)).date()
+
+
+# keep the grid heatmap counts current - the day the gig was on before, and the day it's on now. The gig as it
+# was comes from gig.signals.remember_old_gig.
+@receiver(post_save, sender=Gig)
+def update_heatmap(sender, instance, **kwargs):
+    band, day = instance.band, _heatmap_day(instance)
+    old = getattr(instance, '_old', None)
+    if old:
+        old_band = band if old.band_id == band.id else old.band
+        old_day = _heatmap_day(old, old_band)
+        if (old_band.id, old_day) != (band.id, day):
+            HeatmapYear.objects.update_day(old_band, old_day)
+    HeatmapYear.objects.update_day(band, day)
+
+@receiver(post_delete, sender=Gig)
+def update_heatmap_after_delete(sender, instance, **kwargs):
+    HeatmapYear.objects.update_day(instance.band, _heatmap_day(instance))
@@ -16,12 +16,14 @@
 """
 from gig.tests import GigTestBase
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from gig.util import GigStatusChoices, PlanStatusChoices
 from gig.models import Plan
 from member.util import AgendaLayoutChoices
 from agenda.helpers import _get_agenda_plans
 from agenda.templatetags.agenda_tags import is_url
-from band.models import Band, Assoc
+from band.models import Band, Assoc, Section
 from band.util import AssocStatusChoices
 from django.test import Client
 from django.urls import reverse
@@ -29,6 +31,8 @@ from json import loads
 from datetime import datetime, timedelta, timezone as dttimezone
 from django.utils import timezone
 from freezegun import freeze_time
+from unittest.mock import patch
+import re
 
 class AgendaTest(GigTestBase):
     def test_agenda_types(self):
@@ -178,6 +182,80 @@ class AgendaTest(GigTestBase):
         self.assertEqual(response.content.decode('ascii').count("xyzzy"), 1)
         self.assertEqual(response.content.decode('ascii').count("Tomorrow"), 1)
 
+    def test_agenda_query_budget(self):
+        """ the agenda fragment should cost the same number of queries no matter how many plans it shows """
+        a = self.assoc_user(self.joeuser)
+        a.is_multisectional = True
+        a.save()
+        Section.objects.create(name="s1", band=self.band)
+        self.band.plan_feedback = "good\nbad"
+        self.band.save()
+
+        c = Client()
+        c.force_login(self.joeuser)
+
+        def _count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                response = c.get(f'/plans/{int(AgendaLayoutChoices.ONE_LIST)}/0')
+            self.assertEqual(response.status_code, 200)
+            return len(ctx.captured_queries), response
+
+        for i in range(0, 2):
+            self.create_gig_form(contact=self.joeuser, title=f"xyzzy{i}")
+        few, response = _count_queries()
+        self.assertEqual(response.content.decode('ascii').count("xyzzy"), 2)
+
+        for i in range(2, 12):
+            self.create_gig_form(contact=self.joeuser, title=f"xyzzy{i}")
+        many, response = _count_queries()
+        self.assertEqual(response.content.decode('ascii').count("xyzzy"), 12)
+
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 8)
+
+    @patch('agenda.helpers.PAGE_LENGTH', 3)
+    def test_agenda_pages(self):
+        """ the agenda comes in pages, each one pointing to the next """
+        self.assoc_user(self.joeuser)
+        for i in range(0, 7):
+            self.create_gig(self.joeuser, title=f"xyzzy{i:02d}",
+                            start_date=datetime(2100 + i // 4, 1, 2 + i, 12, tzinfo=dttimezone.utc))
+        c = Client()
+        c.force_login(self.joeuser)
+
+        url = f'/plans/{int(AgendaLayoutChoices.ONE_LIST)}/0'
+        titles = []
+        years = []
+        pages = 0
+        while url:
+            response = c.get(url)
+            self.assertEqual(response.status_code, 200)
+            content = response.content.decode('ascii')
+            titles.extend(re.findall(r'xyzzy\d\d', content))
+            years.extend(re.findall(r'agenda-separator my-3">(\d+)<', content))
+            next_page = re.search(r'hx-get="([^"]*cursor=[^"]*)"', content)
+            url = next_page.group(1).replace('&amp;', '&') if next_page else None
+            pages += 1
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(titles, [f"xyzzy{i:02d}" for i in range(0, 7)])
+        # the second year gets a heading once, even though it starts in the middle of a page
+        self.assertEqual(years, ['2101'])
+
+        # the classic layout gets everything at once
+        self.joeuser.preferences.agenda_use_classic = True
+        self.joeuser.preferences.save()
+        response = c.get(f'/plans/{int(AgendaLayoutChoices.ONE_LIST)}/0')
+        self.assertEqual(response.content.decode('ascii').count("xyzzy"), 7)
+        self.assertNotIn('cursor=', response.content.decode('ascii'))
+
+    def test_agenda_bad_cursor(self):
+        self.assoc_user(self.joeuser)
+        c = Client()
+        c.force_login(self.joeuser)
+        response = c.get(f'/plans/{int(AgendaLayoutChoices.ONE_LIST)}/0?cursor=nonsense')
+        self.assertEqual(response.status_code, 400)
+
     def test_agenda_occasionals(self):
         _ = self.assoc_user(self.joeuser)
         janeassoc = self.assoc_user(self.janeuser)
@@ -334,6 +412,16 @@ class AgendaTest(GigTestBase):
 
 
 
+    def test_agenda_shows_attending(self):
+        _, _, p = self.assoc_joe_and_create_gig(title="xyzzy")
+        p.set_status(PlanStatusChoices.DEFINITELY)
+        c = Client()
+        c.force_login(self.joeuser)
+        response = c.get(f'/plans/{int(AgendaLayoutChoices.ONE_LIST)}/0')
+        self.assertEqual(response.context["yearly_plans"][2100][0].attending, 1)
+        self.assertContains(response, "fa-user-check")
+
+
 class CalendarTest(GigTestBase):
     def test_calendar(self):
         self.assoc_user(self.joeuser)
@@ -401,6 +489,80 @@ class CalendarTest(GigTestBase):
         data = loads(response.content)
         self.assertEqual(len(data), 1)
 
+    def test_calendar_conditional_get(self):
+        self.assoc_user(self.joeuser)
+        gig = self.create_gig(self.joeuser)
+
+        c = Client()
+        c.force_login(self.joeuser)
+        window = {
+            'start': datetime(2100, 1, 1, 0, 0, 0, 0, dttimezone.utc).isoformat(),
+            'end': datetime(2100, 2, 1, 0, 0, 0, 0, dttimezone.utc).isoformat(),
+        }
+        response = c.get(reverse('calendar-events', args=[self.band.id]), data=window)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(loads(response.content)), 1)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # nothing changed, so nothing to send
+        response = c.get(reverse('calendar-events', args=[self.band.id]), data=window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # changing the gig changes the band's version
+        gig.title = 'changed'
+        gig.save()
+        response = c.get(reverse('calendar-events', args=[self.band.id]), data=window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(loads(response.content)[0]['title'], 'changed')
+
+        # so does changing a preference
+        etag = response['ETag']
+        self.joeuser.preferences.calendar_show_only_confirmed = True
+        self.joeuser.preferences.save()
+        response = c.get(reverse('calendar-events', args=[self.band.id]), data=window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(loads(response.content)), 0)
+
+    def test_calendar_follows_committed_plans(self):
+        self.assoc_user(self.joeuser)
+        gig = self.create_gig(self.joeuser)
+        plan = Plan.objects.get(gig=gig, assoc__member=self.joeuser)
+
+        def version():
+            return Band.objects.get(id=self.band.id).calendar_version
+
+        # the calendar doesn't depend on the plans, so answering doesn't change it
+        before = version()
+        plan.status = PlanStatusChoices.DEFINITELY
+        plan.save()
+        self.assertEqual(version(), before)
+
+        self.joeuser.preferences.calendar_show_only_committed = True
+        self.joeuser.preferences.save()
+        plan.status = PlanStatusChoices.PROBABLY
+        plan.save()
+        self.assertEqual(version(), before)
+        plan.status = PlanStatusChoices.CANT_DO_IT
+        plan.save()
+        self.assertEqual(version(), before + 1)
+
+    def test_calendar_prefetch(self):
+        self.assoc_user(self.joeuser)
+        self.create_gig(self.joeuser, start_date=datetime(2100, 3, 2, 12, tzinfo=dttimezone.utc))
+
+        c = Client()
+        c.force_login(self.joeuser)
+        window = {
+            'start': datetime(2100, 1, 1, 0, 0, 0, 0, dttimezone.utc).isoformat(),
+            'end': datetime(2100, 2, 1, 0, 0, 0, 0, dttimezone.utc).isoformat(),
+        }
+        response = c.get(reverse('calendar-events', args=[self.band.id]), data=window)
+        self.assertEqual(len(loads(response.content)), 0)
+        response = c.get(reverse('calendar-events', args=[self.band.id]), data=dict(window, prefetch=1))
+        self.assertEqual(len(loads(response.content)), 1)
+
 class GridTest(GigTestBase):
     def test_grid(self):
         self.assoc_user(self.joeuser)
@@ -427,8 +589,11 @@ class GridTest(GigTestBase):
             'year': 2100,
         })
         self.assertEqual(response.status_code, 200)
-        gigs = loads(response.content)
-        self.assertEqual(len(gigs), 19)
+        grid = loads(response.content)
+        self.assertEqual(len(grid['gigs']), 19)
+        self.assertEqual(len(grid['plans']), 19)
+        self.assertEqual(len(grid['members']), 2)
+        self.assertTrue(all(p == '00' for p in grid['plans']))
 
     def test_hide_canceled_gigs(self):
         self.assoc_user(self.joeuser)
@@ -449,8 +614,70 @@ class GridTest(GigTestBase):
             'year': 2100,
         })
         self.assertEqual(response.status_code, 200)
-        gigs = loads(response.content)
-        self.assertEqual(len(gigs), 3)
+        grid = loads(response.content)
+        self.assertEqual(len(grid['gigs']), 3)
+
+    def test_grid_year(self):
+        self.assoc_user(self.joeuser)
+        self.create_gig(self.joeuser, title='jan', start_date=datetime(2100, 1, 2, 12, tzinfo=dttimezone.utc))
+        g = self.create_gig(self.joeuser, title='jun', start_date=datetime(2100, 6, 2, 12, tzinfo=dttimezone.utc))
+        self.create_gig(self.joeuser, title='next', start_date=datetime(2101, 1, 2, 12, tzinfo=dttimezone.utc))
+        p = g.plans.get(assoc__member=self.joeuser)
+        p.status = PlanStatusChoices.DEFINITELY
+        p.save()
+
+        c = Client()
+        c.force_login(self.joeuser)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = c.post(reverse('grid-gigs'), data={'band': self.band.id, 'year': 2100})
+        self.assertLessEqual(len(ctx.captured_queries), 8)
+        self.assertEqual(response.status_code, 200)
+        grid = loads(response.content)
+        self.assertEqual([g['title'] for g in grid['gigs']], ['jan', 'jun'])
+        self.assertEqual([g['month'] for g in grid['gigs']], [0, 5])
+        joe = grid['members'].index(self.joeuser.id)
+        self.assertEqual(grid['plans'][1][joe], str(int(PlanStatusChoices.DEFINITELY)))
+        self.assertEqual(grid['plans'][0][joe], str(int(PlanStatusChoices.NO_PLAN)))
+
+    def test_heatmap(self):
+        self.assoc_user(self.joeuser)
+        self.band.timezone = 'US/Pacific'
+        self.band.save()
+        # late in the evening in the band's timezone is already the next day in UTC
+        late = self.create_gig(self.joeuser, start_date=datetime(2100, 1, 3, 6, tzinfo=dttimezone.utc))
+        self.create_gig(self.joeuser, start_date=datetime(2100, 1, 2, 20, tzinfo=dttimezone.utc))
+
+        c = Client()
+        c.force_login(self.joeuser)
+
+        def heatmap(year=2100):
+            response = c.post(reverse('grid-heatmap'), data={'band': self.band.id, 'year': year})
+            self.assertEqual(response.status_code, 200)
+            return loads(response.content)
+
+        self.assertEqual(heatmap(), [{'count': 2, 'date': '2100-01-02'}])
+
+        # the year is kept, and changes to gigs update it
+        with CaptureQueriesContext(connection) as ctx:
+            heatmap()
+        self.assertFalse(any('GROUP BY' in q['sql'] for q in ctx.captured_queries))
+
+        late.date = datetime(2100, 2, 1, 20, tzinfo=dttimezone.utc)
+        late.setdate = late.enddate = None
+        late.save()
+        self.assertEqual(heatmap(), [{'count': 1, 'date': '2100-01-02'}, {'count': 1, 'date': '2100-02-01'}])
+
+        late.trashed_date = timezone.now()
+        late.save()
+        self.assertEqual(heatmap(), [{'count': 1, 'date': '2100-01-02'}])
+
+        # moving into another year takes it out of this one
+        late.trashed_date = None
+        late.date = datetime(2101, 2, 1, 20, tzinfo=dttimezone.utc)
+        late.save()
+        self.assertEqual(heatmap(), [{'count': 1, 'date': '2100-01-02'}])
+        self.assertEqual(heatmap(2101), [{'count': 1, 'date': '2101-02-01'}])
 
 class AgendaTagTests(TestCase):
     def test_is_url_valid_url(self):
@@ -20,6 +20,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import redirect
 from django.utils import timezone
+from member.models import InboxEntry
 from member.util import AgendaChoices, AgendaLayoutChoices
 from band.models import Assoc
 from band.util import AssocStatusChoices
@@ -73,10 +74,7 @@ class AgendaView(AgendaBaseView):
         # Depending on the layout they want, send different instructions
 
         if self.request.user.preferences.agenda_use_classic:
-            if len(self.request.user.future_noplans) == 0:
-                context['noplans'] = False
-            else:
-                context['noplans'] = True
+            context['noplans'] = InboxEntry.objects.future(self.request.user).exists()
         else:
             layout = self.request.user.preferences.agenda_layout
             if layout == AgendaLayoutChoices.HAS_RESPONSE:
@@ -38,7 +38,8 @@ class BandForm(forms.ModelForm):
         fields = ['name', 'shortname', 'hometown', 'description', 'member_links', 'website',
             'new_member_message', 'thumbnail_img', 'images', 'default_language', 'timezone',
             'anyone_can_create_gigs', 'anyone_can_manage_gigs', 'share_gigs',
-            'send_updates_by_default', 'invite_occasionals_by_default', 'simple_planning', 'plan_feedback']
+            'send_updates_by_default', 'notification_digest', 'invite_occasionals_by_default', 'simple_planning',
+            'plan_feedback']
 
         widgets = {
             'images': forms.Textarea(attrs={'placeholder': 'put urls to images on their own lines...'}),
@@ -60,6 +61,7 @@ class BandForm(forms.ModelForm):
             'anyone_can_manage_gigs': _('Anyone Can Manage Gigs'), 
             'share_gigs': _('Show Gigs On Public Page'),
             'send_updates_by_default': _('Send Gig Updates By Default'), 
+            'notification_digest': _('Combine Gig Updates Into Digests'),
             'invite_occasionals_by_default': _('Invite Occasional Members By Default'), 
             'simple_planning': _('Use Yes/Maybe/No Responses'), 
             'plan_feedback': _('Use Additional Feedback Options'),
@@ -27,7 +27,8 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404, redirect, render
 from band.util import AssocStatusChoices
 import json
-from lib.caldav import make_band_calfeed, save_calfeed, get_calfeed, delete_calfeed
+from lib.caldav import make_band_calfeed, save_calfeed, calfeed_response, dynamic_calfeed_response, delete_calfeed, \
+    make_calfeeds
 from lib.email import send_messages_async, prepare_email
 from django.utils import timezone
 from pytz import timezone as zone
@@ -36,7 +37,10 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib.auth.hashers import make_password
 from django.db import transaction
+from django.db.models import F, Q
 import html
+import time
+from collections import defaultdict
 
 
 def assoc_editor_required(func):
@@ -248,16 +252,23 @@ def set_sections(request, *args, **kw):
 def set_calfeeds_dirty(band):
     """ called from gig post_save signal - when gig is updated, set calfeeds dirty for all members """
     Member.objects.filter(assocs__band=band).update(cal_feed_dirty=True)
-    band.pub_cal_feed_dirty = True
-    band.save()
+    # the band comes from the task queue and may be out of date, so don't save it over the real one
+    Band.objects.filter(id=band.id).update(pub_cal_feed_dirty=True)
 
 
-def prepare_band_calfeed(band):
+def set_calendar_changed(band_id):
+    """ called from the gig, plan, assoc and band signals - bump the band's calendar version so cached
+        calendar events for its members get rebuilt """
+    Band.objects.filter(id=band_id).update(calendar_version=F('calendar_version') + 1,
+                                           calendar_changed=timezone.now())
+
+
+def _band_calfeed_gigs(bands):
     # we want the gigs as far back as a year ago
     date_earliest = timezone.now() - timedelta(days=365)
 
     filter_args = {
-        "band": band,
+        "band__in": bands,
         "is_private": False,
         "date__gt": date_earliest,
         "status": GigStatusChoices.CONFIRMED,
@@ -265,9 +276,11 @@ def prepare_band_calfeed(band):
         "trashed_date": None,
     }
 
-    the_gigs = Gig.objects.filter(**filter_args)
-    cf = make_band_calfeed(band, the_gigs)
-    return cf
+    return Gig.objects.filter(**filter_args).order_by('date', 'id')
+
+
+def prepare_band_calfeed(band):
+    return make_band_calfeed(band, _band_calfeed_gigs([band]))
 
 
 def update_band_calfeed(id):
@@ -276,20 +289,71 @@ def update_band_calfeed(id):
     save_calfeed(b.pub_cal_feed_id, cf)
 
 
+def _claim_dirty_band_calfeeds(after_id):
+    """ take the next batch of bands whose calfeeds are dirty, marking them clean and claimed as they're taken.
+        Like the member feeds, a claim that's never finished can be taken again after CALFEED_CLAIM_SECONDS. """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.CALFEED_CLAIM_SECONDS)
+    with transaction.atomic():
+        ids = list(Band.objects.filter(Q(pub_cal_feed_dirty=True) | Q(pub_cal_feed_claimed__lt=stale),
+                                       id__gt=after_id)
+                   .order_by('id').select_for_update(skip_locked=True)
+                   .values_list('id', flat=True)[:settings.CALFEED_BATCH_SIZE])
+        Band.objects.filter(id__in=ids).update(pub_cal_feed_dirty=False, pub_cal_feed_claimed=now)
+    return ids
+
+
+def regenerate_band_calfeeds(pool=None):
+    """ make all the dirty band calfeeds again, a batch at a time, with one query for all the batch's gigs.
+        Yields the size of each batch and how long it took. """
+    after_id = 0
+    while True:
+        ids = _claim_dirty_band_calfeeds(after_id)
+        if not ids:
+            return
+        after_id = ids[-1]
+        start = time.monotonic()
+        try:
+            bands = list(Band.objects.filter(id__in=ids).order_by('id'))
+            gigs = defaultdict(list)
+            for g in _band_calfeed_gigs(bands):
+                gigs[g.band_id].append(g)
+            feeds = make_calfeeds(pool, [(make_band_calfeed, (b, gigs[b.id])) for b in bands])
+            for b, cf in zip(bands, feeds):
+                save_calfeed(b.pub_cal_feed_id, cf)
+        except Exception:
+            # leave them for the next run
+            Band.objects.filter(id__in=ids).update(pub_cal_feed_dirty=True, pub_cal_feed_claimed=None)
+            raise
+        Band.objects.filter(id__in=ids).update(pub_cal_feed_claimed=None)
+        yield len(ids), time.monotonic() - start
+
+
 def band_calfeed(request, pk):
     try:
         if settings.DYNAMIC_CALFEED:
-            # if the dynamic calfeed is set, just create the calfeed right now and return it
-            tf = prepare_band_calfeed(Band.objects.get(pub_cal_feed_id=pk))
+            # if the dynamic calfeed is set, make the calfeed now - or take it from the cache if nothing has
+            # changed since it was made. Public feeds get embedded in band websites, so this saves a lot.
+            band = Band.objects.get(pub_cal_feed_id=pk)
+            # gig changes bump the calendar_version, and the window moves on every day
+            version = ('band', band.pub_cal_feed_id, band.calendar_version, band.calendar_changed,
+                       timezone.now().date())
+
+            def make():
+                gigs = list(_band_calfeed_gigs([band]))
+                # a gig that leaves the feed isn't in the gigs any more, but it changed the band's calendar
+                changes = [g.last_update for g in gigs] + [band.calendar_changed]
+                return make_band_calfeed(band, gigs), max(filter(None, changes), default=None)
+
+            response = dynamic_calfeed_response(request, version, make)
         else:
-            # if using the task queue, get the calfeed from the disk cache
-            tf = get_calfeed(pk)
+            # if using the task queue, serve the calfeed from the disk cache
+            response = calfeed_response(request, pk)
     except (ValueError, ValidationError):
         hr = HttpResponse()
         hr.status_code = 404
         return hr
 
-    response = HttpResponse(tf, content_type='text/calendar')
     response.headers['Access-Control-Allow-Origin'] = '*'
     return response
 
@@ -0,0 +1,44 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from django.core.management.base import BaseCommand
+from band.models import AttendanceYear, Band
+
+
+class Command(BaseCommand):
+    help = 'Checks the attendance counters against the plans and counts again for any band that has drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true',
+                            help="don't repair anything, just report the bands that are wrong")
+
+    def handle(self, *args, **options):
+        wrong = []
+        for band in Band.objects.order_by('id').iterator():
+            found = set(AttendanceYear.objects.filter(assoc__band=band)
+                        .values_list('assoc_id', 'year', 'definitely', 'probably', 'cant', 'no_answer'))
+            if found != AttendanceYear.objects.expected(band):
+                wrong.append(band)
+                self.stdout.write(f'attendance for band {band.id} is wrong')
+
+        if wrong and not options['verify_only']:
+            for band in wrong:
+                AttendanceYear.objects.rebuild(band)
+            self.stdout.write(self.style.SUCCESS(f'repaired the attendance for {len(wrong)} bands'))
+        elif wrong:
+            self.stdout.write(self.style.ERROR(f'{len(wrong)} bands have wrong attendance'))
+        else:
+            self.stdout.write(self.style.SUCCESS('all attendance matches'))
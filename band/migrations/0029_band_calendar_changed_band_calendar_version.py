@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0028_band_invite_occasionals_by_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='band',
+            name='calendar_changed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='band',
+            name='calendar_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
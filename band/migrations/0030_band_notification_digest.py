@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0029_band_calendar_changed_band_calendar_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='band',
+            name='notification_digest',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+import pytz
+from gig.util import GigStatusChoices, PlanStatusChoices
+
+
+def fill_attendance(apps, schema_editor):
+    Band = apps.get_model('band', 'Band')
+    Plan = apps.get_model('gig', 'Plan')
+    AttendanceYear = apps.get_model('band', 'AttendanceYear')
+    columns = {PlanStatusChoices.DEFINITELY: 'definitely', PlanStatusChoices.PROBABLY: 'probably',
+               PlanStatusChoices.PROBABLY_NOT: 'cant', PlanStatusChoices.CANT_DO_IT: 'cant',
+               PlanStatusChoices.NOT_INTERESTED: 'cant'}
+    for band in Band.objects.all():
+        zone = pytz.timezone(band.timezone)
+        counters = {}
+        plans = Plan.objects.filter(assoc__band=band, gig__trashed_date__isnull=True) \
+            .exclude(gig__status=GigStatusChoices.CANCELED).values_list('assoc_id', 'status', 'gig__date')
+        for assoc_id, status, date in plans.iterator():
+            key = (assoc_id, date.astimezone(zone).year)
+            row = counters.setdefault(key, AttendanceYear(assoc_id=assoc_id, year=key[1]))
+            column = columns.get(status, 'no_answer')
+            setattr(row, column, getattr(row, column) + 1)
+        AttendanceYear.objects.bulk_create(counters.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0030_band_notification_digest'),
+        ('gig', '0040_plantally'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttendanceYear',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('definitely', models.IntegerField(default=0)),
+                ('probably', models.IntegerField(default=0)),
+                ('cant', models.IntegerField(default=0)),
+                ('no_answer', models.IntegerField(default=0)),
+                ('assoc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attendance_years', to='band.assoc')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='attendanceyear',
+            constraint=models.UniqueConstraint(fields=('assoc', 'year'), name='unique_attendance_assoc_year'),
+        ),
+        migrations.RunPython(fill_attendance, migrations.RunPython.noop),
+    ]
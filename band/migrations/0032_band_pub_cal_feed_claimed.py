@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0031_attendanceyear'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='band',
+            name='pub_cal_feed_claimed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -15,14 +15,19 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from django.db import models
-from django.db.models import Q
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q
 from django.db.models.functions import Lower
 from go3.colors import the_colors
 from .util import BandStatusChoices, AssocStatusChoices
 from member.util import MemberStatusChoices, AgendaChoices
+from gig.util import GigStatusChoices, PlanStatusChoices
 from django.apps import apps
 from django.utils import timezone
+import datetime
 import pytz
 import uuid
 from go3.settings import LANGUAGES, URL_BASE
@@ -53,6 +58,8 @@ class Band(models.Model):
     anyone_can_manage_gigs = models.BooleanField(default=True)
     anyone_can_create_gigs = models.BooleanField(default=True)
     send_updates_by_default = models.BooleanField(default=True)
+    # hold gig notifications for a few minutes and send each member one email about everything that changed
+    notification_digest = models.BooleanField(default=False)
     invite_occasionals_by_default = models.BooleanField(default=True)
     
     simple_planning = models.BooleanField(default=False)
@@ -74,20 +81,34 @@ class Band(models.Model):
     # # flags to determine whether to recompute calendar feeds
     # band_cal_feed_dirty = models.BooleanField(default=True)
     pub_cal_feed_dirty = models.BooleanField(default=True)
+    # set while a worker is making the feed, so it can be made again if the worker dies
+    pub_cal_feed_claimed = models.DateTimeField(null=True, blank=True)
     pub_cal_feed_id = models.UUIDField(
         unique=True, default=uuid.uuid4, editable=False)
 
+    # bumped whenever something that shows up on members' calendars changes, so cached
+    # calendar events can be checked without rebuilding them
+    calendar_version = models.IntegerField(default=0)
+    calendar_changed = models.DateTimeField(null=True, blank=True)
+
     default_language = models.CharField(
         choices=LANGUAGES, max_length=200, default='en-US')
 
     def has_member(self, member):
-        return member and not member.is_anonymous and self.assocs.filter(member=member, status=AssocStatusChoices.CONFIRMED).count() == 1
+        if not member or member.is_anonymous:
+            return False
+        membership = Assoc.member_assocs.memberships(member).get(self.id)
+        return membership is not None and membership.status == AssocStatusChoices.CONFIRMED
 
     def is_admin(self, member):
-        not_anon = not member.is_anonymous
-        is_confirmed = self.assocs.filter(member=member, status=AssocStatusChoices.CONFIRMED, is_admin=True).count() == 1
-        is_super = member.is_superuser
-        return member and (is_super or (not_anon and is_confirmed))
+        if not member:
+            return False
+        if member.is_superuser:
+            return True
+        if member.is_anonymous:
+            return False
+        membership = Assoc.member_assocs.memberships(member).get(self.id)
+        return membership is not None and membership.status == AssocStatusChoices.CONFIRMED and membership.is_admin
 
     def is_editor(self, member):
         return member and not member.is_anonymous and (self.is_admin(member) or member.is_superuser)
@@ -128,6 +149,11 @@ class Band(models.Model):
             (~Q(enddate=None) & Q(enddate__lt=the_date))
         ).order_by('date')
 
+    def year_range(self, year):
+        """ the start and end of a year in the band's timezone """
+        zone = pytz.timezone(self.timezone)
+        return zone.localize(datetime.datetime(year, 1, 1)), zone.localize(datetime.datetime(year + 1, 1, 1))
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse("band-detail", kwargs={"pk": self.pk})
@@ -192,9 +218,59 @@ class Section(models.Model):
         ]
 
 
+@dataclass(frozen=True)
+class Membership:
+    """ the parts of an assoc that permission checks need """
+    status: int
+    is_admin: bool
+    is_occasional: bool
+
+
+# bumped whenever an assoc is saved or deleted, so membership maps held on member objects get reloaded
+_membership_generation = 0
+
+
+def _memberships_key(member_id, version):
+    return f'band-memberships-{member_id}-{version}'
+
+
+def invalidate_memberships(*member_ids):
+    """ called from the assoc signals - forget what we know about these members' bands. The version in the
+        database moves on so that every process stops using its cached copy, not just this one. """
+    global _membership_generation
+    _membership_generation += 1
+    member_model = Assoc._meta.get_field('member').related_model
+    members = member_model.objects.filter(id__in=member_ids)
+    cache.delete_many([_memberships_key(member_id, version)
+                       for member_id, version in members.values_list('id', 'membership_version')])
+    members.update(membership_version=F('membership_version') + 1)
+
+
 class MemberAssocManager(models.Manager):
     """ functions on the Assoc class that are queries for members """
 
+    def memberships(self, member):
+        """ all of the member's assocs as a dict of band id to Membership, loaded with one query and kept on
+            the member object - for request.user that means once per request. If MEMBERSHIP_CACHE_SECONDS
+            is set, the map is also shared between requests for that long, under the member's
+            membership_version so that a change in another process is seen on the next request. """
+        cached = getattr(member, '_band_memberships', None)
+        if cached and cached[0] == _membership_generation:
+            return cached[1]
+
+        generation = _membership_generation
+        key = _memberships_key(member.id, member.membership_version)
+        memberships = cache.get(key) if settings.MEMBERSHIP_CACHE_SECONDS else None
+        if memberships is None:
+            memberships = {band_id: Membership(status, is_admin, is_occasional)
+                           for band_id, status, is_admin, is_occasional in
+                           super().get_queryset().filter(member=member).values_list('band_id', 'status',
+                                                                                    'is_admin', 'is_occasional')}
+            if settings.MEMBERSHIP_CACHE_SECONDS:
+                cache.set(key, memberships, settings.MEMBERSHIP_CACHE_SECONDS)
+        member._band_memberships = (generation, memberships)
+        return memberships
+
     def confirmed_count(self, member):
         """ returns the asocs for bands we're confirmed for """
         return super().get_queryset().filter(member=member, status=AssocStatusChoices.CONFIRMED).count()
@@ -248,8 +324,7 @@ class Assoc(models.Model):
     # default_section_index = ndb.IntegerProperty( default=None )
 
     is_multisectional = models.BooleanField(default=False)
-    # commitment_number = ndb.IntegerProperty(default=0)
-    # commitment_total = ndb.IntegerProperty(default=0)
+    # GO2's commitment_number and commitment_total are now the AttendanceYear counters
     color = models.IntegerField(default=0)
 
     @property
@@ -264,3 +339,132 @@ class Assoc(models.Model):
 
     def __str__(self):
         return "{0} in {1} ({2})".format(self.member, self.band, self.status)
+
+
+class AttendanceYearManager(models.Manager):
+    """ an answer moves one count between the columns of the member's row for the gig's year; whole years
+        are counted again when a gig moves, is canceled or trashed, or gets new plans """
+
+    @staticmethod
+    def _counted(plans):
+        """ trashed and canceled gigs don't count towards attendance """
+        return plans.filter(gig__trashed_date__isnull=True).exclude(gig__status=GigStatusChoices.CANCELED)
+
+    def _count(self, band, year, assocs=None):
+        Plan = apps.get_model('gig', 'Plan')
+        start, end = band.year_range(year)
+        plans = self._counted(Plan.objects.filter(assoc__band=band, gig__date__gte=start, gig__date__lt=end))
+        if assocs is not None:
+            plans = plans.filter(assoc__in=assocs)
+        counters = {}
+        for assoc_id, status, count in plans.values_list('assoc_id', 'status').annotate(count=Count('id')).order_by():
+            counters.setdefault(assoc_id, AttendanceYear(assoc_id=assoc_id, year=year)).add(status, count)
+        return counters.values()
+
+    def move(self, gig_id, assoc_id, old_status, new_status):
+        """ count a plan under its new status instead of its old one. Either is None for a plan that's
+            just been made or deleted. """
+        old = AttendanceYear.column(old_status) if old_status is not None else None
+        new = AttendanceYear.column(new_status) if new_status is not None else None
+        if old == new:
+            return
+        Gig = apps.get_model('gig', 'Gig')
+        gig = Gig.objects.filter(id=gig_id).values_list('date', 'status', 'trashed_date', 'band__timezone').first()
+        if gig is None or gig[1] == GigStatusChoices.CANCELED or gig[2] is not None:
+            return
+        year = gig[0].astimezone(pytz.timezone(gig[3])).year
+        changes = {c: F(c) + n for c, n in [(old, -1), (new, 1)] if c}
+        counter = self.filter(assoc_id=assoc_id, year=year)
+        if new is None:
+            # a deleted plan can leave the member with nothing that year, which recount wouldn't keep
+            counter.update(**changes)
+            counter.filter(definitely=0, probably=0, cant=0, no_answer=0).delete()
+            return
+        if counter.update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                self.create(assoc_id=assoc_id, year=year, **{new: 1})
+        except IntegrityError:
+            # another answer from the same member made the row first
+            counter.update(**changes)
+
+    def recount(self, band, year, assocs=None):
+        """ count the plans again for the band's gigs in a year, for all the band's members or just some """
+        counters = self._count(band, year, assocs)
+        with transaction.atomic():
+            self.bulk_create(counters, update_conflicts=True, unique_fields=['assoc', 'year'],
+                             update_fields=['definitely', 'probably', 'cant', 'no_answer'])
+            gone = self.filter(assoc__band=band, year=year).exclude(assoc__in=[c.assoc_id for c in counters])
+            if assocs is not None:
+                gone = gone.filter(assoc__in=assocs)
+            gone.delete()
+
+    def _gig_years(self, band):
+        Gig = apps.get_model('gig', 'Gig')
+        zone = pytz.timezone(band.timezone)
+        return {d.astimezone(zone).year for d in Gig.objects.filter(band=band).values_list('date', flat=True)}
+
+    def rebuild(self, band):
+        """ count every year again, e.g. after the band has changed timezone """
+        years = self._gig_years(band)
+        with transaction.atomic():
+            self.filter(assoc__band=band).exclude(year__in=years).delete()
+            for year in years:
+                self.recount(band, year)
+
+    def expected(self, band):
+        """ what the band's counters should be, as a set of (assoc, year, definitely, probably, cant, no_answer) """
+        return {(c.assoc_id, c.year, c.definitely, c.probably, c.cant, c.no_answer)
+                for year in self._gig_years(band) for c in self._count(band, year)}
+
+    def years(self, band):
+        """ the years the band has attendance for, most recent first """
+        return list(self.filter(assoc__band=band).values_list('year', flat=True).distinct().order_by('-year'))
+
+
+class AttendanceYear(models.Model):
+    """
+    How a member answered the band's gigs in one year (in the band's timezone), so the attendance pages
+    don't have to go through the band's plan history. "Can't" covers every kind of no, and "no answer"
+    includes "don't know".
+    """
+    assoc = models.ForeignKey(Assoc, related_name='attendance_years', on_delete=models.CASCADE)
+    year = models.IntegerField()
+    definitely = models.IntegerField(default=0)
+    probably = models.IntegerField(default=0)
+    cant = models.IntegerField(default=0)
+    no_answer = models.IntegerField(default=0)
+
+    objects = AttendanceYearManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['assoc', 'year'], name='unique_attendance_assoc_year'),
+        ]
+
+    @staticmethod
+    def column(status):
+        """ the field a plan status is counted in """
+        if status == PlanStatusChoices.DEFINITELY:
+            return 'definitely'
+        elif status == PlanStatusChoices.PROBABLY:
+            return 'probably'
+        elif status in (PlanStatusChoices.PROBABLY_NOT, PlanStatusChoices.CANT_DO_IT,
+                        PlanStatusChoices.NOT_INTERESTED):
+            return 'cant'
+        else:
+            return 'no_answer'
+
+    def add(self, status, count):
+        column = self.column(status)
+        setattr(self, column, getattr(self, column) + count)
+
+    @property
+    def total(self):
+        return self.definitely + self.probably + self.cant + self.no_answer
+
+    @property
+    def rate(self):
+        """ the percentage of gigs the member said they'd (probably) make """
+        return round(100 * (self.definitely + self.probably) / self.total) if self.total else 0
@@ -14,14 +14,17 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.db.models import Q
-from .models import Band, Assoc, Section
+from .models import Band, Assoc, Section, AttendanceYear, invalidate_memberships
 from .util import AssocStatusChoices
-from gig.models import Plan
+from gig.models import Gig, Plan, plans_provisioned
 from gig.helpers import update_plan_default_section
+from .helpers import set_calendar_changed
 from text_unidecode import unidecode
+from member.models import Member
+import pytz
 import re
 
 @receiver(pre_save, sender=Band)
@@ -64,9 +67,7 @@ def set_initial_default_section_and_alum_status(sender, instance, **kwargs):
 def set_plan_sections(sender, instance, created, **kwargs):
 
     # if this is a new assoc, make plans for the new member
-    the_gigs = instance.band.gigs.future()
-    for g in the_gigs:
-        _ = g.member_plans
+    Plan.objects.provision(instance.band.gigs.future(), assocs=[instance])
 
     # update any plans that rely on knowing the default section
     update_plan_default_section(instance)
@@ -78,11 +79,29 @@ def set_plan_sections(sender, instance, created, **kwargs):
         m.preferences.save()
 
 
+@receiver(post_save, sender=Band)
+def set_band_calendar_changed(sender, instance, created, **kwargs):
+    if not created:
+        set_calendar_changed(instance.id)
+
+@receiver(post_save, sender=Assoc)
+@receiver(post_delete, sender=Assoc)
+def set_assoc_calendar_changed(sender, instance, **kwargs):
+    set_calendar_changed(instance.band_id)
+
+@receiver(post_save, sender=Assoc)
+@receiver(post_delete, sender=Assoc)
+def reset_memberships(sender, instance, **kwargs):
+    invalidate_memberships(instance.member_id)
+
+
 @receiver(pre_delete, sender=Section)
 def set_sections_of_assocs(sender, instance, **kwargs):
     # when a section gets deleted, set any assocs in the section to the band's default section before proceeding
     band_default_section = instance.band.sections.get(is_default=True)
+    member_ids = list(instance.default_assocs.values_list('member_id', flat=True))
     instance.default_assocs.update(default_section=band_default_section)
+    invalidate_memberships(*member_ids)
     
     # if any plans are using this section, set them back to the member's default section
     plans = Plan.objects.filter(plan_section=instance)
@@ -95,3 +114,52 @@ def set_sections_of_assocs(sender, instance, **kwargs):
         p.section = p.assoc.default_section
         p.save()
 
+
+# keep the attendance counters current
+def _attendance_year(gig, band):
+    return gig.date.astimezone(pytz.timezone(band.timezone)).year
+
+@receiver(post_save, sender=Plan)
+def update_attendance_for_plan(sender, instance, created, **kwargs):
+    old_status = None if created else getattr(instance, '_old_status', None)
+    AttendanceYear.objects.move(instance.gig_id, instance.assoc_id, old_status, instance.status)
+
+@receiver(post_delete, sender=Plan)
+def update_attendance_after_plan_delete(sender, instance, origin=None, **kwargs):
+    # if the gig or the member is going, the gig's post_delete or the cascade takes care of it
+    if not issubclass(getattr(origin, 'model', type(origin)), (Gig, Band, Assoc, Member)):
+        AttendanceYear.objects.move(instance.gig_id, instance.assoc_id, instance.status, None)
+
+@receiver(post_save, sender=Gig)
+def update_attendance_for_gig(sender, instance, created, **kwargs):
+    # a new gig's plans are counted when they're provisioned. Otherwise only moving, canceling or
+    # trashing the gig changes what it counts towards.
+    old = getattr(instance, '_old', None)
+    if created or not old or (old.date, old.status, old.trashed_date) == \
+            (instance.date, instance.status, instance.trashed_date):
+        return
+    band = instance.band
+    for year in {_attendance_year(instance, band), _attendance_year(old, band)}:
+        AttendanceYear.objects.recount(band, year)
+
+@receiver(post_delete, sender=Gig)
+def update_attendance_after_gig_delete(sender, instance, origin=None, **kwargs):
+    if not issubclass(getattr(origin, 'model', type(origin)), Band):
+        AttendanceYear.objects.recount(instance.band, _attendance_year(instance, instance.band))
+
+@receiver(pre_save, sender=Band)
+def remember_timezone(sender, instance, **kwargs):
+    instance._old_timezone = Band.objects.filter(pk=instance.pk).values_list('timezone', flat=True).first() \
+        if instance.pk else None
+
+@receiver(post_save, sender=Band)
+def update_attendance_for_timezone(sender, instance, created, **kwargs):
+    # the years are in the band's timezone, so gigs near new year can move to another year
+    if not created and getattr(instance, '_old_timezone', None) != instance.timezone:
+        AttendanceYear.objects.rebuild(instance)
+
+@receiver(plans_provisioned)
+def update_attendance_for_new_plans(sender, gigs, assocs, **kwargs):
+    years = {(g.band, _attendance_year(g, g.band)) for g in gigs}
+    for band, year in years:
+        AttendanceYear.objects.recount(band, year, assocs=assocs)
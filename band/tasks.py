@@ -14,9 +14,8 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from band.models import Band
-from band.helpers import update_band_calfeed
-from django_q.tasks import async_task
+import logging
+from band.helpers import regenerate_band_calfeeds
 from django.conf import settings
 
 
@@ -26,7 +25,9 @@ def update_all_calfeeds():
     if settings.DYNAMIC_CALFEED:
         return
 
-    bands = Band.objects.filter(pub_cal_feed_dirty=True)
-    for b in bands:
-        async_task(update_band_calfeed, b.id)
-    bands.update(pub_cal_feed_dirty=False)
+    count = batches = 0
+    for size, seconds in regenerate_band_calfeeds():
+        count += size
+        batches += 1
+        logging.info(f'made {size} band calfeeds in {seconds:.2f}s')
+    return f'updated {count} band calfeeds in {batches} batches'
@@ -16,16 +16,20 @@
 """
 
 from re import A
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.urls import reverse
+from django.core.cache import cache
 from django.core import mail
-from .models import Band, Assoc, Section
+from .models import Band, Assoc, Section, AttendanceYear
 from .helpers import prepare_band_calfeed, band_calfeed, update_band_calfeed, do_delete_assoc
 from .util import _get_active_bands, _get_inactive_bands, _get_active_band_members
 from member.models import Member, Invite
 from gig.models import Gig, Plan
-from gig.util import GigStatusChoices
+from gig.util import GigStatusChoices, PlanStatusChoices
 from band import helpers
+from band.tasks import update_all_calfeeds
 from member.util import MemberStatusChoices
 from band.util import AssocStatusChoices
 from django.utils import timezone
@@ -34,7 +38,11 @@ import pytz
 from pytz import timezone as pytz_timezone
 import json
 import os
+from io import StringIO
+from django.core.management import call_command
 from django.conf import settings
+from django.utils.http import parse_http_date
+from unittest import mock
 from pyfakefs.fake_filesystem_unittest import TestCase as FSTestCase
 from freezegun import freeze_time
 import pytest
@@ -621,6 +629,75 @@ class BandTests(GigTestBase):
         plans = g2.plans.filter(assoc__member=self.joeuser)
         self.assertEqual(plans.count(),1) # future plan should be gone
 
+class MembershipTest(GigTestBase):
+    def test_membership_checks(self):
+        a = Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.PENDING)
+        self.assertFalse(self.band.has_member(self.joeuser))
+        self.assertFalse(self.band.is_admin(self.joeuser))
+
+        # the same member object sees changes to its assocs
+        a.status = AssocStatusChoices.CONFIRMED
+        a.save()
+        self.assertTrue(self.band.has_member(self.joeuser))
+        self.assertFalse(self.band.is_admin(self.joeuser))
+        a.is_admin = True
+        a.save()
+        self.assertTrue(self.band.is_admin(self.joeuser))
+        a.delete()
+        self.assertFalse(self.band.has_member(self.joeuser))
+        self.assertTrue(self.band.is_admin(self.super))
+
+    @override_settings(MEMBERSHIP_CACHE_SECONDS=60)
+    def test_shared_membership_cache(self):
+        a = Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.CONFIRMED)
+        self.assertTrue(self.band.has_member(Member.objects.get(id=self.joeuser.id)))
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(self.band.has_member(Member.objects.get(id=self.joeuser.id)))
+        self.assertEqual(len(ctx.captured_queries), 1) # just getting the member
+        a.delete()
+        self.assertFalse(self.band.has_member(Member.objects.get(id=self.joeuser.id)))
+
+    @override_settings(MEMBERSHIP_CACHE_SECONDS=60)
+    def test_membership_cache_in_other_processes(self):
+        a = Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.CONFIRMED)
+        stale = Member.objects.get(id=self.joeuser.id)
+        self.assertTrue(self.band.has_member(stale))
+        old_key = f'band-memberships-{stale.id}-{stale.membership_version}'
+        old_value = cache.get(old_key)
+
+        a.status = AssocStatusChoices.NOT_CONFIRMED
+        a.save()
+        # another process doesn't see the delete, so its copy is still there
+        cache.set(old_key, old_value)
+        self.assertFalse(self.band.has_member(Member.objects.get(id=self.joeuser.id)))
+
+        # moving the assocs out of a deleted section changes the version too
+        a.status = AssocStatusChoices.CONFIRMED
+        a.default_section = Section.objects.create(band=self.band, name='Horns')
+        a.save()
+        version = Member.objects.get(id=self.joeuser.id).membership_version
+        a.default_section.delete()
+        self.assertGreater(Member.objects.get(id=self.joeuser.id).membership_version, version)
+
+    def test_one_membership_query_per_page(self):
+        a = Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.CONFIRMED)
+        g = self.create_gig(self.band_admin)
+        p = g.plans.get(assoc=a)
+        self.client.force_login(self.joeuser)
+
+        for url in [reverse('gig-detail', args=[g.id]),
+                    reverse('band-detail', args=[self.band.id]),
+                    reverse('plan-update', args=[p.id, 1])]:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            membership_queries = [q for q in ctx.captured_queries
+                                  if 'FROM "band_assoc"' in q['sql'] and
+                                  f'"band_assoc"."member_id" = {self.joeuser.id}' in q['sql'] and
+                                  '"band_assoc"."status" = ' not in q['sql']]
+            self.assertEqual(len(membership_queries), 1, url)
+
+
 class SectionTest(TestCase):
     def test_auto_assign_section_order(self):
         band = Band.objects.create(name="Example")
@@ -818,9 +895,57 @@ class BandCalfeedTest(FSTestCase):
         self.band.refresh_from_db()
         # self.assertFalse(self.band.pub_cal_feed_dirty) # moved this to an async task
 
-        cf = band_calfeed(request=None, pk=self.band.pub_cal_feed_id)
+        cf = band_calfeed(request=RequestFactory().get('/'), pk=self.band.pub_cal_feed_id)
         self.assertTrue(cf.content.decode('ascii').find('EVENT') > 0)
 
+    @override_settings(DYNAMIC_CALFEED=True)
+    def test_band_calfeed_cached(self):
+        factory = RequestFactory()
+        with mock.patch('band.helpers.make_band_calfeed', wraps=helpers.make_band_calfeed) as make:
+            first = band_calfeed(request=factory.get('/'), pk=self.band.pub_cal_feed_id)
+            second = band_calfeed(request=factory.get('/'), pk=self.band.pub_cal_feed_id)
+            self.assertEqual(make.call_count, 1)
+            self.assertEqual(first.content, second.content)
+            self.assertEqual(second.headers['Access-Control-Allow-Origin'], '*')
+
+            # the validators come back as a 304, without making the feed
+            etag = first.headers['ETag']
+            r = band_calfeed(request=factory.get('/', HTTP_IF_NONE_MATCH=etag), pk=self.band.pub_cal_feed_id)
+            self.assertEqual(r.status_code, 304)
+            r = band_calfeed(request=factory.get('/', HTTP_IF_MODIFIED_SINCE=first.headers['Last-Modified']),
+                             pk=self.band.pub_cal_feed_id)
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(make.call_count, 1)
+
+            # a gig leaving the feed makes a new one
+            g = Gig.objects.get(title='Good Gig')
+            g.trashed_date = timezone.now()
+            g.save()
+            r = band_calfeed(request=factory.get('/', HTTP_IF_NONE_MATCH=etag), pk=self.band.pub_cal_feed_id)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(make.call_count, 2)
+            self.assertNotIn(b'Good Gig', r.content)
+            self.assertNotEqual(r.headers['ETag'], etag)
+        self.assertEqual(parse_http_date(r.headers['Last-Modified']),
+                         int(Band.objects.get(id=self.band.id).calendar_changed.timestamp()))
+
+    @override_settings(CALFEED_BATCH_SIZE=1, DYNAMIC_CALFEED=False)
+    def test_regenerate_band_calfeeds(self):
+        self.setUpPyfakefs()    # fake a file system
+        os.mkdir('calfeeds')
+        other = Band.objects.create(name='other band')
+        Band.objects.update(pub_cal_feed_dirty=True)
+
+        self.assertEqual(update_all_calfeeds(), 'updated 2 band calfeeds in 2 batches')
+        self.assertFalse(Band.objects.filter(pub_cal_feed_dirty=True).exists())
+        strip = lambda feed: [line for line in feed.split(b'\r\n') if not line.startswith(b'DTSTAMP')]
+        for b in [self.band, other]:
+            with open(f'calfeeds/{b.pub_cal_feed_id}.txt', 'rb') as f:
+                self.assertEqual(strip(f.read()), strip(prepare_band_calfeed(b)))
+
+        # nothing dirty, nothing to do
+        self.assertEqual(update_all_calfeeds(), 'updated 0 band calfeeds in 0 batches')
+
     def test_band_calfeeds_dirty(self):
         self.band.pub_cal_feed_dirty = False
         self.band.save()
@@ -831,6 +956,18 @@ class BandCalfeedTest(FSTestCase):
         self.band.refresh_from_db()
         self.assertTrue(self.band.pub_cal_feed_dirty)
 
+    def test_band_calfeeds_dirty_stale_band(self):
+        # the task gets a copy of the band from when it was queued, which mustn't undo later changes
+        stale = Band.objects.get(id=self.band.id)
+        g = Gig.objects.first()
+        g.title = "Edited"
+        g.save()
+        version = Band.objects.get(id=self.band.id).calendar_version
+        helpers.set_calfeeds_dirty(stale)
+        band = Band.objects.get(id=self.band.id)
+        self.assertEqual(band.calendar_version, version)
+        self.assertTrue(band.pub_cal_feed_dirty)
+
     def test_band_calfeed_description(self):
         """
         one of the gigs has 'details' including the word 'private' and a
@@ -1385,6 +1522,95 @@ class MemberAttendanceViewTests(TestCase):
         self.assertIsNotNone(jan_item)
         self.assertEqual(jan_item['plan'].comment, "Looking forward to it!")
 
+    def counter(self, assoc, year):
+        return AttendanceYear.objects.get(assoc=assoc, year=year)
+
+    def test_counters_follow_plans(self):
+        c = self.counter(self.member_assoc, 2023)
+        self.assertEqual((c.definitely, c.probably, c.cant, c.no_answer), (1, 0, 1, 0))
+        self.assertEqual(c.rate, 50)
+        c = self.counter(self.member_assoc, 2024)
+        self.assertEqual((c.definitely, c.probably, c.cant, c.no_answer), (1, 1, 0, 0))
+        c = self.counter(self.admin_assoc, 2024)
+        self.assertEqual((c.definitely, c.no_answer), (0, 2))
+
+        self.plan_2023_2.status = 1
+        self.plan_2023_2.save()
+        self.assertEqual(self.counter(self.member_assoc, 2023).definitely, 2)
+
+    def test_answer_moves_one_count(self):
+        # an answer only touches the member's row for the year, without counting the year again
+        with mock.patch.object(AttendanceYear.objects, 'recount') as recount:
+            self.plan_2023_2.status = PlanStatusChoices.PROBABLY
+            self.plan_2023_2.save()
+            self.gig_2023_1.title = 'new title'
+            self.gig_2023_1.save()
+        recount.assert_not_called()
+        c = self.counter(self.member_assoc, 2023)
+        self.assertEqual((c.definitely, c.probably, c.cant, c.no_answer), (1, 1, 0, 0))
+
+        self.plan_2023_2.delete()
+        c = self.counter(self.member_assoc, 2023)
+        self.assertEqual((c.definitely, c.probably, c.cant, c.no_answer), (1, 0, 0, 0))
+
+    def test_counters_follow_gigs(self):
+        # canceled gigs don't count
+        self.gig_2024_1.status = GigStatusChoices.CANCELED
+        self.gig_2024_1.save()
+        c = self.counter(self.member_assoc, 2024)
+        self.assertEqual((c.definitely, c.probably), (1, 0))
+
+        # moving a gig to another year moves its plans
+        self.gig_2024_2.date = datetime(2023, 6, 1, 19, 0, tzinfo=pytz_timezone('UTC'))
+        self.gig_2024_2.save()
+        self.assertEqual(self.counter(self.member_assoc, 2023).definitely, 2)
+        self.assertFalse(AttendanceYear.objects.filter(assoc=self.member_assoc, year=2024).exists())
+
+        self.gig_2023_1.delete()
+        self.assertEqual(self.counter(self.member_assoc, 2023).definitely, 1)
+
+    def test_counters_follow_timezone(self):
+        # early on new year's day in UTC is still the old year in New York
+        self.gig_2024_1.date = datetime(2024, 1, 1, 2, 0, tzinfo=pytz_timezone('UTC'))
+        self.gig_2024_1.save()
+        self.assertEqual(self.counter(self.member_assoc, 2024).probably, 1)
+
+        self.band.timezone = 'America/New_York'
+        self.band.save()
+        self.assertEqual(self.counter(self.member_assoc, 2024).probably, 0)
+        self.assertEqual(self.counter(self.member_assoc, 2023).probably, 1)
+
+    def test_reconcile_attendance(self):
+        AttendanceYear.objects.filter(assoc=self.member_assoc, year=2023).update(definitely=7)
+
+        out = StringIO()
+        call_command('reconcile_attendance', '--verify-only', stdout=out)
+        self.assertIn(f'attendance for band {self.band.id} is wrong', out.getvalue())
+        self.assertEqual(self.counter(self.member_assoc, 2023).definitely, 7)
+
+        out = StringIO()
+        call_command('reconcile_attendance', stdout=out)
+        self.assertIn('repaired the attendance for 1 bands', out.getvalue())
+        self.assertEqual(self.counter(self.member_assoc, 2023).definitely, 1)
+
+        out = StringIO()
+        call_command('reconcile_attendance', stdout=out)
+        self.assertIn('all attendance matches', out.getvalue())
+
+    def test_attendance_page(self):
+        url = reverse('band-attendance', args=[self.band.id])
+        self.client.force_login(self.regular_member)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(self.band_admin)
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, {'year': '2024'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['available_years'], [datetime.now().year, 2024, 2023])
+        self.assertEqual(len(resp.context['attendance']), 2)
+        self.assertContains(resp, "100%")
+        self.assertFalse([q for q in ctx.captured_queries if 'gig_plan' in q['sql']])
+
 
 class TestBandInviteAPI(GigTestBase):
     def setUp(self):
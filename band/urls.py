@@ -26,6 +26,7 @@ urlpatterns = [
     path('<int:pk>/update/', views.UpdateView.as_view(), name='band-update'),
     path('<int:pk>/members/', views.AllMembersView.as_view(), name='all-members'),
     path('<int:pk>/member/<int:member_id>/attendance/', views.MemberAttendanceView.as_view(), name='member-attendance'),
+    path('<int:pk>/attendance/', views.AttendanceView.as_view(), name='band-attendance'),
     path('<int:pk>/stats/', views.BandStatsView.as_view(), name='band-stats'),
     path('<int:pk>/section/<int:sk>', views.SectionMembersView.as_view(), name='section-members'),
     path('<int:pk>/member_spreadsheet', views.member_spreadsheet, name='member-spreadsheet'),
@@ -11,9 +11,10 @@ from django.shortcuts import get_object_or_404, render
 from django.template.loader import render_to_string
 from django.db.models.functions import Lower
 from django.shortcuts import redirect
+from django.utils import timezone
 from django.utils.formats import date_format, time_format
 from pytz import timezone as pytz_timezone
-from .models import Band, Assoc, Section
+from .models import Band, Assoc, Section, AttendanceYear
 from .forms import BandForm
 from .util import AssocStatusChoices, _get_active_bands
 from member.models import Invite
@@ -52,8 +53,8 @@ class DetailView(LoginRequiredMixin, UserPassesTestMixin, generic.DetailView):
         if self.request.user.is_superuser:
             return True
         # if we're not active in the band, deny entry!
-        assoc = Assoc.objects.filter(band=self.kwargs['pk'], member=self.request.user).first()
-        return assoc and assoc.status==AssocStatusChoices.CONFIRMED
+        membership = Assoc.member_assocs.memberships(self.request.user).get(self.kwargs['pk'])
+        return membership is not None and membership.status == AssocStatusChoices.CONFIRMED
 
     def handle_no_permission(self):
         """ if the user has no permission but is authenticated, direct to the public page """
@@ -78,9 +79,7 @@ class DetailView(LoginRequiredMixin, UserPassesTestMixin, generic.DetailView):
         context['url_base'] = URL_BASE
         context['calfeed_url'] = self.request.build_absolute_uri(reverse('band-calfeed',kwargs={'pk':the_band.pub_cal_feed_id}))
 
-        assoc = None if the_user.is_superuser else Assoc.objects.get(band=the_band, member=the_user)
-
-        context['the_user_is_band_admin'] = the_user.is_superuser or (assoc and assoc.is_admin)
+        context['the_user_is_band_admin'] = the_band.is_admin(the_user)
         context['the_pending_members'] = Assoc.objects.filter(band=the_band, status=AssocStatusChoices.PENDING)
         context['the_invited_members'] = Invite.objects.filter(band=the_band)
 
@@ -166,17 +165,9 @@ class MemberAttendanceView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
 
         from gig.models import Plan
         from datetime import datetime
-        from django.db.models.functions import ExtractYear
 
-        # Get list of years that have gigs using database aggregation
-        available_years = list(
-            the_band.gigs
-            .filter(date__isnull=False)
-            .annotate(year=ExtractYear('date'))
-            .values_list('year', flat=True)
-            .distinct()
-            .order_by('-year')
-        )
+        # the years come from the attendance counters rather than a scan of the band's gigs
+        available_years = AttendanceYear.objects.years(the_band)
 
         # Get the selected year from query params, default to most recent year
         selected_year = self.request.GET.get('year')
@@ -188,10 +179,11 @@ class MemberAttendanceView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
         else:
             selected_year = datetime.now().year
 
-        # Query gigs from the selected year
+        # Query gigs from the selected year, in the band's timezone like the counters
+        start, end = the_band.year_range(selected_year)
         year_gigs = list(
             the_band.gigs
-            .filter(date__year=selected_year)
+            .filter(date__gte=start, date__lt=end)
             .order_by('-date')
         )
 
@@ -224,6 +216,34 @@ class MemberAttendanceView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
         return context
 
 
+class AttendanceView(LoginRequiredMixin, UserPassesTestMixin, TemplateView):
+    """ every member's attendance for a year, from the attendance counters """
+    template_name = 'band/band_attendance.html'
+
+    def test_func(self):
+        band = get_object_or_404(Band, id=self.kwargs['pk'])
+        return self.request.user.is_superuser or band.is_admin(self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        the_band = Band.objects.get(id=self.kwargs['pk'])
+
+        available_years = AttendanceYear.objects.years(the_band)
+        try:
+            selected_year = int(self.request.GET['year'])
+        except (KeyError, ValueError):
+            selected_year = available_years[0] if available_years else timezone.now().year
+
+        context['the_band'] = the_band
+        context['available_years'] = available_years
+        context['selected_year'] = selected_year
+        context['attendance'] = (AttendanceYear.objects
+                                 .filter(assoc__band=the_band, year=selected_year)
+                                 .select_related('assoc', 'assoc__member')
+                                 .order_by(Lower('assoc__member__display_name')))
+        return context
+
+
 class BandStatsView(LoginRequiredMixin, BandMemberRequiredMixin, TemplateView):
     template_name = 'band/band_stats.html'
 
@@ -355,12 +375,18 @@ def archive_spreadsheet(request, pk):
     writer = csv.writer(response)
     writer.writerow(['date ', 'gig', 'contact','call time', 'set time', 'end time', 'pay deal','status'])
     zone = pytz_timezone(band.timezone)
-    for gig in Gig.objects.filter(band=band, is_archived=True).order_by('date'):
+    # the contact comes from the snapshot taken when the gig was archived, so this is one query
+    for gig in Gig.objects.filter(band=band, is_archived=True).select_related('snapshot').order_by('date'):
         date = date_format(gig.date.astimezone(zone))
         calltime = time_format(gig.date.astimezone(zone)) if gig.has_call_time else ''
         settime = time_format(gig.setdate.astimezone(zone)) if gig.has_set_time else ''
         endtime = time_format(gig.enddate.astimezone(zone)) if gig.has_end_time else ''
-        writer.writerow([date, gig.title, gig.contact.username, calltime, settime, endtime,
+        snapshot = getattr(gig, 'snapshot', None)
+        if snapshot:
+            contact = snapshot.data['contact']['username'] if snapshot.data['contact'] else ''
+        else:
+            contact = gig.contact.username if gig.contact else ''
+        writer.writerow([date, gig.title, contact, calltime, settime, endtime,
                           gig.paid, gig.status_string()])
 
     return response
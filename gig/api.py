@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from django.http import JsonResponse
 from ninja import Field, FilterSchema, ModelSchema, Query, Router, Schema
@@ -35,6 +35,7 @@ class GigSchema(ModelSchema):
     end_time: Optional[str] = None
     gig_status: Optional[str] = None
     is_in_trash: bool
+    plan_counts: Dict[str, int]
 
     class Meta:
         model = Gig
@@ -107,6 +108,11 @@ class GigSchema(ModelSchema):
     def resolve_is_in_trash(obj):
         return obj.is_in_trash
 
+    @staticmethod
+    def resolve_plan_counts(obj):
+        counts = obj.plan_counts
+        return {str(label): counts[status] for status, label in PlanStatusChoices.choices}
+
 
 class GigListResponse(Schema):
     count: int
@@ -142,7 +148,7 @@ def list_all_gigs(request, filters: GigFilterSchema = Query(...)):
             plans = plans.filter(status=filters.plan_status)
         if filters.gig_status in [status[0] for status in GigStatusChoices.choices]:
             plans = plans.filter(gig__status=filters.gig_status)
-        gigs = Gig.objects.filter(plans__in=plans).distinct()
+        gigs = Gig.objects.filter(plans__in=plans).distinct().prefetch_related('tallies')
     return {"count": gigs.count(), "gigs": gigs if gigs else []}
 
 @router.get("/plan_status_choices", response={200: List[dict]})
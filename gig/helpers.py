@@ -23,17 +23,21 @@ from django.utils import timezone
 from django.utils.formats import date_format, time_format
 from django.utils.translation import gettext_lazy as _
 from django.utils.timezone import template_localtime, now
-from django.db.models import Q
-from .models import Gig, Plan
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Lower
+from django.template.defaultfilters import linebreaks_filter as linebreaks, urlize
+from .models import Gig, Plan, NotificationSend, NotificationChunk, DigestEntry, GigSnapshot, PlanTally
 from .util import PlanStatusChoices
 from band.models import Section, Assoc, AssocStatusChoices
 from stats.tasks import register_sent_emails
 from gig.util import PlanStatusChoices
-from lib.email import prepare_email, send_messages_async
+from lib.email import prepare_email, send_messages_async, EmailVariants, render_email_part
 from lib.translation import join_trans
 from django_q.tasks import async_task
 from datetime import timedelta
 from collections import Counter
+from dataclasses import dataclass, field
 import uuid
 import calendar
 from go3.settings import URL_BASE
@@ -49,9 +53,9 @@ def band_editor_required(func):
 def plan_editor_required(func):
     def decorated(request, pk, *args, **kw):
         p = get_object_or_404(Plan, pk=pk)
-        is_self = (request.user == p.assoc.member)
-        is_band_admin = Assoc.objects.filter(
-            member=request.user, band=p.assoc.band, is_admin=True).count() == 1
+        is_self = (request.user.id == p.assoc.member_id)
+        membership = Assoc.member_assocs.memberships(request.user).get(p.assoc.band_id)
+        is_band_admin = membership is not None and membership.is_admin
         if not (is_self or is_band_admin or request.user.is_superuser):
             return HttpResponseForbidden()
 
@@ -59,6 +63,109 @@ def plan_editor_required(func):
     return decorated
 
 
+@dataclass
+class RosterSection:
+    """ one section of a gig's roster: its plans, sorted by member name, and how many of each status """
+    section: Section
+    plans: list = field(default_factory=list)
+    counts: Counter = field(default_factory=Counter)
+
+
+@dataclass
+class Roster:
+    """ the plans for a gig, grouped by section in band order, plus the totals for the whole gig """
+    sections: list
+    counts: Counter
+
+    @property
+    def band_sections(self):
+        return [s.section for s in self.sections]
+
+    @property
+    def status_counts(self):
+        """ (status, count) pairs in the order the gig page shows them, with 'no plan' last """
+        statuses = [s for s in PlanStatusChoices.values if s != PlanStatusChoices.NO_PLAN]
+        statuses.append(PlanStatusChoices.NO_PLAN)
+        return [(s, self.counts[s]) for s in statuses]
+
+
+def build_roster(gig):
+    """ Get the gig's plans with everything the roster shows in one query and group them by section
+        in a single pass, so the template doesn't have to regroup or look anything up per row. """
+    plans = (gig.member_plans
+             .select_related('assoc', 'assoc__member', 'section')
+             .order_by(Lower('assoc__member__display_name')))
+    return _group_roster(gig, gig.band.sections.all(), plans)
+
+
+def _group_roster(gig, sections, plans):
+    roster = {s.id: RosterSection(s) for s in sections}
+    counts = Counter()
+    for plan in plans:
+        # these are the same objects for every row, so hand them over rather than fetch them again
+        plan.gig = gig
+        plan.assoc.band = gig.band
+        counts[plan.status] += 1
+        entry = roster.get(plan.section_id)
+        if entry is None:
+            continue
+        entry.plans.append(plan)
+        entry.counts[plan.status] += 1
+    return Roster(sections=list(roster.values()), counts=counts)
+
+
+def _render_text(text):
+    """ the same as |urlize|linebreaks in a template """
+    return linebreaks(urlize(text, autoescape=True), autoescape=True) if text else ''
+
+
+def _snapshot_data(gig, roster):
+    return {
+        'contact': {'id': gig.contact.id, 'name': gig.contact.display_name,
+                    'username': gig.contact.username} if gig.contact else None,
+        'details': _render_text(gig.details),
+        'setlist': _render_text(gig.setlist),
+        'counts': roster.status_counts,
+        'sections': [{
+            # the default section is translated when it's shown
+            'name': None if s.section.is_default else s.section.name,
+            'plans': [{
+                'member': p.assoc.member.id,
+                'name': p.assoc.member.display_name,
+                'is_active': p.assoc.member.is_active,
+                'status': p.status,
+                'attending': p.attending,
+                'occasional': p.assoc.is_occasional,
+                'feedback': p.feedback_string,
+                'comment': p.comment or '',
+            } for p in s.plans],
+        } for s in roster.sections],
+    }
+
+
+def snapshot_gigs(gig_ids):
+    """ Take the snapshots that archived gigs are shown from, for a batch of gigs with a fixed number of
+        queries. Any snapshot a gig already has is replaced. """
+    gigs = list(Gig.objects.filter(id__in=gig_ids, is_archived=True).select_related('band', 'contact'))
+    sections = {}
+    for section in Section.objects.filter(band_id__in={g.band_id for g in gigs}):
+        sections.setdefault(section.band_id, []).append(section)
+    plans = {}
+    # archived gigs show everyone's plans, not just those of current members
+    for plan in (Plan.objects.filter(gig__in=gigs)
+                 .select_related('assoc', 'assoc__member', 'section')
+                 .order_by(Lower('assoc__member__display_name'))):
+        plans.setdefault(plan.gig_id, []).append(plan)
+
+    snapshots = [GigSnapshot(gig=g, data=_snapshot_data(g, _group_roster(g, sections.get(g.band_id, []),
+                                                                         plans.get(g.id, []))))
+                 for g in gigs]
+    with transaction.atomic():
+        GigSnapshot.objects.filter(gig__in=gigs).delete()
+        GigSnapshot.objects.bulk_create(snapshots)
+    return snapshots
+
+
 @login_required
 @plan_editor_required
 def update_plan(request, plan, val):
@@ -95,7 +202,12 @@ def update_plan_default_section(assoc):
     """
     the default section of the member assoc has changed, so update any plans that aren't overriding
     """
-    Plan.objects.filter(assoc=assoc, plan_section=None).update(section=assoc.default_section)
+    plans = Plan.objects.filter(assoc=assoc, plan_section=None).exclude(section=assoc.default_section)
+    gig_ids = list(plans.values_list('gig_id', flat=True).distinct())
+    if gig_ids:
+        # the update skips the plan signals, so count the moved plans here
+        plans.update(section=assoc.default_section)
+        PlanTally.objects.sync(gig_ids)
 
 def date_format_func(dt, fmt):
     # Returns lambdas that the template will evaluate in the correct
@@ -159,26 +271,46 @@ def is_single_day(gig):
         return True
     return (end - gig.date) < datetime.timedelta(days=1)
 
-def email_from_plan(plan, template, dates=None):
-    gig = plan.gig
+def gig_email_context(gig, dates=None, previous=None):
+    """ the parts of a gig email that are the same for everyone it goes to. The changes are the ones
+        since the previous history record, or since the one passed in. """
     latest_record = gig.history.latest()
-    changes = generate_changes(latest_record, latest_record.prev_record)
-    member = plan.assoc.member
+    if previous is None:
+        previous = latest_record.prev_record
+    changes = generate_changes(latest_record, previous)
     contact_name, contact_email = ((gig.contact.display_name, gig.contact.email)
                                     if gig.contact else ('??', None))
-    context = {
+    return {
         'gig': gig,
         'changes': changes,
-        'changes_title': join_trans(_(', '), (c[0] for c in changes)),
+        'changes_title': join_trans(_(', '), [c[0] for c in changes]),
         'single_day': is_single_day(gig),
         'contact_name': contact_name,
+        'contact_email': contact_email,
+        'dates': dates,
+        'previous_history_id': previous.history_id if previous else None,
+        **PlanStatusChoices.__members__,
+    }
+
+def email_from_plan(plan, template, dates=None, gig_context=None, variants=None):
+    """ make the email for one plan. When sending to a lot of plans, pass in the gig_context and an
+        EmailVariants so the gig's changes are worked out once and each kind of email is only rendered once. """
+    if gig_context is None:
+        gig_context = gig_email_context(plan.gig, dates)
+    member = plan.assoc.member
+    context = {
+        **gig_context,
         'plan': plan,
         'status': plan.status,
         'status_label': PlanStatusChoices(plan.status).label,
-        'dates': dates,
-        **PlanStatusChoices.__members__,
     }
-    return prepare_email(member.as_email_recipient(), template, context, reply_to=[contact_email])
+    reply_to = [gig_context['contact_email']]
+    if variants is None:
+        return prepare_email(member.as_email_recipient(), template, context, reply_to=reply_to)
+    # everything in the email except the answer links depends only on the gig and the plan's status
+    return variants.prepare_email(member.as_email_recipient(), template, context,
+                                  key=(plan.gig_id, plan.status), tokens={'plan': str(plan.id)},
+                                  reply_to=reply_to)
 
 def send_emails_from_plans(plans_query, template, dates=None):
     contactable = plans_query.filter(assoc__status=AssocStatusChoices.CONFIRMED,
@@ -186,12 +318,103 @@ def send_emails_from_plans(plans_query, template, dates=None):
     # if the plan is for a gig that did not invite occasionals, select only members that are not
     # occasional
     contactable = contactable.filter(Q(gig__invite_occasionals=True) | Q(assoc__is_occasional=False))
-    send_messages_async(email_from_plan(p, template, dates) for p in contactable)
+
+    # the emails themselves are made and sent in chunks by send_notification_chunk
+    gig_plans = {}
+    for plan_id, gig_id in contactable.order_by('gig_id', 'id').values_list('id', 'gig_id'):
+        gig_plans.setdefault(gig_id, []).append(str(plan_id))
+    for gig_id, plan_ids in gig_plans.items():
+        NotificationSend.objects.start(gig_id, template, plan_ids, dates)
 
     # do this as a counter even though any specific call of this will be for a single band.
     if contactable.count():
         register_sent_emails(contactable.first().gig.band, contactable.count())
 
+def send_notification_chunk(chunk_id):
+    """ Send the emails for one chunk of a notification. The emails go into the outbox in the same
+        transaction that marks the chunk sent, so running a chunk again never sends anything twice. """
+    with transaction.atomic():
+        chunk = (NotificationChunk.objects.select_for_update(of=('self',)).select_related('send', 'send__gig')
+                 .filter(id=chunk_id, sent__isnull=True).first())
+        if chunk is None:
+            return
+
+        send = chunk.send
+        dates = send.get_dates()
+        gig_context = gig_email_context(send.gig, dates)
+        variants = EmailVariants()
+        plans = (Plan.objects.filter(id__in=chunk.plans)
+                 .select_related('gig', 'gig__band', 'gig__contact', 'assoc', 'assoc__band',
+                                 'assoc__member', 'assoc__member__preferences'))
+        emails = []
+        held = []
+        for p in plans:
+            if wants_digest(p, send.template):
+                held.append(DigestEntry(member=p.assoc.member, plan=p, template=send.template,
+                                        previous=gig_context['previous_history_id']))
+            else:
+                emails.append(email_from_plan(p, send.template, dates, gig_context, variants))
+        send_messages_async(emails)
+        DigestEntry.objects.bulk_create(held)
+
+        chunk.sent = timezone.now()
+        chunk.save(update_fields=['sent'])
+        NotificationSend.objects.filter(id=send.id).update(sent=F('sent') + len(chunk.plans))
+
+DIGEST_TEMPLATES = ['email/new_gig.md', 'email/edited_gig.md']
+
+def wants_digest(plan, template):
+    """ news about a gig can wait for a digest if the member or their band asked for one. Reminders can't. """
+    return template in DIGEST_TEMPLATES and (plan.assoc.band.notification_digest or
+                                             plan.assoc.member.preferences.notification_digest)
+
+def digest_email(member, entries):
+    """ one email about all the gigs in the entries. Each gig gets the body of the email it would have
+        had on its own; a gig that was added and then edited is just new, and an edited gig lists
+        everything that changed since the first edit. """
+    gig_entries = {}
+    for e in entries:
+        gig_entries.setdefault(e.plan.gig_id, []).append(e)
+
+    recipient = member.as_email_recipient()
+    items = []
+    for held in sorted(gig_entries.values(), key=lambda es: es[0].plan.gig.date):
+        plan = held[-1].plan
+        gig = plan.gig
+        if any(e.template == 'email/new_gig.md' for e in held):
+            template = 'email/new_gig.md'
+            gig_context = gig_email_context(gig)
+        else:
+            template = 'email/edited_gig.md'
+            previous_ids = [e.previous for e in held if e.previous]
+            previous = gig.history.filter(history_id=min(previous_ids)).first() if previous_ids else None
+            gig_context = gig_email_context(gig, previous=previous)
+        context = {
+            **gig_context,
+            'plan': plan,
+            'status': plan.status,
+            'status_label': PlanStatusChoices(plan.status).label,
+            'url_base': URL_BASE,
+            'digest_item': True,
+        }
+        items.append(render_email_part(template, context, recipient.language, gig.band.timezone))
+
+    return prepare_email(recipient, 'email/gig_digest.md', {'items': items})
+
+def send_member_digest(member_id):
+    """ send a member everything held for their digest. The entries are deleted in the same transaction
+        that puts the email in the outbox, so a digest only goes out once. """
+    with transaction.atomic():
+        entries = list(DigestEntry.objects.select_for_update(of=('self',)).filter(member_id=member_id)
+                       .select_related('member', 'member__preferences', 'plan', 'plan__gig', 'plan__gig__band',
+                                       'plan__gig__contact', 'plan__assoc')
+                       .order_by('created'))
+        # news about gigs that have been trashed since just goes away
+        live = [e for e in entries if e.plan.gig.trashed_date is None]
+        if live:
+            send_messages_async([digest_email(live[0].member, live)])
+        DigestEntry.objects.filter(id__in=[e.id for e in entries]).delete()
+
 def send_email_from_gig(gig, template, dates=None, only_answered=False):
     if only_answered:
         plans = gig.member_plans.filter(status__in=[
@@ -240,7 +463,16 @@ def _prepare_plans_for_watcher_email(plans):
         final_data.append([band, giglist])
     return final_data
 
+def watched_plan_changes():
+    """ every changed plan, once for each member watching its gig (or once with no watcher if nobody is),
+        from one query ordered so each watcher's plans come together by band and gig date """
+    return (Plan.objects.filter(status_changed=True)
+            .annotate(watcher_id=F('gig__watchers'))
+            .select_related('gig', 'gig__band', 'assoc__member')
+            .order_by('watcher_id', 'gig__band', 'gig__date', 'gig'))
+
 def send_watcher_email(member, plans):
+    # plans should already be in band, gig date order, as watched_plan_changes gives them.
     # organize the plans for ease of presentation:
     # [
     #     [band, [
@@ -250,8 +482,6 @@ def send_watcher_email(member, plans):
     #     ],
     # ]
 
-    plans = plans.order_by('gig__band','gig__date','gig')
-
     the_data = _prepare_plans_for_watcher_email(plans)
 
     context = {
@@ -0,0 +1,49 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from django.core.management.base import BaseCommand
+from gig.models import Gig, PlanTally
+
+
+class Command(BaseCommand):
+    help = 'Checks the plan tallies against the plans and counts again for any gig that has drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true',
+                            help="don't repair anything, just report the gigs that are wrong")
+
+    def handle(self, *args, **options):
+        wrong = []
+        ids = list(Gig.objects.order_by('id').values_list('id', flat=True))
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            expected = PlanTally.objects.expected(batch)
+            # rows left at zero by plans that moved on don't count as drift
+            found = set(PlanTally.objects.filter(gig__in=batch).exclude(count=0)
+                        .values_list('gig_id', 'section_id', 'status', 'count'))
+            wrong.extend(sorted({t[0] for t in expected ^ found}))
+
+        for gig_id in wrong:
+            self.stdout.write(f'tallies for gig {gig_id} are wrong')
+
+        if wrong and not options['verify_only']:
+            for i in range(0, len(wrong), 500):
+                PlanTally.objects.sync(wrong[i:i + 500])
+            self.stdout.write(self.style.SUCCESS(f'repaired the tallies for {len(wrong)} gigs'))
+        elif wrong:
+            self.stdout.write(self.style.ERROR(f'{len(wrong)} gigs have wrong tallies'))
+        else:
+            self.stdout.write(self.style.SUCCESS('all tallies match'))
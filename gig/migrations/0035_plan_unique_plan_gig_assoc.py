@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:59
+
+from django.db import migrations, models
+from django.db.models import Count
+
+def remove_duplicate_plans(apps, schema_editor):
+    """ keep the most recently updated plan for each gig and member """
+    Plan = apps.get_model('gig', 'Plan')
+    dupes = Plan.objects.values('gig', 'assoc').annotate(n=Count('id')).filter(n__gt=1)
+    for d in dupes:
+        plans = Plan.objects.filter(gig=d['gig'], assoc=d['assoc']).order_by('-last_update')
+        Plan.objects.filter(id__in=[p.id for p in plans[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gig', '0034_alter_gig_safe_date_alter_gig_safe_enddate_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_plans, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='plan',
+            constraint=models.UniqueConstraint(fields=('gig', 'assoc'), name='unique_plan_gig_assoc'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:16
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gig', '0035_plan_unique_plan_gig_assoc'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationSend',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('template', models.CharField(max_length=100)),
+                ('dates', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('total', models.IntegerField(default=0)),
+                ('sent', models.IntegerField(default=0)),
+                ('gig', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_sends', to='gig.gig')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NotificationChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('plans', models.JSONField()),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('send', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='gig.notificationsend')),
+            ],
+        ),
+    ]
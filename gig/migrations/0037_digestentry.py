@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gig', '0036_notificationsend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DigestEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('template', models.CharField(max_length=100)),
+                ('previous', models.IntegerField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='digest_entries', to=settings.AUTH_USER_MODEL)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='digest_entries', to='gig.plan')),
+            ],
+        ),
+    ]
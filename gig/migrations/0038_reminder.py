@@ -0,0 +1,72 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:27
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+from datetime import timedelta
+import pytz
+
+
+def file_reminders(apps, schema_editor):
+    """ file reminders for the plans that are already snoozed and the upcoming RSVP deadlines """
+    Reminder = apps.get_model('gig', 'Reminder')
+    Plan = apps.get_model('gig', 'Plan')
+    Gig = apps.get_model('gig', 'Gig')
+
+    def _reminder(kind, due, **kw):
+        bucket = due.astimezone(pytz.utc).replace(minute=0, second=0, microsecond=0)
+        return Reminder(kind=kind, due=due, bucket=bucket, **kw)
+
+    reminders = [_reminder(0, p.snooze_until, plan_id=p.id)
+                 for p in Plan.objects.filter(snooze_until__isnull=False).only('id', 'snooze_until')]
+    reminders += [_reminder(1, g.rsvp_by_date - timedelta(hours=settings.RSVP_REMINDER_HOURS), gig_id=g.id)
+                  for g in Gig.objects.filter(rsvp_by_date__gt=timezone.now(), is_archived=False).only('id', 'rsvp_by_date')]
+    Reminder.objects.bulk_create(reminders, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gig', '0037_digestentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reminder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.IntegerField(choices=[(0, 'Snooze'), (1, 'RSVP Deadline')])),
+                ('due', models.DateTimeField()),
+                ('bucket', models.DateTimeField()),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='plan',
+            index=models.Index(condition=models.Q(('snooze_until__isnull', False)), fields=['snooze_until'], name='plan_snoozed'),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='gig',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='gig.gig'),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='plan',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='gig.plan'),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(condition=models.Q(('sent__isnull', True)), fields=['bucket'], name='reminder_unsent_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='reminder',
+            constraint=models.UniqueConstraint(fields=('kind', 'plan'), name='unique_reminder_plan'),
+        ),
+        migrations.AddConstraint(
+            model_name='reminder',
+            constraint=models.UniqueConstraint(fields=('kind', 'gig'), name='unique_reminder_gig'),
+        ),
+        migrations.RunPython(file_reminders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gig', '0038_reminder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GigSnapshot',
+            fields=[
+                ('gig', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='gig.gig')),
+                ('data', models.JSONField()),
+                ('created', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
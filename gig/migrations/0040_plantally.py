@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:34
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+from band.util import AssocStatusChoices
+from member.util import MemberStatusChoices
+
+
+def fill_tallies(apps, schema_editor):
+    Plan = apps.get_model('gig', 'Plan')
+    PlanTally = apps.get_model('gig', 'PlanTally')
+    plans = Plan.objects.filter(Q(gig__is_archived=True) |
+                                Q(assoc__member__status=MemberStatusChoices.ACTIVE,
+                                  assoc__status=AssocStatusChoices.CONFIRMED))
+    rows = plans.values('gig_id', 'section_id', 'status').annotate(count=Count('id')).order_by()
+    PlanTally.objects.bulk_create([PlanTally(**r) for r in rows.iterator()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0030_band_notification_digest'),
+        ('gig', '0039_gigsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanTally',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(0, 'No Plan'), (1, 'Definitely'), (2, 'Probably'), (3, "Don't Know"), (4, 'Probably Not'), (5, "Can't Do It"), (6, 'Not Interested')])),
+                ('count', models.IntegerField(default=0)),
+                ('gig', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tallies', to='gig.gig')),
+                ('section', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='band.section')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='plantally',
+            constraint=models.UniqueConstraint(fields=('gig', 'section', 'status'), name='unique_tally_gig_section_status'),
+        ),
+        migrations.RunPython(fill_tallies, migrations.RunPython.noop),
+    ]
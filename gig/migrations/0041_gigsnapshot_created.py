@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gig', '0040_plantally'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='gigsnapshot',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+    ]
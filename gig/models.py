@@ -17,15 +17,21 @@
 import pytz
 import uuid
 from datetime import timedelta, datetime
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from collections import Counter
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q, Sum
+from django.dispatch import Signal
 from django.utils.translation import gettext_lazy as _
 from simple_history.models import HistoricalRecords
-from band.models import Band, Assoc
+from band.models import Band, Assoc, Section
 from band.util import AssocStatusChoices
-from .util import GigStatusChoices, PlanStatusChoices
+from .util import GigStatusChoices, PlanStatusChoices, ReminderKindChoices
 from member.util import MemberStatusChoices
+from lib.tasks import async_task_on_commit
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 
 class GigsManager(models.Manager):
@@ -39,16 +45,24 @@ class GigsManager(models.Manager):
         return self.active().filter(is_archived = False)
 
 
+def unfinished_gig_q(prefix='gig__'):
+    """ Q for gigs that haven't ended yet. The prefix is the path to the gig's date, enddate and
+        is_full_day fields, so this can be used on anything that carries a copy of them. """
+    time_for_user = timezone.now()
+    recent_for_user = time_for_user - timedelta(hours=4) # for gigs with no end date
+    yesterday_for_user = time_for_user.replace(hour=23, minute=59) - timedelta(days=1)
+
+    return ((Q(**{f'{prefix}is_full_day': True}) & Q(**{f'{prefix}date__gte': yesterday_for_user})) |
+            (Q(**{f'{prefix}enddate': None}) & Q(**{f'{prefix}date__gte': recent_for_user})) |
+            Q(**{f'{prefix}enddate__gt': time_for_user}))
+
+
 class MemberPlanManager(models.Manager):
     def all(self):
         """ override the default all to order by section """
         return super().order_by('section')
 
     def future_plans(self, member):
-        time_for_user = timezone.now()
-        recent_for_user = time_for_user - timedelta(hours=4) # for gigs with no end date
-        yesterday_for_user = time_for_user.replace(hour=23, minute=59) - timedelta(days=1)
-
         # find plans that are for this member that are not trashed or archived
         possible = super().get_queryset().filter(assoc__member=member,
                                                  assoc__status=AssocStatusChoices.CONFIRMED,
@@ -56,14 +70,62 @@ class MemberPlanManager(models.Manager):
                                                  gig__is_archived=False,
                                                 )
         # find plans for gigs that haven't ended yet
-        possible = possible.filter((Q(gig__is_full_day=True) & Q(gig__date__gte=yesterday_for_user)) |
-                                   (Q(gig__enddate=None) & Q(gig__date__gte=recent_for_user)) |
-                                   Q(gig__enddate__gt=time_for_user))
+        possible = possible.filter(unfinished_gig_q())
 
         possible = possible.order_by('gig__date')
 
         return possible
 
+    def future_noplans(self, member):
+        """ the plans the member still needs to answer, straight from the plans. The agenda uses the
+            member's inbox instead; this is what the inbox is checked against. """
+        plans = self.future_plans(member).filter(status=PlanStatusChoices.NO_PLAN)
+        plans = plans.exclude(gig__status=GigStatusChoices.CANCELED)
+        plans = plans.exclude(assoc__hide_from_schedule=True)
+        plans = plans.exclude(Q(assoc__is_occasional=True) & Q(gig__invite_occasionals=False))
+        return plans
+
+# sent after Plan.objects.provision has made plans, since bulk_create doesn't send post_save
+plans_provisioned = Signal()
+
+
+class PlanManager(models.Manager):
+    def provision(self, gigs, assocs=None):
+        """ make sure every active, confirmed member has a plan for each of the gigs - or just the given
+            assocs, if there are any. Archived gigs are left alone. The missing plans are made with one
+            bulk insert, and the unique constraint on (gig, assoc) means calling this again, or at the same
+            time from somewhere else, never makes a second plan. """
+        gigs = [g for g in gigs if not g.is_archived]
+        if not gigs:
+            return
+
+        bands = {g.band_id for g in gigs}
+        candidates = Assoc.objects.filter(band__in=bands,
+                                          member__status=MemberStatusChoices.ACTIVE,
+                                          status=AssocStatusChoices.CONFIRMED)
+        if assocs is not None:
+            candidates = candidates.filter(id__in=[a.id for a in assocs])
+        band_assocs = {}
+        for assoc_id, band_id, section_id in candidates.values_list('id', 'band_id', 'default_section_id'):
+            band_assocs.setdefault(band_id, []).append((assoc_id, section_id))
+        if not band_assocs:
+            return
+
+        # new plans start out in the member's default section, or the band's if they don't have one -
+        # the same thing the pre_save signal does one plan at a time
+        default_sections = dict(Section.objects.filter(band__in=bands, is_default=True)
+                                .values_list('band_id', 'id'))
+        existing = set(self.filter(gig__in=gigs, assoc__band__in=bands).values_list('gig_id', 'assoc_id'))
+
+        new_plans = [Plan(gig_id=g.id, assoc_id=assoc_id, section_id=section_id or default_sections.get(g.band_id))
+                     for g in gigs
+                     for assoc_id, section_id in band_assocs.get(g.band_id, [])
+                     if (g.id, assoc_id) not in existing]
+        if new_plans:
+            self.bulk_create(new_plans, batch_size=500, ignore_conflicts=True)
+            plans_provisioned.send(sender=Plan, gigs=gigs, assocs=assocs)
+
+
 class Plan(models.Model):
     """ Models a gig-o-matic plan """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -106,9 +168,18 @@ class Plan(models.Model):
     last_update = models.DateTimeField(auto_now=True)
     snooze_until = models.DateTimeField(null=True, blank=True)
 
-    objects = models.Manager()
+    objects = PlanManager()
     member_plans = MemberPlanManager()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gig', 'assoc'], name='unique_plan_gig_assoc'),
+        ]
+        indexes = [
+            # the reminder reconcile looks for snoozed plans
+            models.Index(fields=['snooze_until'], condition=Q(snooze_until__isnull=False), name='plan_snoozed'),
+        ]
+
     def __str__(self):
         return '{0} for {1} ({2})'.format(self.assoc.member.display_name, self.gig.title, PlanStatusChoices(self.status).label)
 
@@ -216,21 +287,8 @@ class Gig(AbstractEvent):
 
     @property
     def member_plans(self):
-        """ if this gig is not archived, find any members that don't have plans yet. This is called whenever a new gig is created
-            through the signaling system, or when a member joins a band from the assoc signal. """
-        if self.is_archived is False:
-            absent = self.band.assocs.exclude(id__in = self.plans.values_list('assoc',flat=True)) \
-                .filter(member__status = MemberStatusChoices.ACTIVE) \
-                .filter(status = AssocStatusChoices.CONFIRMED)
-            # Plan.objects.bulk_create(
-            #     [Pn(glaig=self, assoc=a, section=a.band.sections.get(is_default=True)) for a in absent]
-            # )
-            # can't use bulk_create because it doesn't send signals
-            # TODO is there a more efficient way?
-            s = self.band.sections.get(is_default=True)
-            for a in absent:
-                Plan.objects.create(gig=self, assoc=a, section=s)
-
+        """ the plans for this gig. Plans are made by Plan.objects.provision when the gig is created or a
+            member joins the band, so this just reads them. """
         # if this is an archived gig, return all the plans, otherwise just those for active members
         plans = self.plans # pylint: disable=no-member
         if self.is_archived:
@@ -238,12 +296,248 @@ class Gig(AbstractEvent):
         else:
             return plans.filter(assoc__member__status=MemberStatusChoices.ACTIVE).filter(assoc__status=AssocStatusChoices.CONFIRMED)
 
+    @property
+    def plan_counts(self):
+        """ how many member plans there are of each status, from the tallies rather than the plans """
+        counts = Counter()
+        for t in self.tallies.all():
+            if t.count:
+                counts[t.status] += t.count
+        return counts
+
+    @property
+    def section_plan_counts(self):
+        """ plan_counts for each section, by section id """
+        counts = {}
+        for t in self.tallies.all():
+            if t.count:
+                counts.setdefault(t.section_id, Counter())[t.status] += t.count
+        return counts
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse("gig-detail", kwargs={"pk": self.pk})
 
+class GigSnapshot(models.Model):
+    """ What an archived gig's page shows, taken when the gig is archived: the roster with each member's
+        plan, the plan tallies and the rendered text fields. Archived gigs don't change, so their pages
+        and the archive spreadsheet are made from this instead of the plans. """
+    gig = models.OneToOneField("Gig", primary_key=True, related_name="snapshot", on_delete=models.CASCADE)
+    data = models.JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class PlanTallyManager(models.Manager):
+    """ a plan save moves one count from its old (section, status) row to its new one; sync counts whole
+        gigs again, for the changes that decide which plans a gig counts at all """
+
+    @staticmethod
+    def _counted(plans):
+        """ the plans a gig's member_plans would return """
+        return plans.filter(Q(gig__is_archived=True) |
+                            Q(assoc__member__status=MemberStatusChoices.ACTIVE,
+                              assoc__status=AssocStatusChoices.CONFIRMED))
+
+    def _add(self, gig_id, section_id, status, n):
+        tally = self.filter(gig_id=gig_id, section_id=section_id, status=status)
+        if tally.update(count=F('count') + n) or n < 0:
+            return
+        try:
+            with transaction.atomic():
+                self.create(gig_id=gig_id, section_id=section_id, status=status, count=n)
+        except IntegrityError:
+            # another answer to the same gig made the row first
+            tally.update(count=F('count') + n)
+
+    def move(self, gig_id, assoc_id, old, new):
+        """ count a plan under its new (section, status) instead of its old one. Either is None for a plan
+            that's just been made or deleted. """
+        if old == new:
+            return
+        counted = Gig.objects.filter(Q(is_archived=True) |
+                                     Q(band__assocs=assoc_id, band__assocs__status=AssocStatusChoices.CONFIRMED,
+                                       band__assocs__member__status=MemberStatusChoices.ACTIVE), id=gig_id)
+        if not counted.exists():
+            return
+        changes = [(key, -1) for key in [old] if key] + [(key, 1) for key in [new] if key]
+        with transaction.atomic():
+            # always touch the rows in the same order, so two answers to one gig can't deadlock
+            for (section_id, status), n in sorted(changes, key=lambda c: (c[0][0] or 0, c[0][1])):
+                self._add(gig_id, section_id, status, n)
+
+    def sync(self, gigs):
+        """ count the plans again for a list or queryset of gigs (or their ids) """
+        with transaction.atomic():
+            # lock the gigs first, so two counts of the same gig run one after the other. Otherwise the
+            # second delete can miss the rows the first one is inserting and its insert breaks the constraint.
+            list(Gig.objects.filter(id__in=gigs).order_by('id').select_for_update().values_list('id', flat=True))
+            self.filter(gig__in=gigs).delete()
+            rows = self._counted(Plan.objects.filter(gig__in=gigs)) \
+                .values('gig_id', 'section_id', 'status').annotate(count=Count('id')).order_by()
+            self.bulk_create([PlanTally(**r) for r in rows.iterator()], batch_size=500)
+
+    def attending(self, gigs):
+        """ how many members are definitely or probably going to each gig, by gig id """
+        rows = self.filter(gig__in=gigs, status__in=[PlanStatusChoices.DEFINITELY, PlanStatusChoices.PROBABLY]) \
+            .values('gig_id').annotate(total=Sum('count')).order_by()
+        return {r['gig_id']: r['total'] for r in rows}
+
+    def expected(self, gigs):
+        """ what the tallies for these gigs should be, as a set of (gig, section, status, count) """
+        rows = self._counted(Plan.objects.filter(gig__in=gigs)) \
+            .values_list('gig_id', 'section_id', 'status').annotate(count=Count('id')).order_by()
+        return set(rows)
+
+
+class PlanTally(models.Model):
+    """
+    How many of a gig's member plans have each status, for each section. This lets pages and the API show
+    how many people are coming without loading the plans. A row whose plans have all moved on stays
+    behind with a count of zero.
+    """
+    gig = models.ForeignKey("Gig", related_name="tallies", on_delete=models.CASCADE)
+    section = models.ForeignKey("band.Section", null=True, blank=True, related_name="+", on_delete=models.CASCADE)
+    status = models.IntegerField(choices=PlanStatusChoices.choices)
+    count = models.IntegerField(default=0)
+
+    objects = PlanTallyManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gig', 'section', 'status'], name='unique_tally_gig_section_status'),
+        ]
+
+
 class GigComment(models.Model):
     gig = models.ForeignKey("Gig", related_name="comments", on_delete=models.CASCADE)
     member = models.ForeignKey("member.Member", verbose_name="member", related_name="comments", on_delete=models.CASCADE)
     text = models.TextField(null=True, blank=True)
     created_date = models.DateTimeField(auto_now_add=True)
+
+
+class NotificationSendManager(models.Manager):
+    def start(self, gig_id, template, plan_ids, dates=None):
+        """ split the plans into chunks and queue a task to send each one """
+        size = settings.NOTIFICATION_CHUNK_SIZE
+        send = self.create(gig_id=gig_id, template=template, dates=dates, total=len(plan_ids))
+        chunks = NotificationChunk.objects.bulk_create(
+            NotificationChunk(send=send, plans=plan_ids[i:i + size]) for i in range(0, len(plan_ids), size))
+        for chunk in chunks:
+            async_task_on_commit('gig.helpers.send_notification_chunk', chunk.id, ack_failure=True)
+        return send
+
+
+class NotificationSend(models.Model):
+    """ A notification email going out to the members of a gig. The recipients are split into chunks which
+        are sent by separate tasks, so a big band doesn't tie up a worker and a failure only has to redo
+        the chunks that didn't go out. """
+    gig = models.ForeignKey("Gig", related_name="notification_sends", on_delete=models.CASCADE)
+    template = models.CharField(max_length=100)
+    dates = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created = models.DateTimeField(auto_now_add=True)
+    total = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+
+    objects = NotificationSendManager()
+
+    def __str__(self):
+        return '{0} for {1} ({2}/{3})'.format(self.template, self.gig.title, self.sent, self.total)
+
+    @property
+    def is_finished(self):
+        return self.sent >= self.total
+
+    def get_dates(self):
+        return [parse_datetime(d) for d in self.dates] if self.dates else None
+
+    def resume(self):
+        """ queue the chunks that haven't been sent again """
+        for chunk_id in self.chunks.filter(sent__isnull=True).values_list('id', flat=True):
+            async_task_on_commit('gig.helpers.send_notification_chunk', chunk_id, ack_failure=True)
+
+
+class NotificationChunk(models.Model):
+    send = models.ForeignKey("NotificationSend", related_name="chunks", on_delete=models.CASCADE)
+    plans = models.JSONField()
+    sent = models.DateTimeField(null=True, blank=True)
+
+
+class DigestEntry(models.Model):
+    """ A gig notification held back for a member who gets digests. For an edit, previous is the history
+        record the gig was changed from, so the digest can list everything that changed since. """
+    member = models.ForeignKey("member.Member", related_name="digest_entries", on_delete=models.CASCADE)
+    plan = models.ForeignKey("Plan", related_name="digest_entries", on_delete=models.CASCADE)
+    template = models.CharField(max_length=100)
+    previous = models.IntegerField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+def reminder_bucket(due):
+    """ the hour a reminder is filed under """
+    return due.astimezone(pytz.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def rsvp_reminder_due(gig):
+    return gig.rsvp_by_date - timedelta(hours=settings.RSVP_REMINDER_HOURS)
+
+
+class ReminderManager(models.Manager):
+    def schedule(self, kind, due, plan=None, gig=None):
+        """ file a reminder, or move it if it was due at another time. A reminder that's already gone out
+            isn't sent again unless its time changes. """
+        reminder, created = self.get_or_create(kind=kind, plan=plan, gig=gig,
+                                               defaults={'due': due, 'bucket': reminder_bucket(due)})
+        if not created and reminder.due != due:
+            reminder.due = due
+            reminder.bucket = reminder_bucket(due)
+            reminder.sent = None
+            reminder.save()
+        return reminder
+
+    def due_now(self):
+        """ the unsent reminders that are due. Only the buckets up to this hour are looked at. """
+        now = timezone.now()
+        return self.filter(sent__isnull=True, bucket__lte=reminder_bucket(now), due__lte=now)
+
+    def reconcile(self):
+        """ Make sure there's a reminder for every snoozed plan and upcoming RSVP deadline, for anything
+            that was changed without going through save. Also throws away reminders sent long ago. """
+        now = timezone.now()
+        self.filter(sent__lt=now - timedelta(days=30)).delete()
+
+        wanted = [(ReminderKindChoices.SNOOZE, plan_id, None, due) for plan_id, due in
+                  Plan.objects.filter(snooze_until__isnull=False).values_list('id', 'snooze_until')]
+        wanted += [(ReminderKindChoices.RSVP, None, gig.id, rsvp_reminder_due(gig)) for gig in
+                   Gig.objects.filter(rsvp_by_date__gt=now, is_archived=False, trashed_date__isnull=True)
+                   .only('id', 'rsvp_by_date')]
+        have = {(r.kind, r.plan_id, r.gig_id): r for r in
+                self.filter(Q(plan__snooze_until__isnull=False) | Q(gig__rsvp_by_date__gt=now))}
+        for kind, plan_id, gig_id, due in wanted:
+            reminder = have.get((kind, plan_id, gig_id))
+            if reminder is None or reminder.due != due:
+                self.schedule(kind, due, plan=Plan(id=plan_id) if plan_id else None,
+                              gig=Gig(id=gig_id) if gig_id else None)
+
+
+class Reminder(models.Model):
+    """ A reminder email waiting to go out: either for a plan that was snoozed, or for the members
+        who haven't answered a gig with an RSVP deadline. Reminders are filed under the hour they're due
+        so the scheduler only has to look at the hours that have come up. """
+    kind = models.IntegerField(choices=ReminderKindChoices.choices)
+    plan = models.ForeignKey("Plan", null=True, blank=True, related_name="reminders", on_delete=models.CASCADE)
+    gig = models.ForeignKey("Gig", null=True, blank=True, related_name="reminders", on_delete=models.CASCADE)
+    due = models.DateTimeField()
+    bucket = models.DateTimeField()
+    sent = models.DateTimeField(null=True, blank=True)
+
+    objects = ReminderManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'plan'], name='unique_reminder_plan'),
+            models.UniqueConstraint(fields=['kind', 'gig'], name='unique_reminder_gig'),
+        ]
+        indexes = [
+            models.Index(fields=['bucket'], condition=Q(sent__isnull=True), name='reminder_unsent_bucket'),
+        ]
+
@@ -14,19 +14,26 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from .models import Gig, Plan
-from .util import PlanStatusChoices
-from gig.helpers import send_emails_from_plans
-from band.helpers import set_calfeeds_dirty
+from .models import Gig, Plan, GigSnapshot, PlanTally, Reminder, rsvp_reminder_due, plans_provisioned
+from .util import PlanStatusChoices, ReminderKindChoices
+from gig.helpers import send_emails_from_plans, snapshot_gigs
+from band.models import Assoc, Band
+from member.models import Member
+from band.helpers import set_calfeeds_dirty, set_calendar_changed
 from django_q.tasks import async_task
 
+@receiver(pre_save, sender=Gig)
+def remember_old_gig(sender, instance, **kwargs):
+    """ load the gig as it was before this save, once for all the receivers that only act on what changed """
+    instance._old = Gig.objects.filter(pk=instance.pk).first() if instance.pk else None
+
 @receiver(post_save, sender=Gig)
 def create_member_plans(sender, instance, created, **kwargs):
     """ makes sure every member has a plan set for a newly created gig """
     if created:
-        _ = instance.member_plans
+        Plan.objects.provision([instance])
 
 
 @receiver(post_save, sender=Gig)
@@ -34,6 +41,35 @@ def set_calfeed_dirty(sender, instance, created, **kwargs):
     async_task('band.helpers.set_calfeeds_dirty', instance.band)
 
 
+@receiver(post_save, sender=Gig)
+def set_gig_calendar_changed(sender, instance, **kwargs):
+    set_calendar_changed(instance.band_id)
+
+
+_COMMITTED = (PlanStatusChoices.DEFINITELY, PlanStatusChoices.PROBABLY)
+
+@receiver(pre_save, sender=Plan)
+def remember_plan_status(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None:
+        instance._old_status, instance._old_section_id = None, None
+    elif update_fields is not None and not {'status', 'section'} & set(update_fields):
+        instance._old_status, instance._old_section_id = instance.status, instance.section_id
+    else:
+        instance._old_status, instance._old_section_id = \
+            Plan.objects.filter(pk=instance.pk).values_list('status', 'section_id').first() or (None, None)
+
+@receiver(post_save, sender=Plan)
+def set_plan_calendar_changed(sender, instance, created, **kwargs):
+    # plans only matter to members whose calendars just show gigs they can do, and only when the answer
+    # moves in or out of that. New plans come from a gig or assoc save, which takes care of it.
+    if created or (getattr(instance, '_old_status', None) in _COMMITTED) == (instance.status in _COMMITTED):
+        return
+    band_id = Assoc.objects.filter(id=instance.assoc_id, member__preferences__calendar_show_only_committed=True) \
+        .values_list('band_id', flat=True).first()
+    if band_id is not None:
+        set_calendar_changed(band_id)
+
+
 @receiver(pre_save, sender=Plan)
 def update_plan_section(sender, instance, **kwargs):
     """ set the section to the plan_section, unless there isn't one - in that case use the member's default """
@@ -42,3 +78,77 @@ def update_plan_section(sender, instance, **kwargs):
     # if our answer changes from DONT_KNOW to anything, make sure we don't have a snooze reminder set
     if instance.status not in (PlanStatusChoices.NO_PLAN, PlanStatusChoices.DONT_KNOW):
         instance.snooze_until = None
+
+
+@receiver(post_save, sender=Plan)
+def schedule_snooze_reminder(sender, instance, **kwargs):
+    # a reminder for a plan that's been answered since is dropped when it comes up, so answering
+    # doesn't cost anything here
+    if instance.snooze_until:
+        Reminder.objects.schedule(ReminderKindChoices.SNOOZE, instance.snooze_until, plan=instance)
+
+
+@receiver(post_save, sender=Gig)
+def schedule_rsvp_reminder(sender, instance, **kwargs):
+    if instance.rsvp_by_date and not instance.is_archived:
+        Reminder.objects.schedule(ReminderKindChoices.RSVP, rsvp_reminder_due(instance), gig=instance)
+
+
+
+@receiver(post_save, sender=Gig)
+def update_archive_snapshot(sender, instance, created, **kwargs):
+    """ archived gigs are shown from a snapshot, so take one when a gig is archived and drop it if it's
+        brought back """
+    old = getattr(instance, '_old', None)
+    if (old.is_archived if old else None) == instance.is_archived:
+        return
+    if instance.is_archived:
+        snapshot_gigs([instance.id])
+    elif not created:
+        GigSnapshot.objects.filter(gig=instance).delete()
+
+
+# keep the plan tallies current
+@receiver(post_save, sender=Plan)
+def update_tally_for_plan(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not {'status', 'section'} & update_fields:
+        return
+    old = None if created or instance._old_status is None else (instance._old_section_id, instance._old_status)
+    PlanTally.objects.move(instance.gig_id, instance.assoc_id, old, (instance.section_id, instance.status))
+
+@receiver(post_delete, sender=Plan)
+def update_tally_after_plan_delete(sender, instance, origin=None, **kwargs):
+    # if the whole gig is going, its tallies are going with it. The origin is a queryset for bulk deletes.
+    if not issubclass(getattr(origin, 'model', type(origin)), (Gig, Band)):
+        PlanTally.objects.move(instance.gig_id, instance.assoc_id, (instance.section_id, instance.status), None)
+
+@receiver(post_save, sender=Gig)
+def update_tally_for_gig(sender, instance, created, **kwargs):
+    # archived gigs count everyone's plans, not just the current members', so archiving or bringing a gig
+    # back changes what counts. A new gig's plans are counted when they're provisioned.
+    old = getattr(instance, '_old', None)
+    if old and old.is_archived != instance.is_archived:
+        PlanTally.objects.sync([instance.id])
+
+@receiver(pre_save, sender=Assoc)
+def remember_old_assoc(sender, instance, **kwargs):
+    """ load the assoc as it was before this save, for the receivers that only act on what changed """
+    instance._old = Assoc.objects.filter(pk=instance.pk).first() if instance.pk else None
+
+@receiver(post_save, sender=Assoc)
+def update_tally_for_assoc(sender, instance, created, **kwargs):
+    # only confirmed members' plans count. Plans moving to a new default section are counted by
+    # update_plan_default_section.
+    old = getattr(instance, '_old', None)
+    if old and old.status != instance.status:
+        PlanTally.objects.sync(Gig.objects.filter(plans__assoc=instance, is_archived=False))
+
+@receiver(post_save, sender=Member)
+def update_tally_for_member(sender, instance, created, **kwargs):
+    # only active members' plans count
+    if not created and getattr(instance, '_old_status', None) != instance.status:
+        PlanTally.objects.sync(Gig.objects.filter(plans__assoc__member=instance, is_archived=False))
+
+@receiver(plans_provisioned)
+def update_tally_for_new_plans(sender, gigs, **kwargs):
+    PlanTally.objects.sync([g.id for g in gigs])
@@ -14,13 +14,24 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from gig.models import Gig, Plan
-from gig.helpers import send_emails_from_plans, send_watcher_email
-from member.models import Member
+from gig.models import Gig, Plan, NotificationSend, DigestEntry, PlanTally, Reminder, rsvp_reminder_due
+from gig.util import GigStatusChoices, PlanStatusChoices, ReminderKindChoices
+from gig.helpers import send_emails_from_plans, send_watcher_email, send_member_digest, watched_plan_changes, \
+    snapshot_gigs
+from member.models import Member, InboxEntry
+from band.models import Band
+from band.helpers import set_calendar_changed
+from django.db import transaction
+from django_q.tasks import async_task
 from django.utils import timezone
-from datetime import timedelta, datetime
-from django.db.models import Q
-import pytz
+from datetime import timedelta
+from django.db.models import F, Q
+from django.conf import settings
+from itertools import groupby
+from operator import attrgetter
+
+SEEN_BATCH_SIZE = 500
+ARCHIVE_BATCH_SIZE = 500
 
 def delete_old_trashed_gigs():
     """
@@ -47,49 +58,121 @@ def archive_old_gigs():
         (~Q(enddate=None) & Q(enddate__lt=archive_date)),
         is_archived=False)
 
-    num = over_gigs.count()
-    for g in over_gigs:
-        g.is_archived=True
-        g.watchers.clear()
-        g.save()
+    gig_ids = list(over_gigs.values_list('id', flat=True))
+    band_ids = set()
+    for i in range(0, len(gig_ids), ARCHIVE_BATCH_SIZE):
+        band_ids.update(archive_gigs(gig_ids[i:i + ARCHIVE_BATCH_SIZE]))
+
+    # archiving doesn't go through save, so do what the gig save signals would have - once per band
+    for band in Band.objects.filter(id__in=band_ids):
+        async_task('band.helpers.set_calfeeds_dirty', band)
+        set_calendar_changed(band.id)
+
+    return f'archived {len(gig_ids)} gigs'
+
+def archive_gigs(gig_ids):
+    """ archive a batch of gigs with one update, clear their watchers and inbox entries and write their
+        history records, snapshots and tallies in bulk. Returns the ids of the bands they belong to. """
+    with transaction.atomic():
+        gigs = list(Gig.objects.filter(id__in=gig_ids, is_archived=False))
+        ids = [g.id for g in gigs]
+        Gig.objects.filter(id__in=ids).update(is_archived=True)
+        Gig.watchers.through.objects.filter(gig_id__in=ids).delete()
+        InboxEntry.objects.filter(plan__gig_id__in=ids).delete()
+        for g in gigs:
+            g.is_archived = True
+        Gig.history.bulk_history_create(gigs, update=True) # pylint: disable=no-member
+        snapshot_gigs(ids)
+        PlanTally.objects.sync(ids)
+    return {g.band_id for g in gigs}
+
+def send_due_reminders():
+    """
+    Send the snooze and RSVP reminders that have come due. This runs every few minutes and only looks
+    at the hour buckets that have come up. The reminders are marked sent in the same transaction that
+    queues their emails, so if we stop part way the next run just picks them up again.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(Reminder.objects.due_now().select_for_update(skip_locked=True, of=('self',))
+                   .select_related('plan', 'gig'))
+        if not due:
+            return 'sent 0 reminders'
+        Reminder.objects.filter(id__in=[r.id for r in due]).update(sent=now)
+
+        # a plan that's been answered or snoozed again since doesn't get this one
+        snoozed = [r.plan_id for r in due if r.kind == ReminderKindChoices.SNOOZE and r.plan.snooze_until == r.due]
+        send_emails_from_plans(Plan.objects.filter(id__in=snoozed, gig__date__gt=now), 'email/gig_reminder.md')
+        Plan.objects.filter(id__in=snoozed).update(snooze_until=None)
+
+        for r in due:
+            gig = r.gig
+            if (r.kind == ReminderKindChoices.RSVP and gig.rsvp_by_date and gig.rsvp_by_date > now
+                    and rsvp_reminder_due(gig) == r.due and not gig.is_archived and gig.trashed_date is None
+                    and gig.status != GigStatusChoices.CANCELED):
+                undecided = gig.member_plans.filter(status__in=(PlanStatusChoices.NO_PLAN, PlanStatusChoices.DONT_KNOW))
+                send_emails_from_plans(undecided, 'email/gig_rsvp_reminder.md')
 
-    return f'archived {num} gigs'
+    return f'sent {len(due)} reminders'
 
 def send_snooze_reminders():
     """
-    Send a reminder for all plans with a snooze_until in the next day and a gig
-    date in the future.  Set the snooze_until property of all such plans to None,
-    to so we don't send another reminder in the future.
+    Daily sweep: file reminders for snoozed plans and RSVP deadlines that the save signals didn't see,
+    then send whatever is due. Most reminders go out from send_due_reminders well before this runs.
     """
-    now = datetime.now(tz=pytz.utc)
-    next_day = now + timedelta(days=1)
-    unsnooze = Plan.objects.filter(snooze_until__isnull=False,
-                                   snooze_until__lte=next_day,
-                                   gig__date__gt=now)
-    send_emails_from_plans(unsnooze, 'email/gig_reminder.md')
-    unsnooze.update(snooze_until=None)
+    Reminder.objects.reconcile()
+    return send_due_reminders()
+
+
+def resume_notifications():
+    """ queue again the chunks of notification emails that should have gone out by now but haven't """
+    now = timezone.now()
+    started_before = now - timedelta(minutes=settings.NOTIFICATION_RESUME_MINUTES)
+    # after a day the news is stale, so stop trying
+    sends = NotificationSend.objects.filter(created__lt=started_before, created__gt=now - timedelta(days=1),
+                                            sent__lt=F('total'))
+    for send in sends:
+        send.resume()
+    return f'resumed {len(sends)} notifications'
+
+
+def delete_old_notification_sends():
+    """ Delete the records of gig notifications started more than NOTIFICATION_KEEP_DAYS ago, with their
+        chunks. They aren't resumed after a day, so by then they're finished one way or the other. """
+    cutoff = timezone.now() - timedelta(days=settings.NOTIFICATION_KEEP_DAYS)
+    old = NotificationSend.objects.filter(created__lt=cutoff)
+    num = old.count()
+    old.delete()
+    return f'deleted {num} old notifications'
+
+
+def send_digests():
+    """ send the digests whose oldest held notification has waited long enough """
+    cutoff = timezone.now() - timedelta(minutes=settings.NOTIFICATION_DIGEST_MINUTES)
+    members = set(DigestEntry.objects.filter(created__lte=cutoff).values_list('member_id', flat=True))
+    for member_id in members:
+        send_member_digest(member_id)
+    return f'sent {len(members)} digests'
 
 
 def alert_watchers():
     """ alert members who are watching gigs that plans have changed """
+    changes = list(watched_plan_changes())
+    watchers = Member.objects.select_related('preferences').in_bulk({p.watcher_id for p in changes if p.watcher_id})
+    for watcher_id, plans in groupby(changes, key=attrgetter('watcher_id')):
+        if watcher_id in watchers:
+            send_watcher_email(watchers[watcher_id], list(plans))
+
+    mark_plans_seen({p.id: p.status for p in changes})
+
 
-    # first, get all the members who need to be alerted and tell them what's up
-    members = set(Member.objects.filter(watching__isnull=False))
-
-    for m in members:
-        m_plans = Plan.objects.filter(status_changed=True, gig__in=m.watching.all())
-        if m_plans:
-            send_watcher_email(m, m_plans)
-
-    # finally, mark the plans seen.
-    #
-    # 20260619 - this was hanging up and failing - it used to just be...
-    #
-    # Plan.objects.update(status_changed=False)
-    #
-    # ...which I had assumed would just reset everything fine. But at some point
-    # around 20260610 it started to hang up - I guess the database would timeout
-    # trying to update every single plan. Filtering only for changed plans seems
-    # to fix it. But this could fail if there are many many changed plans, I guess
-    # so TODO make sure we do this in batches.
-    Plan.objects.filter(status_changed=True).update(status_changed=False)
+def mark_plans_seen(reported):
+    """ Clear status_changed on the plans we just told people about. Clearing every changed plan in one
+        update hung the database in production, so this goes in batches. It only touches plans whose status
+        is still the one we reported, so a change made while we were sending goes out next time. """
+    by_status = {}
+    for plan_id, status in reported.items():
+        by_status.setdefault(status, []).append(plan_id)
+    for status, ids in by_status.items():
+        for i in range(0, len(ids), SEEN_BATCH_SIZE):
+            Plan.objects.filter(id__in=ids[i:i + SEEN_BATCH_SIZE], status=status).update(status_changed=False)
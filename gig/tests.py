@@ -15,23 +15,34 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from time import sleep
+from io import StringIO
+from collections import Counter
 from django.core import mail
-from django.test import TestCase, Client
-from member.models import Member
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from member.models import Member, InboxEntry
+from member.util import MemberStatusChoices
 from band.models import Band, Section, Assoc
 from band.util import AssocStatusChoices
 from band.helpers import _get_confirmed_public_gigs
 from gig.util import GigStatusChoices, PlanStatusChoices
-from .models import Gig, Plan, GigComment
-from .helpers import send_reminder_email, create_gig_series
+from .models import Gig, Plan, GigComment, NotificationSend, NotificationChunk, DigestEntry, Reminder, GigSnapshot, PlanTally
+from .helpers import send_reminder_email, create_gig_series, build_roster, email_from_plan, send_emails_from_plans, send_notification_chunk
 from .tasks import send_snooze_reminders
-from .tasks import archive_old_gigs, alert_watchers
+from .tasks import archive_old_gigs, alert_watchers, resume_notifications, send_digests, send_due_reminders, \
+    delete_old_notification_sends
 from datetime import timedelta, datetime, timezone as dttimezone
 from django.urls import reverse
+from django.conf import settings
 from django.utils import timezone
 from pytz import utc, timezone as pytimezone
 from lib.template_test import MISSING, flag_missing_vars
 from freezegun import freeze_time
+from unittest import mock
+import lib.email
+import gig.tasks as gig_tasks
 from go3.api import THROTTLE_PER_SECOND
 
 # workaround for freezegun thing where it ignores modules with names
@@ -465,6 +476,36 @@ class GigTest(GigTestBase):
             "Beginn: 12:00\nTermin: 12:30\nEnde: 14:00", message.body)
         self.assertIn("Nicht fixiert", message.body)
 
+    def test_gig_email_rendered_once_per_variant(self):
+        members, assocs = self.add_members(6)
+        for m in members[:3]:
+            m.preferences.language = "de"
+            m.save()
+        g = self.create_gig(self.band_admin)
+        g.title = "Changed title"
+        g.save()
+        for a in assocs[::2]:
+            p = g.plans.get(assoc=a)
+            p.status = PlanStatusChoices.DEFINITELY
+            p.save()
+
+        plans = g.member_plans.filter(assoc__in=assocs)
+        mail.outbox = []
+        with mock.patch("lib.email.render_to_string", wraps=lib.email.render_to_string) as render:
+            send_emails_from_plans(plans, "email/edited_gig.md")
+        # two languages times two statuses
+        self.assertEqual(render.call_count, 4)
+        self.assertEqual(len(mail.outbox), 6)
+
+        # and they're the same as the ones we'd make one at a time
+        for message in mail.outbox:
+            p = next(p for p in plans if message.to[0] == p.assoc.member.as_email_recipient().email_line)
+            expected = email_from_plan(p, "email/edited_gig.md")
+            self.assertEqual(message.subject, expected.subject)
+            self.assertEqual(message.body, expected.body)
+            self.assertEqual(message.alternatives, expected.alternatives)
+            self.assertIn(str(p.id), message.body)
+
 
     @flag_missing_vars
     def test_reminder_email(self):
@@ -1278,6 +1319,549 @@ class GigTest(GigTestBase):
         self.assertEqual(g.enddate.day,2)
 
 
+class PlanProvisionTest(GigTestBase):
+    def test_gig_plans_made_in_bulk(self):
+        def _count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                g = self.create_gig(self.band_admin)
+            self.assertEqual(g.plans.count(), Assoc.objects.filter(band=self.band).count())
+            return len([q for q in ctx.captured_queries if q['sql'].startswith('INSERT') and 'INTO "gig_plan"' in q['sql']])
+
+        self.add_members(2)
+        self.assertEqual(_count_queries(), 1)
+        self.add_members(10)
+        self.assertEqual(_count_queries(), 1)
+
+    def test_provision_is_idempotent(self):
+        a = self.assoc_user(self.joeuser)
+        g = self.create_gig(self.band_admin)
+        Plan.objects.provision([g])
+        Plan.objects.provision([g], assocs=[a])
+        self.assertEqual(g.plans.filter(assoc=a).count(), 1)
+
+        # reading the plans doesn't make any
+        g.plans.filter(assoc=a).delete()
+        self.assertEqual(g.member_plans.filter(assoc=a).count(), 0)
+        Plan.objects.provision([g])
+        self.assertEqual(g.member_plans.filter(assoc=a).count(), 1)
+
+    def test_provision_sections(self):
+        s = Section.objects.create(name="s1", band=self.band)
+        a = self.assoc_user(self.joeuser)
+        a.default_section = s
+        a.save()
+        jane = self.assoc_user(self.janeuser)
+        g = self.create_gig(self.band_admin)
+        self.assertEqual(g.plans.get(assoc=a).section, s)
+        self.assertEqual(g.plans.get(assoc=jane).section, self.band.sections.get(is_default=True))
+
+    def test_new_member_gets_plans(self):
+        g1 = self.create_gig(self.band_admin)
+        g2 = self.create_gig(self.band_admin, title="another")
+        a = self.assoc_user(self.joeuser)
+        self.assertEqual(Plan.objects.filter(assoc=a).count(), 2)
+        self.assertEqual(set(self.joeuser.future_noplans.values_list('gig', flat=True)), {g1.id, g2.id})
+
+    def test_returning_member_gets_plans(self):
+        self.joeuser.status = MemberStatusChoices.DORMANT
+        self.joeuser.save()
+        a = self.assoc_user(self.joeuser)
+        g = self.create_gig(self.band_admin)
+        self.assertEqual(g.plans.filter(assoc=a).count(), 0)
+        self.joeuser.status = MemberStatusChoices.ACTIVE
+        self.joeuser.save()
+        self.assertEqual(g.plans.filter(assoc=a).count(), 1)
+
+        # saving an active member for any other reason doesn't go looking for plans to make
+        self.joeuser.nickname = 'joe'
+        with CaptureQueriesContext(connection) as ctx:
+            self.joeuser.save()
+        self.assertFalse([q for q in ctx.captured_queries if 'INSERT INTO "gig_plan"' in q['sql']
+                          or '"gig_gig"' in q['sql']])
+
+
+class RosterTest(GigTestBase):
+    def test_roster_groups_and_counts(self):
+        s1 = Section.objects.create(name="s1", band=self.band)
+        _, assocs = self.add_members(3)
+        g = self.create_gig(self.band_admin)
+        for a, status in zip(assocs, [PlanStatusChoices.DEFINITELY, PlanStatusChoices.DEFINITELY, PlanStatusChoices.CANT_DO_IT]):
+            p = g.plans.get(assoc=a)
+            p.status = status
+            p.plan_section = s1
+            p.save()
+
+        roster = build_roster(g)
+        self.assertEqual([r.section for r in roster.sections], list(self.band.sections.all()))
+        by_section = {r.section: r for r in roster.sections}
+        self.assertEqual([p.assoc for p in by_section[s1].plans], assocs)
+        self.assertEqual(by_section[s1].counts[PlanStatusChoices.DEFINITELY], 2)
+        self.assertEqual(by_section[s1].counts[PlanStatusChoices.CANT_DO_IT], 1)
+        default = self.band.sections.get(is_default=True)
+        self.assertEqual(by_section[default].counts[PlanStatusChoices.NO_PLAN], 1)
+
+        counts = dict(roster.status_counts)
+        self.assertEqual(counts[PlanStatusChoices.DEFINITELY], 2)
+        self.assertEqual(counts[PlanStatusChoices.NO_PLAN], 1)
+        self.assertEqual(roster.status_counts[-1][0], PlanStatusChoices.NO_PLAN)
+
+    def test_gig_detail_queries_do_not_grow(self):
+        Section.objects.create(name="s1", band=self.band)
+        g = self.create_gig(self.band_admin)
+        c = Client()
+        c.force_login(self.band_admin)
+
+        def _count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                response = c.get(reverse("gig-detail", args=[g.id]))
+            self.assertEqual(response.status_code, 200)
+            return len(ctx.captured_queries)
+
+        self.add_members(2)
+        few = _count_queries()
+        self.add_members(10)
+        self.assertEqual(_count_queries(), few)
+
+
+@override_settings(NOTIFICATION_CHUNK_SIZE=2)
+class NotificationTest(GigTestBase):
+    def test_notification_sent_in_chunks(self):
+        self.add_members(5)
+        g = self.create_gig_form(user=self.band_admin, contact=self.band_admin)
+        send = NotificationSend.objects.get(gig=g)
+        self.assertEqual(send.chunks.count(), 3)
+        self.assertEqual(send.total, 5)
+        self.assertEqual(send.sent, 5)
+        self.assertTrue(send.is_finished)
+        self.assertEqual(len(mail.outbox), 5)
+
+        # running a chunk again doesn't send anything
+        send_notification_chunk(send.chunks.first().id)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_notification_resumes_unsent_chunks(self):
+        self.add_members(5)
+        with mock.patch("gig.models.async_task_on_commit"):
+            g = self.create_gig_form(user=self.band_admin, contact=self.band_admin)
+        send = NotificationSend.objects.get(gig=g)
+        self.assertEqual(len(mail.outbox), 0)
+        send_notification_chunk(send.chunks.first().id)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # the band admin can see how far it got
+        c = Client()
+        c.force_login(self.band_admin)
+        response = c.get(reverse("gig-detail", args=[g.id]))
+        self.assertEqual(response.context["notification_send"], send)
+
+        # too soon to resume
+        resume_notifications()
+        self.assertEqual(len(mail.outbox), 2)
+
+        NotificationSend.objects.filter(id=send.id).update(created=timezone.now() - timedelta(hours=1))
+        resume_notifications()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len(set(m.to[0] for m in mail.outbox)), 5)
+        send.refresh_from_db()
+        self.assertTrue(send.is_finished)
+        self.assertFalse(NotificationChunk.objects.filter(send=send, sent__isnull=True).exists())
+
+        response = c.get(reverse("gig-detail", args=[g.id]))
+        self.assertIsNone(response.context["notification_send"])
+
+    def test_delete_old_notification_sends(self):
+        self.add_members(5)
+        g = self.create_gig_form(user=self.band_admin, contact=self.band_admin)
+        send = NotificationSend.objects.get(gig=g)
+        self.assertEqual(delete_old_notification_sends(), 'deleted 0 old notifications')
+
+        NotificationSend.objects.filter(id=send.id).update(
+            created=timezone.now() - timedelta(days=settings.NOTIFICATION_KEEP_DAYS + 1))
+        self.assertEqual(delete_old_notification_sends(), 'deleted 1 old notifications')
+        self.assertFalse(NotificationChunk.objects.filter(send_id=send.id).exists())
+
+
+class DigestTest(GigTestBase):
+    def _age_digests(self):
+        DigestEntry.objects.update(created=timezone.now() - timedelta(hours=1))
+
+    def test_member_digest(self):
+        self.joeuser.preferences.notification_digest = True
+        self.joeuser.save()
+        joe = self.assoc_user(self.joeuser)
+        self.assoc_user(self.janeuser)
+
+        g1 = self.create_gig_form(user=self.band_admin, contact=self.band_admin, title="First Gig")
+        self.update_gig_form(g1, user=self.band_admin, status=GigStatusChoices.CONFIRMED)
+        g2 = self.create_gig_form(user=self.band_admin, contact=self.band_admin, title="Second Gig")
+        # jane gets each email as it happens, joe's are held
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertTrue(all(self.janeuser.email in m.to[0] for m in mail.outbox))
+        self.assertEqual(DigestEntry.objects.filter(member=self.joeuser).count(), 3)
+
+        # too soon
+        send_digests()
+        self.assertEqual(len(mail.outbox), 3)
+
+        self._age_digests()
+        send_digests()
+        self.assertEqual(len(mail.outbox), 4)
+        message = mail.outbox[-1]
+        self.assertIn(self.joeuser.email, message.to[0])
+        self.assertIn("2 gigs", message.subject)
+        self.assertIn("First Gig", message.body)
+        self.assertIn("Second Gig", message.body)
+        # a gig that was added and then edited is just new
+        self.assertNotIn("EDITED", message.body)
+        for g in [g1, g2]:
+            p = g.plans.get(assoc=joe)
+            self.assertIn(f"{p.id}/{PlanStatusChoices.DEFINITELY}", message.body)
+        self.assertEqual(message.body.count("Thanks,"), 1)
+        self.assertFalse(DigestEntry.objects.exists())
+
+        send_digests()
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_band_digest_lists_all_edits(self):
+        self.band.notification_digest = True
+        self.band.save()
+        self.assoc_user(self.joeuser)
+        g = self.create_gig_form(user=self.band_admin, contact=self.band_admin)
+        self._age_digests()
+        send_digests()
+        self.assertEqual(len(mail.outbox), 1)
+
+        self.update_gig_form(g, user=self.band_admin, status=GigStatusChoices.CONFIRMED)
+        g.refresh_from_db()
+        self.update_gig_form(g, user=self.band_admin, details="bring a hat")
+        self.assertEqual(len(mail.outbox), 1)
+        self._age_digests()
+        send_digests()
+        self.assertEqual(len(mail.outbox), 2)
+        body = mail.outbox[1].body
+        self.assertIn("EDITED", body)
+        self.assertIn("Status: Confirmed! (was Unconfirmed)", body)
+        self.assertIn("Details: (See below.)", body)
+
+    def test_reminders_are_not_held(self):
+        self.joeuser.preferences.notification_digest = True
+        self.joeuser.save()
+        self.assoc_user(self.joeuser)
+        g = self.create_gig_form(user=self.band_admin, contact=self.band_admin)
+        self.assertEqual(len(mail.outbox), 0)
+        send_reminder_email(g)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class ArchiveTest(GigTestBase):
+    def _old_gigs(self, n):
+        then = timezone.now() - timedelta(days=30)
+        return [self.create_gig(self.band_admin, title=f"old {i}", start_date=then, set_date=None, end_date=None)
+                for i in range(n)]
+
+    def test_archive_in_bulk(self):
+        gigs = self._old_gigs(3)
+        gigs[0].watchers.add(self.band_admin)
+        self.assertTrue(InboxEntry.objects.filter(plan__gig__in=gigs).exists())
+        new_gig = self.create_gig(self.band_admin, title="not yet")
+        version = Band.objects.get(id=self.band.id).calendar_version
+
+        with mock.patch("gig.tasks.async_task") as task:
+            archive_old_gigs()
+        self.assertEqual(task.call_count, 1)
+        self.assertEqual(task.call_args.args, ('band.helpers.set_calfeeds_dirty', self.band))
+        self.assertEqual(Band.objects.get(id=self.band.id).calendar_version, version + 1)
+
+        for g in gigs:
+            g.refresh_from_db()
+            self.assertTrue(g.is_archived)
+            record = g.history.latest()
+            self.assertTrue(record.is_archived)
+            self.assertEqual(record.history_type, '~')
+        self.assertFalse(gigs[0].watchers.exists())
+        self.assertFalse(InboxEntry.objects.filter(plan__gig__in=gigs).exists())
+        new_gig.refresh_from_db()
+        self.assertFalse(new_gig.is_archived)
+
+    def test_archive_queries_do_not_grow(self):
+        def _count_queries(n):
+            self._old_gigs(n)
+            with CaptureQueriesContext(connection) as ctx:
+                archive_old_gigs()
+            self.assertFalse(Gig.objects.filter(is_archived=False).exists())
+            return len(ctx.captured_queries)
+
+        few = _count_queries(2)
+        self.assertEqual(_count_queries(10), few)
+
+
+    def test_archive_takes_snapshots(self):
+        gigs = self._old_gigs(2)
+        archive_old_gigs()
+        self.assertEqual(GigSnapshot.objects.filter(gig__in=gigs).count(), 2)
+
+
+class SnapshotTest(GigTestBase):
+    def _archived_gig(self):
+        g, _, p = self.assoc_joe_and_create_gig(details="see http://example.com")
+        p.status = PlanStatusChoices.DEFINITELY
+        p.comment = "bringing the tuba"
+        p.save()
+        g.is_archived = True
+        g.save()
+        return g, p
+
+    def test_snapshot_taken_on_archive(self):
+        g, p = self._archived_gig()
+        data = GigSnapshot.objects.get(gig=g).data
+        plans = [plan for section in data['sections'] for plan in section['plans']
+                 if plan['member'] == self.joeuser.id]
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(plans[0]['comment'], "bringing the tuba")
+        self.assertEqual(plans[0]['status'], PlanStatusChoices.DEFINITELY)
+        self.assertIn(PlanStatusChoices.DEFINITELY, [p for p, count in data['counts'] if count == 1])
+        self.assertIn('<a href="http://example.com"', data['details'])
+
+        # saving the archived gig again keeps the snapshot it was archived with
+        snapshot = GigSnapshot.objects.get(gig=g)
+        Plan.objects.filter(id=p.id).update(comment="changed later")
+        g.save()
+        self.assertEqual(GigSnapshot.objects.get(gig=g).created, snapshot.created)
+        self.assertEqual(GigSnapshot.objects.get(gig=g).data, data)
+
+    def test_archived_page_from_snapshot(self):
+        g, p = self._archived_gig()
+        # the page shows the gig as it was archived, not the plans
+        Plan.objects.filter(id=p.id).update(comment="changed later")
+        self.client.force_login(self.joeuser)
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse('gig-detail', args=[g.id]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTemplateUsed(resp, 'gig/gig_detail_archived.html')
+        self.assertContains(resp, "bringing the tuba")
+        self.assertNotContains(resp, "changed later")
+        self.assertFalse([q for q in ctx.captured_queries if 'gig_plan' in q['sql']])
+
+    def test_old_archived_gig_gets_snapshot(self):
+        g, _ = self._archived_gig()
+        GigSnapshot.objects.all().delete()
+        self.client.force_login(self.joeuser)
+        resp = self.client.get(reverse('gig-detail', args=[g.id]))
+        self.assertContains(resp, "bringing the tuba")
+        self.assertTrue(GigSnapshot.objects.filter(gig=g).exists())
+
+    def test_gig_save_loads_old_gig_once(self):
+        # the heatmap, attendance, tally and snapshot receivers share one look at the gig as it was
+        g, _, _ = self.assoc_joe_and_create_gig()
+        g.is_archived = True
+        g.date = g.date + timedelta(days=1)
+        with CaptureQueriesContext(connection) as ctx:
+            g.save()
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if f'FROM "gig_gig" WHERE "gig_gig"."id" = {g.id} ' in q['sql']]), 1)
+        self.assertTrue(GigSnapshot.objects.filter(gig=g).exists())
+
+    def test_unarchive_drops_snapshot(self):
+        g, _ = self._archived_gig()
+        g.is_archived = False
+        g.save()
+        self.assertFalse(GigSnapshot.objects.filter(gig=g).exists())
+        self.client.force_login(self.joeuser)
+        resp = self.client.get(reverse('gig-detail', args=[g.id]))
+        self.assertTemplateUsed(resp, 'gig/gig_detail.html')
+
+    def test_archive_spreadsheet(self):
+        self._archived_gig()
+        self.client.force_login(self.joeuser)
+        resp = self.client.get(reverse('archive-spreadsheet', args=[self.band.id]))
+        self.assertIn(self.joeuser.username, resp.content.decode())
+
+
+class PlanTallyTest(GigTestBase):
+    def assert_tallies_match(self, g):
+        g = Gig.objects.get(id=g.id)
+        self.assertEqual(+g.plan_counts, Counter(p.status for p in g.member_plans))
+        for section_id, counts in g.section_plan_counts.items():
+            self.assertEqual(counts, Counter(p.status for p in g.member_plans.filter(section_id=section_id)))
+
+    def test_tallies_follow_plans(self):
+        jane = self.assoc_user(self.janeuser)
+        g, _, p = self.assoc_joe_and_create_gig()
+        self.assert_tallies_match(g)
+        self.assertEqual(g.plan_counts[PlanStatusChoices.NO_PLAN], 3)
+
+        p.set_status(PlanStatusChoices.DEFINITELY)
+        self.assert_tallies_match(g)
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.DEFINITELY], 1)
+
+        # moving sections moves the tally
+        s = Section.objects.create(name="Horns", band=self.band)
+        p.plan_section = s
+        p.save()
+        self.assert_tallies_match(g)
+        self.assertIn(s.id, Gig.objects.get(id=g.id).section_plan_counts)
+
+        # a member who isn't confirmed any more isn't counted
+        jane.status = AssocStatusChoices.NOT_CONFIRMED
+        jane.save()
+        self.assert_tallies_match(g)
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.NO_PLAN], 1)
+
+        p.delete()
+        self.assert_tallies_match(g)
+
+    def test_tallies_follow_member_status_and_archiving(self):
+        jane = self.assoc_user(self.janeuser)
+        g, _, _ = self.assoc_joe_and_create_gig()
+        self.janeuser.status = MemberStatusChoices.DELETED
+        self.janeuser.save()
+        self.assert_tallies_match(g)
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.NO_PLAN], 2)
+
+        # archived gigs count everyone, and bringing one back stops counting the ex-member again
+        g.is_archived = True
+        g.save()
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.NO_PLAN], 3)
+        g.is_archived = False
+        g.save()
+        self.assert_tallies_match(g)
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.NO_PLAN], 2)
+
+        # a new default section moves the member's plans
+        s = Section.objects.create(name="Horns", band=self.band)
+        jane.status = AssocStatusChoices.CONFIRMED
+        jane.default_section = s
+        jane.save()
+        self.janeuser.status = MemberStatusChoices.ACTIVE
+        self.janeuser.save()
+        self.assert_tallies_match(g)
+        self.assertIn(s.id, Gig.objects.get(id=g.id).section_plan_counts)
+
+    def test_assoc_change_keeps_tallies(self):
+        g, a, _ = self.assoc_joe_and_create_gig()
+        with mock.patch.object(PlanTally.objects, 'sync') as sync:
+            a.color = 3
+            a.save()
+            g.title = 'new title'
+            g.save()
+        sync.assert_not_called()
+
+    def test_answer_moves_one_count(self):
+        g, _, p = self.assoc_joe_and_create_gig()
+        with mock.patch.object(PlanTally.objects, 'sync') as sync:
+            p.set_status(PlanStatusChoices.DEFINITELY)
+            p.set_status(PlanStatusChoices.PROBABLY)
+        sync.assert_not_called()
+        self.assert_tallies_match(g)
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.DEFINITELY], 0)
+
+    def test_tallies_for_new_members(self):
+        g = self.create_gig(self.band_admin)
+        self.assoc_user(self.joeuser)
+        self.assert_tallies_match(g)
+        self.assertEqual(Gig.objects.get(id=g.id).plan_counts[PlanStatusChoices.NO_PLAN], 2)
+
+    def test_gig_delete(self):
+        g, _, _ = self.assoc_joe_and_create_gig()
+        g.delete()
+        self.assertFalse(PlanTally.objects.exists())
+
+    def test_reconcile(self):
+        g, _, p = self.assoc_joe_and_create_gig()
+        Plan.objects.filter(id=p.id).update(status=PlanStatusChoices.CANT_DO_IT)
+
+        out = StringIO()
+        call_command('reconcile_plan_tallies', '--verify-only', stdout=out)
+        self.assertIn(f'tallies for gig {g.id} are wrong', out.getvalue())
+        self.assertIn('1 gigs have wrong tallies', out.getvalue())
+
+        out = StringIO()
+        call_command('reconcile_plan_tallies', stdout=out)
+        self.assertIn('repaired the tallies for 1 gigs', out.getvalue())
+        self.assert_tallies_match(g)
+
+        # the row the plan moved out of is left at zero, which isn't drift
+        p.set_status(PlanStatusChoices.DEFINITELY)
+        self.assertTrue(PlanTally.objects.filter(gig=g, status=PlanStatusChoices.CANT_DO_IT, count=0).exists())
+        out = StringIO()
+        call_command('reconcile_plan_tallies', stdout=out)
+        self.assertIn('all tallies match', out.getvalue())
+
+
+class ReminderTest(GigTestBase):
+    def test_snooze_reminder_on_time(self):
+        _, _, p = self.assoc_joe_and_create_gig()
+        p.snooze_until = timezone.now() + timedelta(hours=2)
+        p.save()
+        r = Reminder.objects.get(plan=p)
+        self.assertEqual(r.bucket.minute, 0)
+
+        mail.outbox = []
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 0)
+
+        # pretend the snooze has run out
+        past = timezone.now() - timedelta(minutes=1)
+        Plan.objects.filter(id=p.id).update(snooze_until=past)
+        Reminder.objects.filter(id=r.id).update(due=past, bucket=past - timedelta(hours=1))
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("Reminder", mail.outbox[0].subject)
+        self.assertIsNone(Plan.objects.get(id=p.id).snooze_until)
+
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_answered_snooze_not_sent(self):
+        _, _, p = self.assoc_joe_and_create_gig()
+        p.snooze_until = timezone.now() - timedelta(minutes=5)
+        p.save()
+        p.set_status(PlanStatusChoices.DEFINITELY)
+        mail.outbox = []
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertIsNotNone(Reminder.objects.get(plan=p).sent)
+
+    def test_rsvp_reminder(self):
+        jane = self.assoc_user(self.janeuser)
+        g, _, p = self.assoc_joe_and_create_gig()
+        g.plans.get(assoc=jane).set_status(PlanStatusChoices.DEFINITELY)
+        p.set_status(PlanStatusChoices.DONT_KNOW)
+
+        g.rsvp_by_date = timezone.now() + timedelta(days=3)
+        g.save()
+        mail.outbox = []
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 0)
+
+        # moving the deadline moves the reminder
+        g.rsvp_by_date = timezone.now() + timedelta(hours=settings.RSVP_REMINDER_HOURS - 1)
+        g.save()
+        self.assertEqual(Reminder.objects.filter(gig=g).count(), 1)
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("RSVP Reminder", mail.outbox[0].subject)
+        self.assertIn(self.joeuser.email, mail.outbox[0].to[0])
+
+        # editing the gig again doesn't send it again
+        g.title = "Still New"
+        g.save()
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_reminders_survive_a_failed_run(self):
+        _, _, p = self.assoc_joe_and_create_gig()
+        p.snooze_until = timezone.now() - timedelta(minutes=5)
+        p.save()
+        mail.outbox = []
+        with mock.patch("gig.tasks.send_emails_from_plans", side_effect=OSError("down")):
+            with self.assertRaises(OSError):
+                send_due_reminders()
+        self.assertIsNone(Reminder.objects.get(plan=p).sent)
+        send_due_reminders()
+        self.assertEqual(len(mail.outbox), 1)
+
+
 class GigWatchTest(GigTestBase):
     def test_watch_gig(self):
         g, _, _ = self.assoc_joe_and_create_gig()
@@ -1370,6 +1954,51 @@ class GigWatchTest(GigTestBase):
         message = mail.outbox[0]
         self.assertIn('1:30', message.body)
 
+    def test_watch_queries_do_not_grow(self):
+        g, _, _ = self.assoc_joe_and_create_gig()
+
+        def _count_queries(watchers):
+            for m in watchers:
+                g.watchers.add(m)
+            for p in g.plans.all():
+                p.set_status(PlanStatusChoices.PROBABLY)
+            mail.outbox = []
+            with CaptureQueriesContext(connection) as ctx:
+                alert_watchers()
+            self.assertEqual(len(mail.outbox), g.watchers.count())
+            return len([q for q in ctx.captured_queries if 'gig_plan' in q['sql'] or 'member_member' in q['sql']])
+
+        members, _ = self.add_members(2)
+        few = _count_queries(members)
+        members, _ = self.add_members(8)
+        self.assertEqual(_count_queries(members), few)
+        self.assertFalse(Plan.objects.filter(status_changed=True).exists())
+
+    def test_watch_change_during_alert(self):
+        g, _, p = self.assoc_joe_and_create_gig()
+        g.watchers.add(self.band_admin)
+        p.set_status(PlanStatusChoices.DEFINITELY)
+
+        other = g.plans.exclude(id=p.id).get()
+        real_send = gig_tasks.send_watcher_email
+        def _send_and_change(member, plans):
+            real_send(member, plans)
+            # someone answers while the emails are going out
+            Plan.objects.get(id=p.id).set_status(PlanStatusChoices.CANT_DO_IT)
+            Plan.objects.get(id=other.id).set_status(PlanStatusChoices.PROBABLY)
+
+        mail.outbox = []
+        with mock.patch("gig.tasks.send_watcher_email", side_effect=_send_and_change):
+            alert_watchers()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(set(Plan.objects.filter(status_changed=True).values_list('id', flat=True)), {p.id, other.id})
+
+        mail.outbox = []
+        alert_watchers()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('is now Can&#x27;t Do It', mail.outbox[0].body)
+        self.assertFalse(Plan.objects.filter(status_changed=True).exists())
+
 class GigSecurityTest(GigTestBase):
     def test_gig_detail_access(self):
         g, _, _ = self.assoc_joe_and_create_gig()
@@ -1493,6 +2122,7 @@ class TestGigAPI(GigTestBase):
             self.assertEqual(gig.get("band"), self.band.name)
             self.assertEqual(gig.get("contact"), self.joeuser.display_name)
             self.assertEqual(gig.get("plan_status"), PlanStatusChoices.NO_PLAN.label)
+            self.assertEqual(gig.get("plan_counts")[PlanStatusChoices.NO_PLAN.label], 2)
             self.assertEqual(Gig.objects.get(id=gig.get("id")).plans.filter(assoc__member=self.joeuser).first().assoc.status, AssocStatusChoices.CONFIRMED)
 
     def test_gigs_uncomfirmed_member(self):
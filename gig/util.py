@@ -31,3 +31,7 @@ class GigStatusChoices(models.IntegerChoices):
     CONFIRMED = 1, _("Confirmed")
     CANCELED = 2, _("Canceled")
     ASKING = 3, _("Asking")
+
+class ReminderKindChoices(models.IntegerChoices):
+    SNOOZE = 0, _("Snooze")
+    RSVP = 1, _("RSVP Deadline")
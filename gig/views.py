@@ -21,14 +21,13 @@ from django.views import generic
 from django.views.generic.base import TemplateView
 from django.urls import reverse
 from django.utils import timezone
-from django.db.models import Q
-from django.db.models.functions import Lower
+from django.db.models import F, Q
 from django import forms
 from django.http import HttpResponseForbidden
-from .models import Gig, Plan, GigComment
+from .models import Gig, Plan, GigComment, GigSnapshot
 from .forms import GigForm
 from .util import PlanStatusChoices
-from .helpers import create_gig_series
+from .helpers import create_gig_series, build_roster, snapshot_gigs
 from band.models import Band, Assoc
 from gig.helpers import notify_new_gig
 from member.helpers import has_band_admin, has_manage_gig_permission, has_create_gig_permission, has_comment_permission
@@ -43,17 +42,32 @@ class DetailView(LoginRequiredMixin, UserPassesTestMixin, generic.DetailView):
         gig = get_object_or_404(Gig, id=self.kwargs['pk'])
         return gig.band.has_member(self.request.user) or self.request.user.is_superuser
 
+    snapshot = None
+
+    def get_template_names(self):
+        if self.snapshot:
+            return ['gig/gig_detail_archived.html']
+        return super().get_template_names()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['the_user_is_band_admin'] = has_band_admin(
-            self.request.user, self.object.band)
-        context['user_has_manage_gig_permission'] = has_manage_gig_permission(
-            self.request.user, self.object.band) or \
-                self.object.creator == self.request.user or \
-                self.object.contact == self.request.user
         context['user_has_create_gig_permission'] = has_create_gig_permission(
             self.request.user, self.object.band)
 
+        if self.object.is_archived:
+            # archived gigs are shown as they were when they were archived. Gigs archived before there
+            # were snapshots get one the first time they're looked at.
+            self.snapshot = GigSnapshot.objects.filter(gig=self.object).first() or \
+                snapshot_gigs([self.object.id])[0]
+            context['snapshot'] = self.snapshot.data
+        else:
+            context['the_user_is_band_admin'] = has_band_admin(
+                self.request.user, self.object.band)
+            context['user_has_manage_gig_permission'] = has_manage_gig_permission(
+                self.request.user, self.object.band) or \
+                    self.object.creator == self.request.user or \
+                    self.object.contact == self.request.user
+
         if self.object.enddate:
             context['multi_day_gig'] = self.object.is_full_day
         else:
@@ -64,15 +78,17 @@ class DetailView(LoginRequiredMixin, UserPassesTestMixin, generic.DetailView):
             context['set_time'] = self.object.setdate if self.object.has_set_time else None
             context['end_time'] = self.object.enddate if self.object.has_end_time else None
 
-        context['rsvp_by_date'] = self.object.rsvp_by_date
+        if not self.snapshot:
+            context['rsvp_by_date'] = self.object.rsvp_by_date
+
+            context['plan_list'] = [x.value for x in PlanStatusChoices]
 
-        context['plan_list'] = [x.value for x in PlanStatusChoices]
+            context['roster'] = build_roster(self.object)
 
-        # filter the plans so we only see plans for regular users, or occasionals who have registered,
-        # or the current user
-        # VERY IMPORTANT! The order of these results MUST be group by section, or the template breaks.
-        # See https://github.com/Gig-o-Matic/GO3/pull/251
-        context['gig_ordered_member_plans'] = self.object.member_plans.all().order_by('section',Lower('assoc__member__display_name'))
+            if context['user_has_manage_gig_permission']:
+                # let whoever changed the gig see how the emails about it are coming along
+                context['notification_send'] = self.object.notification_sends.filter(
+                    sent__lt=F('total')).order_by('-created').first()
 
         if self.object.address:
             if url_validate(self.object.address):
@@ -289,7 +305,7 @@ class PrintPlansView(LoginRequiredMixin, UserPassesTestMixin, TemplateView):
         context = super().get_context_data(**kwargs)
         gig = Gig.objects.get(id=self.kwargs['pk'])
         context['gig'] = gig
-        context['gig_ordered_member_plans'] = gig.member_plans.order_by('section_id', Lower('assoc__member__display_name'))
+        context['roster'] = build_roster(gig)
         context['plan_list'] = PlanStatusChoices.labels
         context['all'] = kwargs.get('all', True)
         return context
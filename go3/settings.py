@@ -38,7 +38,8 @@ from bleach import sanitizer
 env = environ.Env(DEBUG=bool, SENDGRID_SANDBOX_MODE_IN_DEBUG=bool, CAPTCHA_THRESHOLD=float, 
                   CALFEED_DYNAMIC_CALFEED=bool, CACHE_USE_FILEBASED=bool, ALLOWED_HOSTS=list,
                   ROUTINE_TASK_KEY=int, SENDGRID_SENDER=str, ROLLBAR_ACCESS_TOKEN=str, DATABASE_URL=str,
-                  LOG_LEVEL=str, CAPTCHA_ENABLE=bool)
+                  LOG_LEVEL=str, CAPTCHA_ENABLE=bool, PREFERENCES_BUFFER_UI_STATE=bool,
+                  MEMBERSHIP_CACHE_SECONDS=int, Q_CLUSTER_WORKERS=int, CALFEED_PROCESSES=int, EMAIL_OUTBOX_RATE=float, EMAIL_OUTBOX_BURST=int)
 
 # reading .env file
 environ.Env.read_env()
@@ -90,6 +91,7 @@ INSTALLED_APPS = [
     "agenda",
     "firewall",
     "stats.apps.StatsConfig",
+    "lib.apps.LibConfig",
     "widget_tweaks",
     "go3.apps.Go3AdminConfig",
     # "django.contrib.admin",
@@ -264,7 +266,7 @@ if ROLLBAR_ACCESS_TOKEN:
 # Configure Django-q message broker
 Q_CLUSTER = {
     "name": "DjangORM",
-    "workers": 1,
+    "workers": env("Q_CLUSTER_WORKERS", default=4),
     # Set timeout ridiculously high until we have a solution: https://github.com/Gig-o-Matic/GO3/pull/450#issuecomment-2072130002
     "timeout": 600, # Allow for longer task runs, particularly emails to large bands
     "retry": 660, # Always ensure this is larger than timeout, or tasks will duplicate!
@@ -312,9 +314,55 @@ else:
     EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
     EMAIL_FILE_PATH = BASE_DIR + "/tmp"
 
+# Outgoing email is written to the outbox table and sent in batches of this many over one connection,
+# at no more than EMAIL_OUTBOX_RATE messages a second (0 for no limit) with bursts of EMAIL_OUTBOX_BURST.
+EMAIL_OUTBOX_BATCH_SIZE = 100
+EMAIL_OUTBOX_RATE = env('EMAIL_OUTBOX_RATE', default=0)
+EMAIL_OUTBOX_BURST = env('EMAIL_OUTBOX_BURST', default=10)
+EMAIL_OUTBOX_MAX_ATTEMPTS = 3       # give up on a message after this many failed sends
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 900    # seconds before a batch a worker took but never finished is taken again
+EMAIL_OUTBOX_KEEP_DAYS = 30         # days to keep the rows for sent and failed messages
+
+# Gig notifications are sent by a task per chunk of this many recipients, so they can run on several workers.
+# Chunks that still haven't gone out this many minutes after the notification started are queued again.
+NOTIFICATION_CHUNK_SIZE = 25
+NOTIFICATION_RESUME_MINUTES = 15
+NOTIFICATION_KEEP_DAYS = 7          # days to keep the record of a notification and its chunks
+# Members who get digests (or whose band sends them) have new and edited gig emails held for this many minutes
+# and then get one email about all of them.
+NOTIFICATION_DIGEST_MINUTES = 10
+
+# Members who haven't answered a gig with an RSVP deadline are reminded this many hours before it. The deadline
+# is the start of the RSVP day in the band's timezone, so 15 hours makes it 9am the day before.
+RSVP_REMINDER_HOURS = 15
+
 # Calfeed settings
 DYNAMIC_CALFEED = env('CALFEED_DYNAMIC_CALFEED', default=False) # True to generate calfeed on demand; False for disk cache
+# Dynamic calfeeds are cached, and only one request at a time makes a missing one. Both go through the cache, so
+# with the local memory cache each process keeps its own copies and makes each feed once itself.
 CALFEED_BASEDIR = env('CALFEED_CALFEED_BASEDIR', default='')
+# Dirty calfeeds are made again in batches of this many, loading each batch's plans and gigs together. A batch
+# whose feeds haven't been saved this long after it was taken - because its worker died - is taken again.
+CALFEED_BATCH_SIZE = 100
+CALFEED_CLAIM_SECONDS = 15 * 60
+# The scheduled tasks make the feeds in the django-q worker. The regenerate_calfeeds command can make them in a
+# pool of this many processes instead, for a big catch-up run. The pool's processes have their own caches, so
+# with the local memory cache the gig events they make aren't shared with the web processes or kept after the
+# command ends.
+CALFEED_PROCESSES = env('CALFEED_PROCESSES', default=1)
+
+# Member preference settings - the schedule page remembers which list the member last looked at on every
+# load. If this is True those writes are held in each process's memory and written out in batches. That
+# suits a single web process; with more, a member may see the old list selected until the batch is written,
+# and a process that's killed loses the last few seconds of choices.
+PREFERENCES_BUFFER_UI_STATE = env('PREFERENCES_BUFFER_UI_STATE', default=False)
+PREFERENCES_BUFFER_SIZE = 100       # write out the buffer when this many members are waiting...
+PREFERENCES_BUFFER_SECONDS = 60     # ...or this long after the first one, even if no more requests come in
+
+# Permission checks load all of a member's assocs once per request. Setting this keeps them in the cache
+# for this many seconds so later requests can use them too. The cache key includes a version kept on the
+# member, which saving or deleting an assoc moves on, so this is safe with the per-process LocMemCache.
+MEMBERSHIP_CACHE_SECONDS = env('MEMBERSHIP_CACHE_SECONDS', default=0)
 
 MESSAGE_TAGS = {
     messages.DEBUG: "alert-info",
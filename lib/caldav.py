@@ -14,54 +14,290 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from django.core.cache import cache
 from django.core.files.storage import default_storage, FileSystemStorage
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 from icalendar import Calendar, Event
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, date, timezone as dt_timezone
 from django.utils import timezone, translation
 from django.utils.translation import gettext_lazy as _
 from gig.util import GigStatusChoices
 from django.conf import settings
 from go3.settings import URL_BASE
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import django
+import gzip
+import multiprocessing
+import hashlib
+import os
+import tempfile
+import time
+from io import BytesIO
+
+# cached events are keyed by the gig's last update, so they never need to be deleted; this just stops the
+# cache filling up with old versions
+CALFEED_EVENT_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# dynamic feeds are cached under their version, so this also only clears out old versions
+CALFEED_CACHE_TIMEOUT = 60 * 60 * 24
+# while one request builds a dynamic feed, the others asking for it wait this long for it before
+# building it themselves
+CALFEED_BUILD_TIMEOUT = 30
+CALFEED_BUILD_POLL = 0.05
+# feeds made in a process pool are handed out this many at a time
+CALFEED_POOL_CHUNK = 10
 
 if default_storage.__class__ == FileSystemStorage:
     default_storage.location = f'{settings.CALFEED_BASEDIR}calfeeds'
     default_storage.base_url = 'calfeeds'
 
 
-def save_calfeed(tag, content):
-    file_path = f'{tag}.txt'
+# Stored feeds are kept as {tag}.txt, with a gzipped copy in {tag}.txt.gz and the sha256 of the feed in
+# {tag}.txt.sha256, which is the ETag. Calendar clients poll their feeds all day, so most polls can be
+# answered with a 304 from the hash file alone, and the rest get the gzipped copy streamed from disk.
 
-    with default_storage.open(file_path, mode='wb') as f:
-        f.write(content)
+def _write_calfeed_file(name, content):
+    if default_storage.__class__ == FileSystemStorage:
+        # write to a temporary file and move it into place, so a request never sees a half-written feed
+        path = default_storage.path(name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.calfeed-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    else:
+        with default_storage.open(name, mode='wb') as f:
+            f.write(content)
 
 
-def get_calfeed(tag):
+def _read_calfeed_hash(tag):
     try:
-        with default_storage.open('{0}.txt'.format(tag), mode='r') as f:
-            s = f.read()
+        with default_storage.open(f'{tag}.txt.sha256', mode='rb') as f:
+            return f.read().decode()
     except FileNotFoundError:
+        return None
+
+
+def save_calfeed(tag, content):
+    digest = hashlib.sha256(content).hexdigest()
+    if digest == _read_calfeed_hash(tag) and default_storage.exists(f'{tag}.txt'):
+        return  # unchanged, so leave it alone and keep its Last-Modified
+
+    # the hash goes last; until it's written, clients holding the old ETag can get a 304 for the old feed
+    _write_calfeed_file(f'{tag}.txt', content)
+    _write_calfeed_file(f'{tag}.txt.gz', gzip.compress(content, mtime=0))
+    _write_calfeed_file(f'{tag}.txt.sha256', digest.encode())
+
+
+def _accepts_gzip(request):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _sep, params = coding.partition(';')
+        if name.strip().lower() == 'gzip':
+            q = params.strip().lower()
+            if q.startswith('q='):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def calfeed_response(request, tag):
+    """ serve a stored feed, gzipped if the client takes it, with validators for conditional requests """
+    name = f'{tag}.txt'
+    try:
+        last_modified = int(default_storage.get_modified_time(name).timestamp())
+    except (FileNotFoundError, NotADirectoryError):
         raise ValueError()
-    return s
+
+    digest = _read_calfeed_hash(tag)
+    gzipped = _accepts_gzip(request) and digest is not None and default_storage.exists(f'{name}.gz')
+    etag = None
+    if digest:
+        # each encoding is a different representation, so it needs its own strong ETag
+        etag = f'"{digest}-gzip"' if gzipped else f'"{digest}"'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = FileResponse(default_storage.open(f'{name}.gz' if gzipped else name, mode='rb'),
+                                content_type='text/calendar')
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    if etag:
+        response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def _single_flight(key, make):
+    """ get the value from the cache, or make it and cache it. Only one request makes it; others missing
+        at the same time wait for that one's answer instead of all making it at once. The lock is in the
+        cache, so with the default LocMemCache this only holds within a process - each process makes the
+        feed once. Use a shared cache for it to hold across processes. """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}-building'
+    deadline = time.monotonic() + CALFEED_BUILD_TIMEOUT
+    while not cache.add(lock_key, True, CALFEED_BUILD_TIMEOUT):
+        time.sleep(CALFEED_BUILD_POLL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if time.monotonic() > deadline:
+            break   # the other request is stuck or gone, so make it here
+
+    try:
+        # it may have been finished between the first look and taking the lock
+        value = cache.get(key)
+        if value is None:
+            value = make()
+            cache.set(key, value, CALFEED_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+    return value
+
+
+def dynamic_calfeed_response(request, version, make):
+    """ serve a feed made on demand. 'version' is anything that changes whenever the feed would, and
+        'make' returns the feed and its last modified time. """
+    digest = hashlib.sha1(repr(version).encode()).hexdigest()
+    content, last_modified = _single_flight(f'calfeed-{digest}', make)
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    # the feed's DTSTAMPs change every time it's made, so the same version isn't byte for byte the same
+    etag = f'W/"{digest}"'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(content, content_type='text/calendar')
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+@contextmanager
+def calfeed_pool(processes):
+    """ a pool of processes to make feeds in, or None to make them in this one. Daemonic processes - like
+        django-q workers - can't start a pool, so they get None too. Each process in the pool has its own
+        cache, so gig events are only shared between them through a cache that's shared between processes. """
+    if processes <= 1 or multiprocessing.current_process().daemon:
+        yield None
+        return
+    # spawned processes set up Django for themselves and don't inherit this one's database connections
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=django.setup) as pool:
+        yield pool
+
+
+def _make_calfeed_job(job):
+    make, args = job
+    return make(*args)
+
+
+def make_calfeeds(pool, jobs):
+    """ run (make, args) jobs, in the pool if there is one. The jobs can't use the database, so everything
+        the feeds need has to be loaded into the arguments. """
+    if pool is None:
+        return [make(*args) for make, args in jobs]
+    return list(pool.map(_make_calfeed_job, jobs, chunksize=CALFEED_POOL_CHUNK))
 
 
 def delete_calfeed(tag):
     if settings.DYNAMIC_CALFEED is False:
-        file_path = f'{tag}.txt'
-        if default_storage.exists(file_path):
-            default_storage.delete(file_path)
+        for file_path in [f'{tag}.txt', f'{tag}.txt.gz', f'{tag}.txt.sha256']:
+            if default_storage.exists(file_path):
+                default_storage.delete(file_path)
 
 
-def _make_calfeed_metadata(the_source):
-    cal = Calendar()
-    cal.add('prodid', '-//Gig-o-Matic//gig-o-matic.com//')
-    cal.add('version', '2.0')
-    cal.add('X-WR-CALNAME', the_source)
-    cal.add('X-WR-CALDESC',
-            '{0} {1}'.format(_('Gig-o-Matic calendar for'), the_source))
-    return cal
+# iCalendar (RFC 5545) writer. Feeds are big - a member can have hundreds of gigs in the window - and building
+# them as icalendar Calendar and Event objects costs an object per property and another pass to serialize
+# them, so the feeds are written straight out as content lines. _make_icalendar_feed builds the same feed with
+# the icalendar object model; the tests check the writer against it and benchmark_calfeed compares the two.
 
+CRLF = b'\r\n'
+# lines are folded at 75 octets, not counting the CRLF
+ICS_LINE_LIMIT = 75
+# properties whose values are URIs, which aren't escaped like text
+ICS_URI_PROPERTIES = {'URL'}
 
-def _make_calfeed_event(gig, is_for_band):
+
+def _ics_escape(text):
+    """ escape a TEXT value (RFC 5545 3.3.11) """
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+               .replace('\r\n', '\\n').replace('\r', '\\n').replace('\n', '\\n')
+
+
+def _ics_value(name, value):
+    """ the parameters and value text for a property value """
+    if isinstance(value, datetime):
+        # aware times are all written in UTC, so the feed doesn't need VTIMEZONE components; naive ones float
+        suffix = ''
+        if value.tzinfo is not None:
+            value = value.astimezone(dt_timezone.utc)
+            suffix = 'Z'
+        return '', (f'{value.year:04}{value.month:02}{value.day:02}'
+                    f'T{value.hour:02}{value.minute:02}{value.second:02}{suffix}')
+    if isinstance(value, date):
+        return ';VALUE=DATE', f'{value.year:04}{value.month:02}{value.day:02}'
+    if name in ICS_URI_PROPERTIES:
+        return '', str(value)
+    return '', _ics_escape(str(value))
+
+
+def _ics_fold(line):
+    """ fold an encoded content line, without splitting a UTF-8 character """
+    if len(line) <= ICS_LINE_LIMIT:
+        return line + CRLF
+    parts = []
+    start = 0
+    limit = ICS_LINE_LIMIT
+    while len(line) - start > limit:
+        end = start + limit
+        # back up to the start of a character; continuation bytes are 0b10xxxxxx
+        while line[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(line[start:end])
+        start = end
+        limit = ICS_LINE_LIMIT - 1  # the leading space counts
+    parts.append(line[start:])
+    return b'\r\n '.join(parts) + CRLF
+
+
+def _ics_property(name, value):
+    params, text = _ics_value(name, value)
+    return _ics_fold(f'{name}{params}:{text}'.encode('utf-8'))
+
+
+def _ics_component(name, properties, components=()):
+    """ generate the content lines of a component from (name, value) pairs and its serialized subcomponents """
+    yield b'BEGIN:' + name.encode() + CRLF
+    for prop, value in properties:
+        yield _ics_property(prop, value)
+    yield from components
+    yield b'END:' + name.encode() + CRLF
+
+
+def _calfeed_metadata(the_source):
+    return [
+        ('VERSION', '2.0'),
+        ('PRODID', '-//Gig-o-Matic//gig-o-matic.com//'),
+        ('X-WR-CALDESC', '{0} {1}'.format(_('Gig-o-Matic calendar for'), the_source)),
+        ('X-WR-CALNAME', str(the_source)),
+    ]
+
+
+def _calfeed_event(gig, is_for_band):
+    """ the properties of the VEVENT for a gig """
     def _make_description(gig):
         parts = []
         if is_for_band:
@@ -78,44 +314,90 @@ def _make_calfeed_event(gig, is_for_band):
             parts.append(f'Gig-o-matic: {URL_BASE}/gig/{gig.id}')
         return "\n\n".join(parts)
 
-    event = Event()
-    event.add('dtstamp', timezone.now())
-    event.add('uid', gig.cal_feed_id)
-
     summary = gig.title
     if not is_for_band: # TODO will be a user option to add band name
         summary += f' - {gig.band.name}'
-    event.add('summary', summary)
 
     if gig.is_full_day:
-        date = gig.date.date()
-        startdate = datetime.combine(date, datetime.min.time())
-        event.add('dtstart', startdate, {'value': 'DATE'})
+        startdate = gig.date.date()
         # To make the event use the full final day, icalendar clients expect the end date
         # to be the date after the event ends. So we add 1 day.
         # https://datatracker.ietf.org/doc/html/rfc5545#section-3.6.1:
         # "The "DTEND" property for a "VEVENT" calendar component specifies
         # the non-inclusive end of the event."
         enddate = (gig.enddate if gig.enddate else gig.date).date() + timedelta(days=1)
-        enddate = datetime.combine(enddate, datetime.min.time())
-        event.add('dtend', enddate, {'value': 'DATE'})
     else:
-        setdate = gig.setdate if (is_for_band and gig.setdate) else gig.date
-        event.add('dtstart', setdate)
+        startdate = gig.setdate if (is_for_band and gig.setdate) else gig.date
         enddate = gig.enddate if gig.enddate else gig.date + timedelta(hours=1)
-        event.add('dtend', enddate)
 
-    event.add('description', _make_description(gig))
-    event.add('location', gig.address)
+    properties = [
+        ('SUMMARY', summary),
+        ('DTSTART', startdate),
+        ('DTEND', enddate),
+        ('DTSTAMP', timezone.now()),
+        ('UID', gig.cal_feed_id),
+        ('DESCRIPTION', _make_description(gig)),
+        ('LOCATION', gig.address or ''),
+    ]
 
     # add the url if this is a member feed
     # this is also in the description of the gig so maybe don't need it here? Not every cal app
     # parses it properly
     if not is_for_band:
-        event.add('url', f'{URL_BASE}/gig/{gig.id}')
+        properties.append(('URL', f'{URL_BASE}/gig/{gig.id}'))
 
     # todo go2 also has sequence:0, status:confirmed, and transp:opaque attributes - need those?
-    return event
+    return properties
+
+
+def _make_calfeed_event(gig, is_for_band):
+    """ the serialized VEVENT for a gig """
+    return b''.join(_ics_component('VEVENT', _calfeed_event(gig, is_for_band)))
+
+
+def _make_icalendar_feed(metadata, events):
+    """ the feed built with the icalendar object model, from the same properties as the writer uses """
+    cal = Calendar()
+    for name, value in metadata:
+        cal.add(name, value)
+    for properties in events:
+        event = Event()
+        for name, value in properties:
+            event.add(name, value)
+        cal.add_component(event)
+    return cal.to_ical()
+
+
+def _event_cache_key(gig, is_for_band):
+    if is_for_band:
+        variant = 'band'
+    else:
+        # the member summary has the band name in it, and renaming the band doesn't touch the gig
+        variant = f'member-{hashlib.sha1(gig.band.name.encode()).hexdigest()[:12]}'
+    return f'calfeed-event-{gig.id}-{variant}-{translation.get_language()}-{gig.last_update.timestamp()}'
+
+
+def _make_calfeed_events(gigs, is_for_band):
+    """ the serialized VEVENTs for the gigs. An event is the same in every feed it's in - a member feed
+        event is the same for every member of the band who reads the same language - so they're made once
+        and cached until the gig changes. """
+    keys = [_event_cache_key(gig, is_for_band) for gig in gigs]
+    events = cache.get_many(keys)
+    missing = {}
+    for gig, key in zip(gigs, keys):
+        if key not in events and key not in missing:
+            missing[key] = _make_calfeed_event(gig, is_for_band)
+    if missing:
+        cache.set_many(missing, CALFEED_EVENT_CACHE_TIMEOUT)
+        events.update(missing)
+    return [events[key] for key in keys]
+
+
+def _assemble_calfeed(metadata, events):
+    """ write the calendar around the serialized events """
+    buffer = BytesIO()
+    buffer.writelines(_ics_component('VCALENDAR', metadata, events))
+    return buffer.getvalue()
 
 
 def make_member_calfeed(member, the_plans):
@@ -124,11 +406,8 @@ def make_member_calfeed(member, the_plans):
     # member.cal_feed_id # TODO uid
 
     with translation.override(member.preferences.language):
-        cal = _make_calfeed_metadata(member)
-        for plan in the_plans:
-            event = _make_calfeed_event(plan.gig, is_for_band=False)
-            cal.add_component(event)
-    return cal.to_ical()
+        events = _make_calfeed_events([plan.gig for plan in the_plans], is_for_band=False)
+        return _assemble_calfeed(_calfeed_metadata(member), events)
 
 
 def make_band_calfeed(band, the_gigs):
@@ -136,8 +415,5 @@ def make_band_calfeed(band, the_gigs):
     # band.pub_cal_feed_id  TODO use uid?
 
     with translation.override(band.default_language):
-        cal = _make_calfeed_metadata(band)
-        for gig in the_gigs:
-            event = _make_calfeed_event(gig, is_for_band=True)
-            cal.add_component(event)
-    return cal.to_ical()
+        events = _make_calfeed_events(list(the_gigs), is_for_band=True)
+        return _assemble_calfeed(_calfeed_metadata(band), events)
@@ -1,12 +1,19 @@
 from dataclasses import dataclass
+from datetime import timedelta
 
+from django.conf import settings
 from django.core import mail
+from django.db.models import Q
 from django.template.loader import render_to_string
 from django.utils import translation, timezone
-from django_q.tasks import async_task
 from markdown import markdown
 import email.utils
 import pytz
+import time
+import uuid
+
+from lib.models import OutboxMessage, OutboxStatusChoices
+from lib.tasks import async_task_on_commit
 
 from go3.settings import DEFAULT_FROM_EMAIL, DEFAULT_FROM_EMAIL_NAME, LANGUAGE_CODE, URL_BASE
 
@@ -14,13 +21,112 @@ SUBJECT = 'Subject:'
 DEFAULT_SUBJECT = 'Message from Gig-O-Matic'
 
 def send_messages_async(messages):
-    # Can accept an iterable, so we need to make it a list for serialization
+    """ Put the messages in the outbox. The rows are written in the caller's transaction, so they only go
+        out if it commits, and the task that sends them just gets told to look at the outbox. """
+    rows = OutboxMessage.objects.bulk_create((OutboxMessage.from_message(m) for m in messages),
+                                             batch_size=settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not rows:
+        return
+
     # ack_failure=True prevents spamming people with taks retries
-    return async_task('lib.email.do_send_messages_async', list(messages), ack_failure=True)
+    async_task_on_commit('lib.email.drain_outbox', ack_failure=True)
 
 def do_send_messages_async(messages):
+    # tasks queued before the outbox existed still call this
     mail.get_connection().send_messages(messages)
 
+
+class TokenBucket:
+    """ Lets through `rate` messages a second on average, and up to `burst` at once after a quiet spell.
+        A rate of 0 means no limit. """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+
+    def take(self):
+        if not self.rate:
+            return
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+            self.tokens = 1
+            self.last = now + wait
+        self.tokens -= 1
+
+
+def _claim_batch(after_id):
+    """ take the next batch of messages for this worker. Messages another worker took a long time ago
+        are assumed to be abandoned and get taken again. """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+    waiting = (Q(status=OutboxStatusChoices.QUEUED) |
+               Q(status=OutboxStatusChoices.SENDING, claimed__lt=stale))
+    ids = list(OutboxMessage.objects.filter(waiting, id__gt=after_id).order_by('id')
+               .values_list('id', flat=True)[:settings.EMAIL_OUTBOX_BATCH_SIZE])
+    if not ids:
+        return []
+
+    # only rows that are still waiting are ours; anything another worker got to first is left alone
+    claim = uuid.uuid4()
+    OutboxMessage.objects.filter(waiting, id__in=ids).update(
+        status=OutboxStatusChoices.SENDING, claim=claim, claimed=now)
+    return list(OutboxMessage.objects.filter(claim=claim).order_by('id'))
+
+def send_outbox_batch(after_id=0, bucket=None):
+    """ send one batch of messages over a single connection, recording how each one went.
+        Returns the id of the last message in the batch, or None if there was nothing to send. """
+    batch = _claim_batch(after_id)
+    if not batch:
+        return None
+
+    connection = mail.get_connection()
+    connection.open()
+    try:
+        for row in batch:
+            if bucket:
+                bucket.take()
+            try:
+                connection.send_messages([row.as_message(connection)])
+            except Exception as e: # pylint: disable=broad-except
+                attempts = row.attempts + 1
+                status = (OutboxStatusChoices.FAILED if attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS
+                          else OutboxStatusChoices.QUEUED)
+                OutboxMessage.objects.filter(id=row.id).update(status=status, attempts=attempts,
+                                                               error=str(e), claim=None)
+            else:
+                OutboxMessage.objects.filter(id=row.id).update(status=OutboxStatusChoices.SENT,
+                                                               attempts=row.attempts + 1,
+                                                               sent=timezone.now(), claim=None)
+    finally:
+        connection.close()
+    return batch[-1].id
+
+def drain_outbox():
+    """ Send everything waiting in the outbox. send_messages_async queues this, but it should also be
+        called on a schedule so messages whose sending failed get another try. """
+    bucket = TokenBucket(settings.EMAIL_OUTBOX_RATE, settings.EMAIL_OUTBOX_BURST)
+    # keep moving forward, so anything that failed in this run waits for the next one
+    last_id = 0
+    while last_id is not None:
+        last_id = send_outbox_batch(last_id, bucket)
+
+def delete_old_outbox_messages():
+    """ Delete the outbox rows for messages that were sent, or given up on, more than EMAIL_OUTBOX_KEEP_DAYS
+        ago. Should be called on a schedule. """
+    cutoff = timezone.now() - timedelta(days=settings.EMAIL_OUTBOX_KEEP_DAYS)
+    old = OutboxMessage.objects.filter(Q(status=OutboxStatusChoices.SENT, sent__lt=cutoff) |
+                                       Q(status=OutboxStatusChoices.FAILED, created__lt=cutoff))
+    num, _ = old.delete()
+    return f'deleted {num} old outbox messages'
+
 @dataclass
 class EmailRecipient:
     email: str
@@ -31,27 +137,31 @@ class EmailRecipient:
     def email_line(self):
         return email.utils.formataddr([self.name, self.email])
 
-def prepare_email(recipient, template, context=None, **kw):
-    if not context:
-        context = dict()
-    context['recipient'] = recipient
-    context['url_base'] = URL_BASE
-
+def _email_from(context):
     gig = context.get('gig',None)
     if gig:
         the_from = gig.band.name
     else:
         the_from = DEFAULT_FROM_EMAIL_NAME
 
-    the_from = f'{the_from}<{DEFAULT_FROM_EMAIL}>'
+    return f'{the_from}<{DEFAULT_FROM_EMAIL}>'
+
+def _email_timezone(context):
+    plan = context.get('plan')
+    return plan.assoc.band.timezone if plan else None
+
+def render_email_part(template, context, language, tz=None):
+    """ render the text of a template in a recipient's language and a band's timezone, for putting
+        inside another email """
+    with translation.override(language):
+        if tz:
+            with timezone.override(pytz.timezone(tz)):
+                    return render_to_string(template, context).strip()
+        else:
+            return render_to_string(template, context).strip()
 
-    with translation.override(recipient.language):
-        try:
-            plan = context['plan']
-            with timezone.override(pytz.timezone(plan.assoc.band.timezone)):
-                    text = render_to_string(template, context).strip()
-        except KeyError:
-            text = render_to_string(template, context).strip()
+def _render_email(template, context, language, tz):
+    text = render_email_part(template, context, language, tz)
 
     if text.startswith(SUBJECT):
         subject, text = [t.strip() for t in text[len(SUBJECT):].split('\n', 1)]
@@ -59,7 +169,56 @@ def prepare_email(recipient, template, context=None, **kw):
         subject = DEFAULT_SUBJECT
 
     html = markdown(text, extensions=['nl2br'])
+    return subject, text, html
 
+def _make_message(recipient, subject, text, html, the_from, **kw):
     message = mail.EmailMultiAlternatives(subject, text, from_email=the_from, to=[recipient.email_line], **kw)
     message.attach_alternative(html, 'text/html')
     return message
+
+def prepare_email(recipient, template, context=None, **kw):
+    if not context:
+        context = dict()
+    context['recipient'] = recipient
+    context['url_base'] = URL_BASE
+
+    subject, text, html = _render_email(template, context, recipient.language, _email_timezone(context))
+    return _make_message(recipient, subject, text, html, _email_from(context), **kw)
+
+
+class EmailVariants:
+    """ Prepares emails like prepare_email, but renders each variant only once.
+
+    Emails with the same template, language, timezone and key must have the same context except for
+    the values in tokens, a dict of strings which are swapped into the rendered email for each recipient.
+    The first email of a variant is rendered normally and the rest are copied from it. If the template
+    uses the recipient, every email is rendered on its own since there's nothing to share. """
+
+    def __init__(self):
+        self._rendered = {}
+
+    def prepare_email(self, recipient, template, context, key=None, tokens=None, **kw):
+        tokens = tokens or {}
+        context['url_base'] = URL_BASE
+        tz = _email_timezone(context)
+        variant = (template, recipient.language, tz, key)
+
+        if variant not in self._rendered:
+            # render for a stand-in recipient, so we can tell whether the template shows who it is sent to
+            stand_in = EmailRecipient(email=f'{uuid.uuid4().hex}@recipient', name=uuid.uuid4().hex,
+                                      language=recipient.language)
+            context['recipient'] = stand_in
+            rendered = _render_email(template, context, recipient.language, tz)
+            if any(stand_in.email in part or stand_in.name in part for part in rendered):
+                rendered = None
+            self._rendered[variant] = (rendered, tokens)
+
+        rendered, rendered_tokens = self._rendered[variant]
+        if rendered is None:
+            context['recipient'] = recipient
+            rendered = _render_email(template, context, recipient.language, tz)
+        else:
+            for name, value in tokens.items():
+                rendered = [part.replace(rendered_tokens[name], value) for part in rendered]
+
+        return _make_message(recipient, *rendered, _email_from(context), **kw)
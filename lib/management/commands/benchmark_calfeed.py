@@ -0,0 +1,57 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from datetime import timedelta
+from band.models import Band
+from gig.models import Gig
+from lib.caldav import _assemble_calfeed, _calfeed_metadata, _calfeed_event, _ics_component, _make_icalendar_feed
+import timeit
+
+
+class Command(BaseCommand):
+    help = 'Times building a member calfeed with the iCalendar writer against building it with icalendar objects'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gigs', type=int, default=300, help='number of gigs in the feed')
+        parser.add_argument('--repeat', type=int, default=5, help='number of times to build each feed')
+
+    def handle(self, *args, **options):
+        # the gigs are never saved, so this can be run against any database
+        band = Band(name='Benchmark Band')
+        start = timezone.now()
+        gigs = [Gig(id=i, band=band, title=f'Gig number {i}', date=start + timedelta(days=i),
+                    details='Load in at the back, parking on the street.\nBring stands; the stage is small.',
+                    setlist='Song one\nSong two\nSong three, with the long intro',
+                    address='1 Main Street, Springfield')
+                for i in range(options['gigs'])]
+
+        def writer():
+            events = [b''.join(_ics_component('VEVENT', _calfeed_event(gig, is_for_band=False))) for gig in gigs]
+            return _assemble_calfeed(_calfeed_metadata(band), events)
+
+        def icalendar():
+            return _make_icalendar_feed(_calfeed_metadata(band),
+                                        [_calfeed_event(gig, is_for_band=False) for gig in gigs])
+
+        repeat = options['repeat']
+        writer_time = min(timeit.repeat(writer, number=1, repeat=repeat))
+        icalendar_time = min(timeit.repeat(icalendar, number=1, repeat=repeat))
+        self.stdout.write(f'{len(gigs)} gigs, best of {repeat}')
+        self.stdout.write(f'icalendar: {icalendar_time * 1000:.1f} ms')
+        self.stdout.write(f'writer:    {writer_time * 1000:.1f} ms')
+        self.stdout.write(self.style.SUCCESS(f'{icalendar_time / writer_time:.1f}x faster'))
@@ -0,0 +1,45 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from band.helpers import regenerate_band_calfeeds
+from band.models import Band
+from lib.caldav import calfeed_pool
+from member.helpers import regenerate_member_calfeeds
+from member.models import Member
+
+
+class Command(BaseCommand):
+    help = 'Makes the dirty member and band calfeeds again, in batches, and reports how long each batch took'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.CALFEED_PROCESSES,
+                            help='number of processes to make the feeds in')
+        parser.add_argument('--all', action='store_true', help='make every feed again, not just the dirty ones')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            Member.objects.update(cal_feed_dirty=True)
+            Band.objects.update(pub_cal_feed_dirty=True)
+
+        with calfeed_pool(options['processes']) as pool:
+            for kind, regenerate in [('member', regenerate_member_calfeeds), ('band', regenerate_band_calfeeds)]:
+                count = 0
+                for size, seconds in regenerate(pool):
+                    count += size
+                    self.stdout.write(f'{size} {kind} calfeeds in {seconds:.2f}s')
+                self.stdout.write(self.style.SUCCESS(f'made {count} {kind} calfeeds'))
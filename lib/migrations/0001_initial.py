@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_email', models.TextField()),
+                ('to', models.JSONField()),
+                ('reply_to', models.JSONField(blank=True, null=True)),
+                ('subject', models.TextField()),
+                ('body', models.TextField()),
+                ('html', models.TextField(blank=True)),
+                ('status', models.IntegerField(choices=[(0, 'Queued'), (1, 'Sending'), (2, 'Sent'), (3, 'Failed')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('claim', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='lib_outboxm_status_c9f661_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,72 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from django.core import mail
+from django.db import models
+
+
+class OutboxStatusChoices(models.IntegerChoices):
+    QUEUED = 0, "Queued"
+    SENDING = 1, "Sending"
+    SENT = 2, "Sent"
+    FAILED = 3, "Failed"
+
+
+class OutboxMessage(models.Model):
+    """ An email waiting to be sent, or the record of one that was. Rows are written by
+        lib.email.send_messages_async and sent by lib.email.drain_outbox. Only the parts of a message
+        we actually use are kept: sender, recipients, reply-to, subject, text and html bodies. """
+    from_email = models.TextField()
+    to = models.JSONField()
+    reply_to = models.JSONField(null=True, blank=True)
+    subject = models.TextField()
+    body = models.TextField()
+    html = models.TextField(blank=True)
+
+    status = models.IntegerField(choices=OutboxStatusChoices.choices, default=OutboxStatusChoices.QUEUED)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    # set when a worker takes the message, so two workers don't both send it
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return '{0} to {1} ({2})'.format(self.subject, ', '.join(self.to), OutboxStatusChoices(self.status).label)
+
+    @classmethod
+    def from_message(cls, message):
+        html = ''
+        for content, mimetype in getattr(message, 'alternatives', []):
+            if mimetype == 'text/html':
+                html = content
+        return cls(from_email=message.from_email, to=list(message.to),
+                   reply_to=list(message.reply_to) if message.reply_to else None,
+                   subject=message.subject, body=message.body, html=html)
+
+    def as_message(self, connection=None):
+        message = mail.EmailMultiAlternatives(self.subject, self.body, from_email=self.from_email, to=self.to,
+                                              reply_to=self.reply_to, connection=connection)
+        if self.html:
+            message.attach_alternative(self.html, 'text/html')
+        return message
@@ -0,0 +1,30 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django_q.tasks import async_task
+
+
+def async_task_on_commit(func, *args, **kwargs):
+    """ Queue a task once the current transaction commits, so the worker sees whatever rows were written
+        for it. When tasks run inline (as in the tests, inside a transaction that never commits) it just
+        runs now. """
+    if settings.Q_CLUSTER.get('sync'):
+        async_task(func, *args, **kwargs)
+    else:
+        transaction.on_commit(lambda: async_task(func, *args, **kwargs))
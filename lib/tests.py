@@ -15,19 +15,30 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from django.core import mail
-from django.test import TestCase
-from lib.email import send_messages_async
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory, override_settings
+from lib.email import send_messages_async, drain_outbox, delete_old_outbox_messages, TokenBucket
+from lib.models import OutboxMessage, OutboxStatusChoices
+from unittest import mock
 from band.util import AssocStatusChoices
 from gig.models import Gig
 from member.models import Member
 from band.models import Band, Assoc
 from gig.models import Plan
 from gig.util import PlanStatusChoices
-from lib.caldav import save_calfeed, get_calfeed, make_band_calfeed, make_member_calfeed, make_band_calfeed, delete_calfeed
+from lib import caldav
+from lib.caldav import save_calfeed, calfeed_response, make_band_calfeed, make_member_calfeed, make_band_calfeed, delete_calfeed
 from pyfakefs.fake_filesystem_unittest import TestCase as FSTestCase
 import os
+import threading
+import uuid
+import time
+import gzip
+import hashlib
+from io import StringIO
 from datetime import timedelta, timezone as dttimezone
-from django.utils import timezone
+from django.utils import timezone, translation
+from icalendar import Calendar
 import pytz
 from django.conf import settings
 import pytest
@@ -44,6 +55,158 @@ class EmailTest(TestCase):
         send_messages_async([mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])] * 5)
         self.assertEqual(len(mail.outbox), 5)
 
+    def test_outbox_records_delivery(self):
+        message = mail.EmailMultiAlternatives('Subject', 'Body', 'from@example.com', ['to@example.com'],
+                                              reply_to=['reply@example.com'])
+        message.attach_alternative('<p>Body</p>', 'text/html')
+        send_messages_async([message])
+
+        row = OutboxMessage.objects.get()
+        self.assertEqual(row.status, OutboxStatusChoices.SENT)
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNotNone(row.sent)
+        self.assertIsNone(row.claim)
+        sent = mail.outbox[0]
+        self.assertEqual(sent.to, ['to@example.com'])
+        self.assertEqual(sent.reply_to, ['reply@example.com'])
+        self.assertEqual(sent.alternatives, [('<p>Body</p>', 'text/html')])
+
+    @override_settings(EMAIL_OUTBOX_BATCH_SIZE=2)
+    def test_outbox_connection_per_batch(self):
+        with mock.patch('lib.email.mail.get_connection', wraps=mail.get_connection) as get_connection:
+            send_messages_async([mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])] * 5)
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxStatusChoices.SENT).count(), 5)
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_outbox_failures(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('nope')):
+            send_messages_async([mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])])
+            row = OutboxMessage.objects.get()
+            self.assertEqual(row.status, OutboxStatusChoices.QUEUED)
+            self.assertEqual(row.attempts, 1)
+            self.assertEqual(row.error, 'nope')
+
+            drain_outbox()
+            row.refresh_from_db()
+            self.assertEqual(row.status, OutboxStatusChoices.FAILED)
+            self.assertEqual(row.attempts, 2)
+
+        # failed messages stay failed
+        drain_outbox()
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_delete_old_outbox_messages(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('nope')):
+            send_messages_async([mail.EmailMessage('Failed', 'Body', 'from@example.com', ['to@example.com'])])
+        OutboxMessage.objects.update(status=OutboxStatusChoices.FAILED)
+        send_messages_async([mail.EmailMessage('Sent', 'Body', 'from@example.com', ['to@example.com'])])
+        OutboxMessage.objects.create(from_email='from@example.com', to=['to@example.com'], subject='Queued', body='')
+        self.assertEqual(delete_old_outbox_messages(), 'deleted 0 old outbox messages')
+
+        later = timezone.now() + timedelta(days=settings.EMAIL_OUTBOX_KEEP_DAYS + 1)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(delete_old_outbox_messages(), 'deleted 2 old outbox messages')
+        # messages still waiting to go out are kept however old they are
+        self.assertEqual(list(OutboxMessage.objects.values_list('subject', flat=True)), ['Queued'])
+
+    def test_token_bucket(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        bucket = TokenBucket(2, burst=3, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            bucket.take()
+        self.assertEqual(now[0], 0)     # the burst goes straight through
+        for _ in range(4):
+            bucket.take()
+        self.assertEqual(now[0], 2)     # then two a second
+
+        TokenBucket(0, clock=lambda: now[0], sleep=sleep).take()
+        self.assertEqual(now[0], 2)
+
+
+# The feeds the icalendar Calendar and Event objects made for CaldavTest.make_awkward_gigs before the feeds were
+# written out directly, unfolded and without the DTSTAMPs. The band feed was given the last gig as it is right after
+# it's saved, with its date still in the band's timezone.
+BASELINE_MEMBER_CALFEED = r"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Gig-o-Matic//gig-o-matic.com//
+X-WR-CALDESC:Gig-o-Matic calendar for {member}
+X-WR-CALNAME:{member}
+BEGIN:VEVENT
+SUMMARY:New Gig - test band
+DTSTART:20200229T143000Z
+DTEND:20200229T153000Z
+UID:00000000-0000-0000-0000-000000000001
+DESCRIPTION:Unconfirmed\n\nBring: music\, stands\; and a \\ backslash\nsecond line\nthird line\n\nÜnïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé Ünïcödé \n\nGig-o-matic: {url}/gig/{gig0}
+LOCATION:1 Main St\, Springfield\; round the back
+URL:{url}/gig/{gig0}
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Festival xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx - test band
+DTSTART;VALUE=DATE:20200307T000000
+DTEND;VALUE=DATE:20200310T000000
+UID:00000000-0000-0000-0000-000000000002
+DESCRIPTION:Unconfirmed\n\nGig-o-matic: {url}/gig/{gig1}
+LOCATION:None
+URL:{url}/gig/{gig1}
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Late gig - test band
+DTSTART:20200311T030000Z
+DTEND:20200311T040000Z
+UID:00000000-0000-0000-0000-000000000003
+DESCRIPTION:Unconfirmed\n\nGig-o-matic: {url}/gig/{gig2}
+LOCATION:None
+URL:{url}/gig/{gig2}
+END:VEVENT
+END:VCALENDAR"""
+
+BASELINE_BAND_CALFEED = r"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Gig-o-Matic//gig-o-matic.com//
+X-WR-CALDESC:Gig-o-Matic calendar for test band
+X-WR-CALNAME:test band
+BEGIN:VEVENT
+SUMMARY:New Gig
+DTSTART:20200229T153000Z
+DTEND:20200229T153000Z
+UID:00000000-0000-0000-0000-000000000001
+DESCRIPTION:
+LOCATION:1 Main St\, Springfield\; round the back
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Festival xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
+DTSTART;VALUE=DATE:20200307T000000
+DTEND;VALUE=DATE:20200310T000000
+UID:00000000-0000-0000-0000-000000000002
+DESCRIPTION:three days\, outdoors
+LOCATION:None
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Late gig
+DTSTART;TZID=America/New_York:20200310T230000
+DTEND;TZID=America/New_York:20200311T000000
+UID:00000000-0000-0000-0000-000000000003
+DESCRIPTION:
+LOCATION:None
+END:VEVENT
+END:VCALENDAR"""
+
+# The lines the writer means to write differently. Apart from these, and folding at 75 octets where icalendar
+# counted characters, the feeds are the same.
+BASELINE_CALFEED_CHANGES = {
+    # full day gigs are DATE values; icalendar wrote the midnight time along with the VALUE=DATE
+    'DTSTART;VALUE=DATE:20200307T000000': 'DTSTART;VALUE=DATE:20200307',
+    'DTEND;VALUE=DATE:20200310T000000': 'DTEND;VALUE=DATE:20200310',
+    # times are always UTC; icalendar used the TZID of a pytz date, with no VTIMEZONE to say what it means
+    'DTSTART;TZID=America/New_York:20200310T230000': 'DTSTART:20200311T030000Z',
+    'DTEND;TZID=America/New_York:20200311T000000': 'DTEND:20200311T040000Z',
+    # a gig without an address has an empty location; icalendar wrote None
+    'LOCATION:None': 'LOCATION:',
+}
 
 class CaldavTest(TestCase):
     def setUp(self):
@@ -58,11 +221,10 @@ class CaldavTest(TestCase):
         self.joeuser_assoc = Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.CONFIRMED)
 
         self.testgig = self.create_gig()
-        self.testgigplan = Plan.objects.create(
-            assoc=self.joeuser_assoc,
-            gig=self.testgig,
-            status=PlanStatusChoices.DEFINITELY,
-        )
+        # the gig already has a plan for every member
+        self.testgigplan = self.testgig.plans.get(assoc=self.joeuser_assoc)
+        self.testgigplan.status = PlanStatusChoices.DEFINITELY
+        self.testgigplan.save()
 
     def tearDown(self):
         """ make sure we get rid of anything we made """
@@ -243,6 +405,163 @@ class CaldavTest(TestCase):
         self.assertIn(b'DESCRIPTION:No confirmado\\n\\ntest details\\n\\n', cf)
 
 
+    def test_calfeed_events_shared(self):
+        # the same gig is only turned into an event once for all the members who read the same language
+        with mock.patch('lib.caldav._make_calfeed_event', wraps=caldav._make_calfeed_event) as make_event:
+            make_member_calfeed(self.joeuser, self.joeuser.calendar_plans.all())
+            make_member_calfeed(self.band_admin, self.band_admin.calendar_plans.all())
+            self.assertEqual(make_event.call_count, 1)
+
+            # a change to the gig makes a new event
+            self.testgig.title = 'Newer Gig'
+            self.testgig.save()
+            make_member_calfeed(self.joeuser, self.joeuser.calendar_plans.all())
+            self.assertEqual(make_event.call_count, 2)
+
+        # the feed is the same as one made with the events uncached
+        cf = make_member_calfeed(self.joeuser, self.joeuser.calendar_plans.all())
+        events = [caldav._make_calfeed_event(plan.gig, is_for_band=False) for plan in self.joeuser.calendar_plans.all()]
+        uncached = caldav._assemble_calfeed(caldav._calfeed_metadata(self.joeuser), events)
+        strip = lambda feed: [line for line in feed.split(b'\r\n') if not line.startswith(b'DTSTAMP')]
+        self.assertEqual(strip(cf), strip(uncached))
+
+    def test_calfeed_events_band_rename(self):
+        make_member_calfeed(self.joeuser, self.joeuser.calendar_plans.all())
+        self.band.name = 'renamed band'
+        self.band.save()
+        cf = make_member_calfeed(self.joeuser, self.joeuser.calendar_plans.all())
+        self.assertIn(b'SUMMARY:New Gig - renamed band\r\n', cf)
+
+    def make_awkward_gigs(self):
+        """ gigs with everything the writer has to get right: escaping, folding, zones and full days """
+        self.testgig.details = 'Bring: music, stands; and a \\ backslash\r\nsecond line\nthird line'
+        self.testgig.setlist = 'Ünïcödé ' * 20
+        self.testgig.address = '1 Main St, Springfield; round the back'
+        self.testgig.setdate = self.testgig.date + timedelta(hours=1)
+        self.testgig.save()
+        Gig.objects.create(
+            title='Festival ' + 'x' * 100,
+            band_id=self.band.id,
+            date=pytz.timezone('America/New_York').localize(timezone.datetime(2020, 3, 6, 22, 30)),
+            enddate=pytz.timezone('America/New_York').localize(timezone.datetime(2020, 3, 8, 22, 30)),
+            is_full_day=True,
+            public_description='three days, outdoors',
+        )
+        Gig.objects.create(
+            title='Late gig',
+            band_id=self.band.id,
+            date=pytz.timezone('America/New_York').localize(timezone.datetime(2020, 3, 10, 23, 0)),
+        )
+
+    def assertSameCalendar(self, feed, expected):
+        # compare the parsed calendars property by property, except for the time stamps
+        feed, expected = Calendar.from_ical(feed), Calendar.from_ical(expected)
+        self.assertEqual(sorted(feed.keys()), sorted(expected.keys()))
+        for key in expected:
+            self.assertEqual(feed.decoded(key), expected.decoded(key))
+        self.assertEqual(len(feed.subcomponents), len(expected.subcomponents))
+        for event, expected_event in zip(feed.subcomponents, expected.subcomponents):
+            self.assertEqual(event.name, 'VEVENT')
+            self.assertEqual(sorted(event.keys()), sorted(expected_event.keys()))
+            for key in expected_event:
+                if key != 'DTSTAMP':
+                    self.assertEqual(event.decoded(key), expected_event.decoded(key), key)
+
+    def test_calfeed_conformance(self):
+        # the writer's feeds read back the same as the ones icalendar makes from the same properties. Those
+        # properties are checked against the old feeds in test_calfeed_baseline.
+        self.make_awkward_gigs()
+
+        plans = self.joeuser.calendar_plans.all()
+        self.assertEqual(len(plans), 3)
+        with translation.override(self.joeuser.preferences.language):
+            expected = caldav._make_icalendar_feed(caldav._calfeed_metadata(self.joeuser),
+                                                   [caldav._calfeed_event(p.gig, is_for_band=False) for p in plans])
+        self.assertSameCalendar(make_member_calfeed(self.joeuser, plans), expected)
+
+        gigs = self.band.gigs.all()
+        with translation.override(self.band.default_language):
+            expected = caldav._make_icalendar_feed(caldav._calfeed_metadata(self.band),
+                                                   [caldav._calfeed_event(g, is_for_band=True) for g in gigs])
+        self.assertSameCalendar(make_band_calfeed(self.band, gigs), expected)
+
+    def test_calfeed_baseline(self):
+        # the writer's feeds are the ones icalendar made, apart from the changes that were meant
+        self.make_awkward_gigs()
+        gigs = list(self.band.gigs.order_by('date'))
+        for n, g in enumerate(gigs):
+            g.cal_feed_id = uuid.UUID(int=n + 1)
+            g.save()
+        gigs[2].date = gigs[2].date.astimezone(pytz.timezone('America/New_York'))
+        values = dict({f'gig{n}': g.id for n, g in enumerate(gigs)}, url=settings.URL_BASE, member=self.joeuser)
+        unfold = lambda feed: [line for line in feed.replace(b'\r\n ', b'').decode('utf-8').split('\r\n')
+                               if line and not line.startswith('DTSTAMP')]
+        changed = lambda baseline: [BASELINE_CALFEED_CHANGES.get(line, line)
+                                    for line in baseline.format(**values).split('\n')]
+
+        self.assertTrue(set(BASELINE_CALFEED_CHANGES) <= set(BASELINE_BAND_CALFEED.split('\n')))
+        plans = list(self.joeuser.calendar_plans.select_related('gig', 'gig__band'))
+        self.assertEqual(unfold(make_member_calfeed(self.joeuser, plans)), changed(BASELINE_MEMBER_CALFEED))
+        self.assertEqual(unfold(make_band_calfeed(self.band, gigs)), changed(BASELINE_BAND_CALFEED))
+
+    def test_calfeed_lines(self):
+        self.make_awkward_gigs()
+        cf = make_member_calfeed(self.joeuser, self.joeuser.calendar_plans.all())
+        self.assertTrue(cf.endswith(b'\r\n'))
+        lines = cf[:-2].split(b'\r\n')
+        for line in lines:
+            self.assertLessEqual(len(line), 75)
+            self.assertNotIn(b'\n', line)
+            line.decode('utf-8')    # folds don't split characters
+
+        unfolded = cf.replace(b'\r\n ', b'').decode('utf-8')
+        self.assertIn('DESCRIPTION:Unconfirmed\\n\\nBring: music\\, stands\\; and a \\\\ backslash'
+                      '\\nsecond line\\nthird line\\n\\n' + 'Ünïcödé ' * 20, unfolded)
+        self.assertIn('LOCATION:1 Main St\\, Springfield\\; round the back\r\n', unfolded)
+
+        # times are in UTC, and full day gigs are dates
+        self.assertIn('DTSTART:20200311T030000Z\r\n', unfolded)
+        cf = make_band_calfeed(self.band, self.band.gigs.all()).replace(b'\r\n ', b'')
+        self.assertIn(b'DTSTART:20200229T153000Z\r\n', cf)
+        self.assertIn(b'DTSTART;VALUE=DATE:20200307\r\n', cf)
+        self.assertIn(b'DTEND;VALUE=DATE:20200310\r\n', cf)
+
+    def test_single_flight(self):
+        made = []
+        def make():
+            made.append(1)
+            time.sleep(0.2)
+            return 'feed'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(caldav._single_flight('single-flight-test', make)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(made), 1)
+        self.assertEqual(results, ['feed'] * 5)
+
+    def test_calfeed_pool(self):
+        # feeds made in other processes are the same as ones made here
+        gigs = list(self.band.gigs.all())
+        jobs = [(make_band_calfeed, (self.band, gigs)), (make_member_calfeed, (self.joeuser, list(self.joeuser.calendar_plans.select_related('gig', 'gig__band'))))]
+        with caldav.calfeed_pool(2) as pool:
+            self.assertIsNotNone(pool)
+            pooled = caldav.make_calfeeds(pool, jobs)
+        with caldav.calfeed_pool(1) as pool:
+            self.assertIsNone(pool)
+            here = caldav.make_calfeeds(pool, jobs)
+        strip = lambda feed: [line for line in feed.split(b'\r\n') if not line.startswith(b'DTSTAMP')]
+        self.assertEqual([strip(cf) for cf in pooled], [strip(cf) for cf in here])
+        self.assertIn(b'SUMMARY:New Gig - test band', pooled[1])
+
+    def test_benchmark_calfeed(self):
+        out = StringIO()
+        call_command('benchmark_calfeed', '--gigs=5', '--repeat=1', stdout=out)
+        self.assertIn('faster', out.getvalue())
+
 @pytest.mark.django_db
 class CaldavFileTest(FSTestCase):
 
@@ -274,20 +593,79 @@ class CaldavFileTest(FSTestCase):
             date=the_date,
         )
 
+    def get_calfeed(self, tag):
+        return b''.join(calfeed_response(RequestFactory().get('/'), tag).streaming_content)
+
     def test_calfeed_save_and_get(self):
         save_calfeed('testfile1',b'')
-        cf = get_calfeed('testfile1')
-        self.assertEqual(cf,'')
+        cf = self.get_calfeed('testfile1')
+        self.assertEqual(cf,b'')
 
     def test_calfeed_save_content(self):
         save_calfeed('testfile2',b'hi')
-        cf = get_calfeed('testfile2')
-        self.assertEqual(cf,'hi')
+        cf = self.get_calfeed('testfile2')
+        self.assertEqual(cf,b'hi')
 
     def test_delete_calfeed(self):
         save_calfeed('testfile2',b'hi')
-        cf = get_calfeed('testfile2')
-        self.assertEqual(cf,'hi')
+        cf = self.get_calfeed('testfile2')
+        self.assertEqual(cf,b'hi')
         delete_calfeed('testfile2')
         with self.assertRaises(ValueError):
-            cf = get_calfeed('testfile2')
+            cf = self.get_calfeed('testfile2')
+        self.assertFalse(os.path.exists('calfeeds/testfile2.txt.gz'))
+        self.assertFalse(os.path.exists('calfeeds/testfile2.txt.sha256'))
+
+    def test_calfeed_save_variants(self):
+        content = make_band_calfeed(self.band, self.band.gigs.all())
+        save_calfeed('testfile3', content)
+        with open('calfeeds/testfile3.txt.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), content)
+        with open('calfeeds/testfile3.txt.sha256') as f:
+            self.assertEqual(f.read(), hashlib.sha256(content).hexdigest())
+        self.assertEqual(sorted(os.listdir('calfeeds')), ['testfile3.txt', 'testfile3.txt.gz', 'testfile3.txt.sha256'])
+
+        # saving the same feed again leaves the files alone
+        os.utime('calfeeds/testfile3.txt', (0, 0))
+        save_calfeed('testfile3', content)
+        self.assertEqual(os.path.getmtime('calfeeds/testfile3.txt'), 0)
+        save_calfeed('testfile3', b'changed')
+        self.assertNotEqual(os.path.getmtime('calfeeds/testfile3.txt'), 0)
+
+    def test_calfeed_response(self):
+        content = make_band_calfeed(self.band, self.band.gigs.all())
+        save_calfeed('testfile4', content)
+        digest = hashlib.sha256(content).hexdigest()
+        factory = RequestFactory()
+
+        response = calfeed_response(factory.get('/'), 'testfile4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        self.assertEqual(response.headers['Content-Type'], 'text/calendar')
+        self.assertEqual(response.headers['ETag'], f'"{digest}"')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        last_modified = response.headers['Last-Modified']
+
+        response = calfeed_response(factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate'), 'testfile4')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), content)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], f'"{digest}-gzip"')
+
+        response = calfeed_response(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0'), 'testfile4')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # polling with the validators gets a 304
+        response = calfeed_response(factory.get('/', HTTP_IF_NONE_MATCH=f'"{digest}"'), 'testfile4')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], f'"{digest}"')
+        response = calfeed_response(factory.get('/', HTTP_IF_MODIFIED_SINCE=last_modified), 'testfile4')
+        self.assertEqual(response.status_code, 304)
+
+        # until the feed changes
+        save_calfeed('testfile4', content + b'changed')
+        response = calfeed_response(factory.get('/', HTTP_IF_NONE_MATCH=f'"{digest}"'), 'testfile4')
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertRaises(ValueError):
+            calfeed_response(factory.get('/'), 'nofile')
@@ -21,19 +21,24 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout
 from django.shortcuts import get_object_or_404, redirect, render
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.validators import validate_email
 from django.utils.translation import get_language_from_request
 
 from datetime import timedelta
 from lib.email import prepare_email, send_messages_async
-from lib.caldav import make_member_calfeed, save_calfeed, get_calfeed
+from lib.caldav import make_member_calfeed, save_calfeed, calfeed_response, dynamic_calfeed_response, make_calfeeds
 from band.helpers import do_delete_assoc
 from band.models import Assoc, AssocStatusChoices
 from member.util import MemberStatusChoices
 from member.models import Member, Invite
-from gig.models import Gig
+from gig.models import Gig, Plan
 import secrets
+import time
+from collections import defaultdict
+from itertools import groupby
 from datetime import timedelta
 
 
@@ -116,12 +121,15 @@ def send_email_conf(confirmation):
     send_messages_async([prepare_email(confirmation.as_email_recipient(), template, context)])
 
 
-def prepare_member_calfeed(member):
+def _member_calfeed_plans(member):
     # we want the gigs as far back as a year ago
     date_earliest = timezone.now() - timedelta(days=365)
-    the_plans = member.calendar_plans.filter(gig__date__gt=date_earliest)
-    cf = make_member_calfeed(member, the_plans)
-    return cf
+    return (member.calendar_plans.filter(gig__date__gt=date_earliest).select_related('gig', 'gig__band')
+            .order_by('gig__date', 'gig_id'))
+
+
+def prepare_member_calfeed(member):
+    return make_member_calfeed(member, _member_calfeed_plans(member))
 
 
 def update_member_calfeed(id):
@@ -129,29 +137,107 @@ def update_member_calfeed(id):
     cf = prepare_member_calfeed(m)
     save_calfeed(m.cal_feed_id, cf)
 
+
+def _claim_dirty_member_calfeeds(after_id):
+    """ take the next batch of members whose calfeeds are dirty. They're marked clean as they're taken, so a
+        change while the feed is being made marks it dirty again for the next run, and claimed until their
+        feeds are saved, so a batch whose worker dies is taken again once the claim is CALFEED_CLAIM_SECONDS
+        old. """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.CALFEED_CLAIM_SECONDS)
+    with transaction.atomic():
+        ids = list(Member.objects.filter(Q(cal_feed_dirty=True) | Q(cal_feed_claimed__lt=stale), id__gt=after_id)
+                   .order_by('id').select_for_update(skip_locked=True)
+                   .values_list('id', flat=True)[:settings.CALFEED_BATCH_SIZE])
+        Member.objects.filter(id__in=ids).update(cal_feed_dirty=False, cal_feed_claimed=now)
+    return ids
+
+
+def _load_member_calfeeds(ids):
+    """ the members and their calendar plans, with a query for the plans of each set of calendar preferences """
+    members = list(Member.objects.filter(id__in=ids).select_related('preferences').order_by('id'))
+    date_earliest = timezone.now() - timedelta(days=365)
+    plans = defaultdict(list)
+    prefs = lambda m: (m.preferences.calendar_show_only_confirmed, m.preferences.calendar_show_only_committed,
+                       m.preferences.hide_canceled_gigs)
+    for _, group in groupby(sorted(members, key=prefs), key=prefs):
+        group = list(group)
+        for p in (Plan.objects.filter(Member.calendar_plans_filter(group[0].preferences),
+                                      assoc__member__in=group, gig__date__gt=date_earliest)
+                  .select_related('gig', 'gig__band', 'assoc').order_by('gig__date', 'gig_id')):
+            plans[p.assoc.member_id].append(p)
+    return [(m, plans[m.id]) for m in members]
+
+
+def regenerate_member_calfeeds(pool=None):
+    """ make all the dirty member calfeeds again, a batch at a time. Yields the size of each batch and how
+        long it took. """
+    after_id = 0
+    while True:
+        ids = _claim_dirty_member_calfeeds(after_id)
+        if not ids:
+            return
+        after_id = ids[-1]
+        start = time.monotonic()
+        try:
+            batch = _load_member_calfeeds(ids)
+            feeds = make_calfeeds(pool, [(make_member_calfeed, (m, plans)) for m, plans in batch])
+            for (m, _), cf in zip(batch, feeds):
+                save_calfeed(m.cal_feed_id, cf)
+        except Exception:
+            # leave them for the next run
+            Member.objects.filter(id__in=ids).update(cal_feed_dirty=True, cal_feed_claimed=None)
+            raise
+        Member.objects.filter(id__in=ids).update(cal_feed_claimed=None)
+        yield len(ids), time.monotonic() - start
+
+
+def _member_calfeed_version(member):
+    """ everything the member's feed depends on. Gig, plan and assoc changes all bump the band's
+        calendar_version, and the window moves on every day. """
+    prefs = member.preferences
+    bands = member.assocs.values_list('band_id', 'band__calendar_version', 'band__calendar_changed')
+    return (
+        'member', member.cal_feed_id, str(member), timezone.now().date(),
+        prefs.language, prefs.hide_canceled_gigs,
+        prefs.calendar_show_only_confirmed, prefs.calendar_show_only_committed,
+        sorted(bands),
+    )
+
+
 def calfeed(request, pk):
     try:
         if settings.DYNAMIC_CALFEED:
-            # if the dynamic calfeed is set, just create the calfeed right now and return it
-            tf = prepare_member_calfeed(Member.objects.get(cal_feed_id=pk))
+            # if the dynamic calfeed is set, make the calfeed now - or take it from the cache if nothing has
+            # changed since it was made
+            member = Member.objects.select_related('preferences').get(cal_feed_id=pk)
+            version = _member_calfeed_version(member)
+
+            def make():
+                plans = list(_member_calfeed_plans(member))
+                # a gig that leaves the feed isn't in the plans any more, but it changed its band's calendar
+                changes = [p.gig.last_update for p in plans]
+                changes.append(member.assocs.aggregate(changed=Max('band__calendar_changed'))['changed'])
+                return make_member_calfeed(member, plans), max(filter(None, changes), default=None)
+
+            return dynamic_calfeed_response(request, version, make)
         else:
-            # if using the task queue, get the calfeed from the disk cache
-            tf = get_calfeed(pk)
+            # if using the task queue, serve the calfeed from the disk cache
+            return calfeed_response(request, pk)
     except (ValueError, ValidationError):
         hr = HttpResponse()
         hr.status_code = 404
         return hr
 
-    return HttpResponse(tf,content_type='text/calendar')
-
 def go2_id_calfeed(request, go2_id):
-    try:
-        member = Member.objects.get(go2_id=go2_id)
-        return calfeed(request, member.cal_feed_id)
-    except(Member.DoesNotExist):
+    """ GO2 calfeed urls used the member's GO2 id; send them on to the member's calfeed """
+    cal_feed_id = Member.objects.filter(go2_id=go2_id).values_list('cal_feed_id', flat=True).first()
+    if cal_feed_id is None:
         hr = HttpResponse()
         hr.status_code = 404
         return hr
+    # the calfeed id never changes, so the redirect can be permanent
+    return redirect('member-calfeed', pk=cal_feed_id, permanent=True)
 
 # helpers to define member permissions for various things
 def has_band_admin(user, band):
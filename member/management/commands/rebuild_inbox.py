@@ -0,0 +1,46 @@
+"""
+    This file is part of Gig-o-Matic
+
+    Gig-o-Matic is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from django.core.management.base import BaseCommand
+from gig.models import Plan
+from member.models import InboxEntry, Member
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the "needs response" inbox from the plans and checks it against the plans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true',
+                            help="don't rebuild, just check the inbox as it is")
+
+    def handle(self, *args, **options):
+        if not options['verify_only']:
+            count = InboxEntry.objects.sync(Plan.objects.all())
+            self.stdout.write(f'rebuilt inbox with {count} entries')
+
+        mismatches = 0
+        for m in Member.objects.filter(assocs__isnull=False).distinct().iterator():
+            expected = set(Plan.member_plans.future_noplans(m).values_list('id', flat=True))
+            found = set(InboxEntry.objects.future(m).values_list('plan_id', flat=True))
+            if expected != found:
+                mismatches += 1
+                self.stdout.write(f'inbox for member {m.id} is wrong: '
+                                  f'{len(expected - found)} missing, {len(found - expected)} extra')
+
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f'{mismatches} inboxes do not match'))
+        else:
+            self.stdout.write(self.style.SUCCESS('all inboxes match'))
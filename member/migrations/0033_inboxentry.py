@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:38
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+import django.db.models.deletion
+
+from band.util import AssocStatusChoices
+from gig.util import GigStatusChoices, PlanStatusChoices
+
+def fill_inboxes(apps, schema_editor):
+    Plan = apps.get_model('gig', 'Plan')
+    InboxEntry = apps.get_model('member', 'InboxEntry')
+    plans = Plan.objects.filter(status=PlanStatusChoices.NO_PLAN,
+                                assoc__status=AssocStatusChoices.CONFIRMED,
+                                assoc__hide_from_schedule=False,
+                                gig__trashed_date__isnull=True,
+                                gig__is_archived=False)
+    plans = plans.exclude(gig__status=GigStatusChoices.CANCELED)
+    plans = plans.exclude(Q(assoc__is_occasional=True) & Q(gig__invite_occasionals=False))
+    rows = plans.values_list('id', 'assoc__member_id', 'assoc__band_id', 'gig__date', 'gig__enddate', 'gig__is_full_day')
+    InboxEntry.objects.bulk_create([InboxEntry(plan_id=p, member_id=m, band_id=b, gig_date=d, gig_enddate=e, gig_is_full_day=f)
+                                    for p, m, b, d, e, f in rows.iterator()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gig', '0034_alter_gig_safe_date_alter_gig_safe_enddate_and_more'),
+        ('band', '0028_band_invite_occasionals_by_default'),
+        ('member', '0032_alter_memberpreferences_agenda_band'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gig_date', models.DateTimeField(blank=True, null=True)),
+                ('gig_enddate', models.DateTimeField(blank=True, null=True)),
+                ('gig_is_full_day', models.BooleanField(default=False)),
+                ('band', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='band.band')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL)),
+                ('plan', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entry', to='gig.plan')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['member', 'gig_date'], name='member_inbo_member__3c43b3_idx')],
+            },
+        ),
+        migrations.RunPython(fill_inboxes, migrations.RunPython.noop),
+    ]
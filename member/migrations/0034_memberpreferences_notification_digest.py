@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0033_inboxentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='memberpreferences',
+            name='notification_digest',
+            field=models.BooleanField(default=False, verbose_name='Combine gig emails into digests'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0034_memberpreferences_notification_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='member',
+            name='go2_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0035_member_go2_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='membership_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
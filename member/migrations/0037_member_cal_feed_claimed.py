@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0036_member_membership_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='cal_feed_claimed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -15,17 +15,22 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import atexit
+import logging
+import threading
 import uuid
+from collections import Counter
 
 import pytz
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.db import connections, models
 from django.db.models import Q
 from django.utils.translation import gettext_lazy as _
 
 from band.models import Assoc, Band
 from band.util import AssocStatusChoices
-from gig.models import GigStatusChoices, Plan
+from gig.models import GigStatusChoices, Plan, unfinished_gig_q
 from gig.util import PlanStatusChoices
 from go3.settings import LANGUAGES
 from lib.caldav import delete_calfeed
@@ -92,13 +97,18 @@ class Member(AbstractUser):
 
     # flag to determine whether to recompute calendar feed
     cal_feed_dirty = models.BooleanField(default=True)
+    # set while a worker is making the feed, so it can be made again if the worker dies
+    cal_feed_claimed = models.DateTimeField(null=True, blank=True)
     cal_feed_id = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
 
     status = models.IntegerField(choices=MemberStatusChoices.choices, default=MemberStatusChoices.ACTIVE)
 
+    # bumped whenever one of the member's assocs changes; part of the key for the cached band memberships
+    membership_version = models.IntegerField(default=0)
+
     # The old Gig-O-Matic v2 (Google App Engine) member ID
     # Used to map old calendar subscription URLs
-    go2_id = models.CharField(max_length=100, blank=True)
+    go2_id = models.CharField(max_length=100, blank=True, db_index=True)
 
     display_name = models.CharField(max_length=200, blank=True, null=True)
 
@@ -143,43 +153,38 @@ class Member(AbstractUser):
 
     @property
     def future_noplans(self):
-        """ used by the agenda page to decide what gigs to show """
-        plans = Plan.member_plans.future_plans(self).filter(status=PlanStatusChoices.NO_PLAN)
-        plans = plans.exclude(gig__status=GigStatusChoices.CANCELED)        
-        plans = plans.exclude(assoc__hide_from_schedule=True)
-        plans = plans.exclude(Q(assoc__is_occasional=True) & Q(gig__invite_occasionals=False))
-        return plans
+        """ used by the agenda page to decide what gigs to show - comes from the member's inbox """
+        return Plan.objects.filter(id__in=InboxEntry.objects.future(self).values('plan')).order_by('gig__date')
     
-    @property
-    def calendar_plans(self):
-        """ pick the gigs that should go on the calendar """
-        """ returns plans, not gigs, in case they need to be further filtered """
-
-        # first get all of the plans which meet the criteria
-        filter_args = {
-            "assoc__member": self, # my plan
-            "assoc__status": AssocStatusChoices.CONFIRMED, # is a usual member
-            "assoc__hide_from_schedule": False, # gigs are not hidden from calendar
-            "gig__hide_from_calendar": False, # not hidden from calendars
-            "gig__trashed_date__isnull": True, # not trashed
-        }
-
-        if self.preferences.calendar_show_only_confirmed:  # pylint: disable=no-member
-            filter_args["gig__status"] = GigStatusChoices.CONFIRMED
+    @staticmethod
+    def calendar_plans_filter(preferences):
+        """ the filter for the plans whose gigs go on the calendar of a member with these preferences """
+
+        q = Q(
+            assoc__status=AssocStatusChoices.CONFIRMED, # is a usual member
+            assoc__hide_from_schedule=False, # gigs are not hidden from calendar
+            gig__hide_from_calendar=False, # not hidden from calendars
+            gig__trashed_date__isnull=True, # not trashed
+        )
 
-        if self.preferences.calendar_show_only_committed:  # pylint: disable=no-member
-            filter_args["status__in"] = [
-                PlanStatusChoices.DEFINITELY, PlanStatusChoices.PROBABLY]
+        if preferences.calendar_show_only_confirmed:
+            q &= Q(gig__status=GigStatusChoices.CONFIRMED)
 
-        # get the plans but exclude gigs for which occasionals are not invited if we're occasional in the band
-        plans = Plan.objects.filter(**filter_args)
+        if preferences.calendar_show_only_committed:
+            q &= Q(status__in=[PlanStatusChoices.DEFINITELY, PlanStatusChoices.PROBABLY])
 
+        # exclude gigs for which occasionals are not invited if we're occasional in the band
+        q &= ~(Q(assoc__is_occasional=True) & Q(gig__invite_occasionals=False) & Q(status=PlanStatusChoices.NO_PLAN))
+        if preferences.hide_canceled_gigs:
+            q &= ~Q(gig__status=GigStatusChoices.CANCELED)
 
-        plans = plans.exclude(Q(assoc__is_occasional=True) & Q(gig__invite_occasionals=False) & Q(status=PlanStatusChoices.NO_PLAN))
-        if self.preferences.hide_canceled_gigs: # pylint: disable=no-member
-            plans = plans.exclude(gig__status=GigStatusChoices.CANCELED)
+        return q
 
-        return plans
+    @property
+    def calendar_plans(self):
+        """ pick the gigs that should go on the calendar """
+        """ returns plans, not gigs, in case they need to be further filtered """
+        return Plan.objects.filter(Member.calendar_plans_filter(self.preferences), assoc__member=self) # pylint: disable=no-member
 
     @property
     def motd(self):
@@ -241,11 +246,78 @@ class Member(AbstractUser):
         return '{0} ({1}) {2}'.format(self.display_name, self.email, ' (deleted)' if self.status==MemberStatusChoices.DELETED else '')
 
 
+# how many preference writes were made, and how many the change checking and buffering saved us
+preference_writes = Counter()
+
+
+class PreferenceBuffer:
+    """ holds back writes of the high-frequency preferences (MemberPreferences.BUFFERED_FIELDS) and writes them
+        out together, when enough members are waiting or on a timer started by the first write held back.
+
+        The buffer belongs to this process. Only this process sees the held-back values, so with several
+        web processes a member can get the old value back for up to PREFERENCES_BUFFER_SECONDS, and a
+        process that is killed rather than shut down loses what it was holding. That's why only UI state
+        that nobody would miss goes in it. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+
+    def add(self, member_id, values):
+        with self._lock:
+            self._pending.setdefault(member_id, {}).update(values)
+            if self._timer is None:
+                self._timer = threading.Timer(settings.PREFERENCES_BUFFER_SECONDS, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+            preference_writes['buffered'] += 1
+            full = len(self._pending) >= settings.PREFERENCES_BUFFER_SIZE
+        if full:
+            self.flush()
+
+    def pending(self, member_id):
+        with self._lock:
+            return dict(self._pending.get(member_id, {}))
+
+    def flush(self):
+        """ write everything in the buffer with one bulk update """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return
+        prefs = list(MemberPreferences.objects.filter(member_id__in=pending.keys()))
+        for p in prefs:
+            for attname, value in pending[p.member_id].items():
+                setattr(p, attname, value)
+        MemberPreferences.objects.bulk_update(prefs, MemberPreferences.BUFFERED_FIELDS, batch_size=500)
+        preference_writes['flushed'] += len(prefs)
+        logging.info(f'wrote buffered preferences for {len(prefs)} members; preference writes: {dict(preference_writes)}')
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        finally:
+            # the timer's thread has its own database connection, which nothing else will close
+            connections.close_all()
+
+
+preference_buffer = PreferenceBuffer()
+atexit.register(preference_buffer.flush)
+
+
 class MemberPreferences(models.Model):
     """ class to hold user preferences """
     member = models.OneToOneField(Member, related_name='preferences', on_delete=models.CASCADE)
 
+    # UI state that changes on almost every page load - see PREFERENCES_BUFFER_UI_STATE in settings
+    BUFFERED_FIELDS = ['agenda_layout', 'agenda_band']
+
     hide_canceled_gigs = models.BooleanField(default=False, verbose_name=_('Hide canceled gigs'))
+    notification_digest = models.BooleanField(default=False, verbose_name=_('Combine gig emails into digests'))
     language = models.CharField(choices=LANGUAGES, max_length=200, default='en-US', verbose_name=_('Language'))
     share_profile = models.BooleanField(default=True, verbose_name=_('Share my profile'))
     share_email = models.BooleanField(default=False, verbose_name=_('Share my email'))
@@ -263,6 +335,121 @@ class MemberPreferences(models.Model):
 
     default_view = models.IntegerField(choices=AgendaChoices.choices, default=AgendaChoices.AGENDA)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        for attname, value in preference_buffer.pending(instance.member_id).items():
+            setattr(instance, attname, value)
+        instance._saved_values = instance._field_values() # pylint: disable=no-member
+        return instance
+
+    def _field_values(self):
+        return {f.name: getattr(self, f.attname) for f in self._meta.concrete_fields if not f.primary_key}
+
+    def save(self, *args, **kwargs):
+        """ only write the fields that changed since the preferences were loaded, and nothing at all if none
+            did. The preferences get saved from a lot of places that are really just reading them. """
+        if self._state.adding or kwargs.get('update_fields') is not None or not hasattr(self, '_saved_values'):
+            super().save(*args, **kwargs)
+            self._saved_values = self._field_values()
+            preference_writes['saved'] += 1
+            return
+
+        values = self._field_values()
+        changed = [f for f, v in values.items() if v != self._saved_values.get(f)]
+        preference_writes['fields_skipped'] += len(values) - len(changed)
+
+        if settings.PREFERENCES_BUFFER_UI_STATE:
+            buffered = [f for f in changed if f in self.BUFFERED_FIELDS]
+            if buffered:
+                preference_buffer.add(self.member_id,
+                                      {self._meta.get_field(f).attname: getattr(self, self._meta.get_field(f).attname)
+                                       for f in buffered})
+                changed = [f for f in changed if f not in buffered]
+
+        if changed:
+            super().save(*args, update_fields=changed, **kwargs)
+            preference_writes['saved'] += 1
+        else:
+            preference_writes['skipped'] += 1
+        self._saved_values = values
+
+
+class InboxManager(models.Manager):
+
+    @staticmethod
+    def _needing_response(plans):
+        """ the plans that belong in an inbox, ignoring whether the gig is over - that is checked when reading """
+        plans = plans.filter(status=PlanStatusChoices.NO_PLAN,
+                             assoc__status=AssocStatusChoices.CONFIRMED,
+                             assoc__hide_from_schedule=False,
+                             gig__trashed_date__isnull=True,
+                             gig__is_archived=False)
+        plans = plans.exclude(gig__status=GigStatusChoices.CANCELED)
+        plans = plans.exclude(Q(assoc__is_occasional=True) & Q(gig__invite_occasionals=False))
+        return plans
+
+    @staticmethod
+    def _plan_needs_response(plan):
+        """ the same test as _needing_response, for a single plan that's already in memory """
+        gig = plan.gig
+        assoc = plan.assoc
+        return (plan.status == PlanStatusChoices.NO_PLAN and
+                assoc.status == AssocStatusChoices.CONFIRMED and
+                not assoc.hide_from_schedule and
+                gig.trashed_date is None and
+                not gig.is_archived and
+                gig.status != GigStatusChoices.CANCELED and
+                not (assoc.is_occasional and not gig.invite_occasionals))
+
+    def sync(self, plans):
+        """ make the inbox entries again for a queryset of plans, returning how many there are now """
+        self.filter(plan__in=plans).delete()
+        rows = self._needing_response(plans).values_list('id', 'assoc__member_id', 'assoc__band_id',
+                                                          'gig__date', 'gig__enddate', 'gig__is_full_day')
+        return len(self.bulk_create([InboxEntry(plan_id=plan_id, member_id=member_id, band_id=band_id,
+                                            gig_date=date, gig_enddate=enddate, gig_is_full_day=is_full_day)
+                                 for plan_id, member_id, band_id, date, enddate, is_full_day in rows.iterator()],
+                                    batch_size=500))
+
+    def future(self, member):
+        """ the member's inbox entries for gigs that haven't ended yet """
+        return self.filter(Q(member=member) & unfinished_gig_q('gig_')).order_by('gig_date')
+
+    def sync_plan(self, plan):
+        """ add, update or remove the inbox entry for one plan """
+        if self._plan_needs_response(plan):
+            gig = plan.gig
+            self.update_or_create(plan=plan, defaults={
+                'member_id': plan.assoc.member_id,
+                'band_id': plan.assoc.band_id,
+                'gig_date': gig.date,
+                'gig_enddate': gig.enddate,
+                'gig_is_full_day': gig.is_full_day,
+            })
+        else:
+            self.filter(plan=plan).delete()
+
+
+class InboxEntry(models.Model):
+    """
+    A plan that a member still has to answer. This duplicates what's in Plan, Gig and Assoc so that the
+    "Needs Response" list and badge only have to look at one table, so the gig's dates are copied here too.
+    """
+    member = models.ForeignKey(Member, related_name='inbox', on_delete=models.CASCADE)
+    plan = models.OneToOneField(Plan, related_name='inbox_entry', on_delete=models.CASCADE)
+    band = models.ForeignKey(Band, related_name='+', on_delete=models.CASCADE)
+    gig_date = models.DateTimeField(null=True, blank=True)
+    gig_enddate = models.DateTimeField(null=True, blank=True)
+    gig_is_full_day = models.BooleanField(default=False)
+
+    objects = InboxManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['member', 'gig_date']),
+        ]
+
 
 class Invite(models.Model):
     """
@@ -17,7 +17,10 @@
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django_q.tasks import async_task
-from .models import Member, MemberPreferences, Invite, EmailConfirmation
+from band.models import Assoc
+from gig.models import Gig, Plan, plans_provisioned
+from .models import Member, MemberPreferences, Invite, EmailConfirmation, InboxEntry
+from .util import MemberStatusChoices
 from .helpers import send_invite_async
 
 # signals to make sure a set of preferences is created for every user
@@ -28,6 +31,27 @@ def handle_user_preferences(sender, instance, created, **kwargs):
     else:
         instance.preferences.save()
 
+@receiver(pre_save, sender=Member)
+def remember_member_status(sender, instance, update_fields=None, **kwargs):
+    """ keep the status from before the save, for the receivers that only care when it changes """
+    if instance.pk is None:
+        instance._old_status = None
+    elif update_fields is not None and 'status' not in update_fields:
+        instance._old_status = instance.status
+    else:
+        instance._old_status = Member.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+
+# a member coming back to active needs plans for the gigs that were made while they were away
+@receiver(post_save, sender=Member)
+def provision_member_plans(sender, instance, created, **kwargs):
+    if created or instance.status != MemberStatusChoices.ACTIVE:
+        return
+    if getattr(instance, '_old_status', None) == MemberStatusChoices.ACTIVE:
+        return
+    assocs = list(instance.confirmed_assocs)
+    if assocs:
+        Plan.objects.provision(Gig.objects.future().filter(band__in=[a.band_id for a in assocs]), assocs=assocs)
+
 @receiver(post_save, sender=Invite)
 def send_invite(sender, instance, created, **kwargs):
     if created:
@@ -46,3 +70,38 @@ def update_user_display_name(sender, instance, **kwargs):
          instance.display_name = instance.username
     else:
         instance.display_name = instance.email
+
+# keep the "needs response" inbox current
+def _changed(old, new, fields):
+    return any(getattr(old, f) != getattr(new, f) for f in fields)
+
+@receiver(post_save, sender=Plan)
+def update_inbox_for_plan(sender, instance, created, **kwargs):
+    # only the answer decides whether a plan is in the inbox, as far as the plan itself goes
+    if created or getattr(instance, '_old_status', None) != instance.status:
+        InboxEntry.objects.sync_plan(instance)
+
+@receiver(post_save, sender=Gig)
+def update_inbox_for_gig(sender, instance, created, **kwargs):
+    # a new gig's plans get added to the inbox when they're provisioned
+    old = getattr(instance, '_old', None)
+    if created or not old:
+        return
+    if _changed(old, instance, ('status', 'trashed_date', 'is_archived', 'invite_occasionals')):
+        InboxEntry.objects.sync(instance.plans.all())
+    elif _changed(old, instance, ('date', 'enddate', 'is_full_day')):
+        InboxEntry.objects.filter(plan__gig=instance).update(gig_date=instance.date, gig_enddate=instance.enddate,
+                                                             gig_is_full_day=instance.is_full_day)
+
+@receiver(post_save, sender=Assoc)
+def update_inbox_for_assoc(sender, instance, created, **kwargs):
+    old = getattr(instance, '_old', None)
+    if not created and old and _changed(old, instance, ('status', 'hide_from_schedule', 'is_occasional')):
+        InboxEntry.objects.sync(instance.plans.all())
+
+@receiver(plans_provisioned)
+def update_inbox_for_new_plans(sender, gigs, assocs, **kwargs):
+    plans = Plan.objects.filter(gig__in=gigs)
+    if assocs is not None:
+        plans = plans.filter(assoc__in=assocs)
+    InboxEntry.objects.sync(plans)
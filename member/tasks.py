@@ -14,9 +14,8 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from member.models import Member
-from member.helpers import update_member_calfeed
-from django_q.tasks import async_task 
+import logging
+from member.helpers import regenerate_member_calfeeds
 from django.conf import settings
 
 def update_all_calfeeds():
@@ -25,7 +24,9 @@ def update_all_calfeeds():
     if settings.DYNAMIC_CALFEED:
         return
 
-    members = Member.objects.filter(cal_feed_dirty=True)
-    for m in members:
-        async_task(update_member_calfeed, m.id)
-    members.update(cal_feed_dirty=False)
\ No newline at end of file
+    count = batches = 0
+    for size, seconds in regenerate_member_calfeeds():
+        count += size
+        batches += 1
+        logging.info(f'made {size} member calfeeds in {seconds:.2f}s')
+    return f'updated {count} member calfeeds in {batches} batches'
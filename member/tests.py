@@ -17,6 +17,7 @@
 
 import os
 from datetime import timedelta
+from io import StringIO
 from unittest.mock import mock_open, patch
 
 import pytest
@@ -24,10 +25,14 @@ import pytz
 from django.conf import settings
 from django.contrib import auth
 from django.core import mail
+from django.core.management import call_command
 from django.http import HttpResponseForbidden, HttpResponseRedirect
-from django.test import Client, RequestFactory, TestCase
+from django.db import connection
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
+from freezegun import freeze_time
 from pyfakefs.fake_filesystem_unittest import TestCase as FSTestCase
 from pytz import timezone as pytz_timezone
 
@@ -39,8 +44,10 @@ from lib.email import DEFAULT_SUBJECT, prepare_email
 from lib.template_test import MISSING, TemplateTestCase, flag_missing_vars
 
 from .helpers import calfeed, prepare_member_calfeed, update_member_calfeed
-from .models import Invite, Member
-from .util import MemberStatusChoices
+from member import helpers
+from member.tasks import update_all_calfeeds
+from .models import InboxEntry, Invite, Member, MemberPreferences, preference_buffer, preference_writes
+from .util import AgendaLayoutChoices, MemberStatusChoices
 from .views import AssocsView, OtherBandsView
 
 
@@ -114,6 +121,80 @@ class MemberTest(TestCase):
         self.assertEqual(context['bands'][0].name, 'another band')
 
 
+class MemberPreferencesTest(TestCase):
+    def setUp(self):
+        self.member = Member.objects.create_user('a@b.com', password='abc')
+        self.band = Band.objects.create(name='test band', timezone="America/New_York")
+
+    def tearDown(self):
+        """ make sure we get rid of anything we made """
+        Member.objects.all().delete()
+        Band.objects.all().delete()
+
+    def fresh_preferences(self):
+        return MemberPreferences.objects.get(member=self.member)
+
+    def test_unchanged_preferences_not_written(self):
+        prefs = self.fresh_preferences()
+        skipped = preference_writes['skipped']
+        with CaptureQueriesContext(connection) as ctx:
+            prefs.save()
+            self.member.save()
+        self.assertFalse(any('member_memberpreferences' in q['sql'] for q in ctx.captured_queries))
+        # one for the preferences, one for the re-save when the member is saved
+        self.assertEqual(preference_writes['skipped'], skipped + 2)
+
+    def test_only_changed_fields_written(self):
+        prefs = self.fresh_preferences()
+        prefs.hide_canceled_gigs = True
+        with CaptureQueriesContext(connection) as ctx:
+            prefs.save()
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('hide_canceled_gigs', updates[0])
+        self.assertNotIn('language', updates[0])
+        self.assertTrue(self.fresh_preferences().hide_canceled_gigs)
+
+    @override_settings(PREFERENCES_BUFFER_UI_STATE=True, PREFERENCES_BUFFER_SIZE=2)
+    def test_buffered_ui_state(self):
+        other = Member.objects.create_user('c@d.com', password='abc')
+
+        prefs = self.fresh_preferences()
+        prefs.agenda_layout = AgendaLayoutChoices.BY_BAND
+        prefs.agenda_band = self.band
+        prefs.save()
+
+        # not in the database yet, but this process sees it
+        self.assertEqual(MemberPreferences.objects.filter(member=self.member).values_list('agenda_layout', flat=True)[0],
+                         AgendaLayoutChoices.ONE_LIST)
+        self.assertEqual(self.fresh_preferences().agenda_layout, AgendaLayoutChoices.BY_BAND)
+
+        # a second member fills the buffer, so it all gets written
+        other_prefs = MemberPreferences.objects.get(member=other)
+        other_prefs.agenda_layout = AgendaLayoutChoices.NEED_RESPONSE
+        other_prefs.save()
+        self.assertEqual(preference_buffer.pending(self.member.id), {})
+        self.assertEqual(MemberPreferences.objects.filter(member=self.member).values_list('agenda_layout', 'agenda_band')[0],
+                         (AgendaLayoutChoices.BY_BAND, self.band.id))
+        self.assertEqual(MemberPreferences.objects.filter(member=other).values_list('agenda_layout', flat=True)[0],
+                         AgendaLayoutChoices.NEED_RESPONSE)
+
+    @override_settings(PREFERENCES_BUFFER_UI_STATE=True, PREFERENCES_BUFFER_SECONDS=30)
+    def test_buffer_written_on_timer(self):
+        prefs = self.fresh_preferences()
+        prefs.agenda_layout = AgendaLayoutChoices.BY_BAND
+        with patch('member.models.threading.Timer') as timer, patch('member.models.connections'):
+            prefs.save()
+            self.assertEqual(timer.call_args.args[0], 30)
+            timer.return_value.start.assert_called_once()
+
+            # when the timer goes off it writes the buffer, without waiting for another save
+            timer.call_args.args[1]()
+        self.assertEqual(preference_buffer.pending(self.member.id), {})
+        self.assertEqual(MemberPreferences.objects.filter(member=self.member).values_list('agenda_layout', flat=True)[0],
+                         AgendaLayoutChoices.BY_BAND)
+
+
 class MemberEmailTest(TestCase):
     def setUp(self):
         self.member = Member.objects.create_user('member@example.com')
@@ -372,9 +453,89 @@ class MemberCalfeedTest(FSTestCase):
         self.joeuser.refresh_from_db()
         # self.assertFalse(self.joeuser.cal_feed_dirty) # moved this to an async task
 
-        cf = calfeed(request=None, pk=self.joeuser.cal_feed_id)
+        cf = calfeed(request=RequestFactory().get('/'), pk=self.joeuser.cal_feed_id)
         self.assertTrue(cf.content.decode('ascii').find('EVENT') > 0)
 
+    @override_settings(DYNAMIC_CALFEED=True)
+    def test_member_calfeed_cached(self):
+        factory = RequestFactory()
+        with patch('member.helpers.make_member_calfeed', wraps=helpers.make_member_calfeed) as make:
+            first = calfeed(request=factory.get('/'), pk=self.joeuser.cal_feed_id)
+            calfeed(request=factory.get('/'), pk=self.joeuser.cal_feed_id)
+            self.assertEqual(make.call_count, 1)
+            r = calfeed(request=factory.get('/', HTTP_IF_NONE_MATCH=first.headers['ETag']), pk=self.joeuser.cal_feed_id)
+            self.assertEqual(r.status_code, 304)
+
+            # changing a preference the feed depends on makes a new one
+            self.joeuser.preferences.calendar_show_only_confirmed = True
+            self.joeuser.preferences.save()
+            r = calfeed(request=factory.get('/', HTTP_IF_NONE_MATCH=first.headers['ETag']), pk=self.joeuser.cal_feed_id)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(make.call_count, 2)
+            self.assertNotIn(b'BEGIN:VEVENT', r.content)
+
+
+    @override_settings(CALFEED_BATCH_SIZE=2, DYNAMIC_CALFEED=False)
+    def test_regenerate_member_calfeeds(self):
+        self.setUpPyfakefs()    # fake a file system
+        os.mkdir('calfeeds')
+        Member.objects.update(cal_feed_dirty=True)
+
+        self.assertEqual(update_all_calfeeds(), 'updated 4 member calfeeds in 2 batches')
+        self.assertFalse(Member.objects.filter(cal_feed_dirty=True).exists())
+        strip = lambda feed: [line for line in feed.split(b'\r\n') if not line.startswith(b'DTSTAMP')]
+        for m in Member.objects.all():
+            with open(f'calfeeds/{m.cal_feed_id}.txt', 'rb') as f:
+                self.assertEqual(strip(f.read()), strip(prepare_member_calfeed(m)))
+        with open(f'calfeeds/{self.joeuser.cal_feed_id}.txt', 'rb') as f:
+            self.assertIn(b'BEGIN:VEVENT', f.read())
+
+        # the batch's plans come from one query for each set of calendar preferences
+        Member.objects.update(cal_feed_dirty=True)
+        MemberPreferences.objects.update(hide_canceled_gigs=False, calendar_show_only_confirmed=False,
+                                         calendar_show_only_committed=False)
+        with override_settings(CALFEED_BATCH_SIZE=100), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(update_all_calfeeds(), 'updated 4 member calfeeds in 1 batches')
+        self.assertEqual(len([q for q in queries if 'FROM "gig_plan"' in q['sql']]), 1)
+
+        out = StringIO()
+        call_command('regenerate_calfeeds', '--all', '--processes=1', stdout=out)
+        self.assertIn('made 4 member calfeeds', out.getvalue())
+        self.assertIn('made 1 band calfeeds', out.getvalue())
+
+    @override_settings(DYNAMIC_CALFEED=False)
+    def test_regenerate_member_calfeeds_failure(self):
+        Member.objects.update(cal_feed_dirty=True)
+        with patch('member.helpers.save_calfeed', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                update_all_calfeeds()
+        # the batch is left dirty for next time
+        self.assertEqual(Member.objects.filter(cal_feed_dirty=True).count(), 4)
+
+    @override_settings(DYNAMIC_CALFEED=False)
+    def test_regenerate_member_calfeeds_after_dead_worker(self):
+        Member.objects.update(cal_feed_dirty=True)
+        # a worker takes a batch and dies before saving it
+        ids = helpers._claim_dirty_member_calfeeds(0)
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(update_all_calfeeds(), 'updated 0 member calfeeds in 0 batches')
+
+        # once the claim is old enough, the next run makes them
+        with freeze_time(timezone.now() + timedelta(seconds=settings.CALFEED_CLAIM_SECONDS + 1)):
+            self.assertEqual(update_all_calfeeds(), 'updated 4 member calfeeds in 1 batches')
+        self.assertFalse(Member.objects.filter(cal_feed_claimed__isnull=False).exists())
+        self.assertEqual(update_all_calfeeds(), 'updated 0 member calfeeds in 0 batches')
+
+    def test_go2_id_calfeed(self):
+        self.joeuser.go2_id = 'ag1zfmdpZy1vLW1hdGlj'
+        self.joeuser.save()
+        response = Client().get('/cal/m/ag1zfmdpZy1vLW1hdGlj')
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response.url, reverse('member-calfeed', kwargs={'pk': self.joeuser.cal_feed_id}))
+
+        response = Client().get('/cal/m/nobody')
+        self.assertEqual(response.status_code, 404)
+
 
     def test_member_beta_flag(self):
         """ make sure the beta flag exists """
@@ -1459,3 +1620,96 @@ class TestQueryMemberAPI(GigTestBase):
         )
         # Should return 422 (validation error) or 400 (bad request)
         self.assertIn(response.status_code, [400, 422])
+
+
+class InboxTest(GigTestBase):
+    def inbox_plans(self, member):
+        return set(InboxEntry.objects.future(member).values_list('plan_id', flat=True))
+
+    def test_new_gig_in_inbox(self):
+        g = self.create_gig(self.band_admin)
+        p = g.plans.get(assoc__member=self.band_admin)
+        self.assertEqual(self.inbox_plans(self.band_admin), {p.id})
+
+    def test_answered_plan_leaves_inbox(self):
+        g = self.create_gig(self.band_admin)
+        p = g.plans.get(assoc__member=self.band_admin)
+        p.status = PlanStatusChoices.DEFINITELY
+        p.save()
+        self.assertEqual(self.inbox_plans(self.band_admin), set())
+        p.status = PlanStatusChoices.NO_PLAN
+        p.save()
+        self.assertEqual(self.inbox_plans(self.band_admin), {p.id})
+
+    def test_gig_changes_update_inbox(self):
+        g = self.create_gig(self.band_admin)
+        g.status = GigStatusChoices.CANCELED
+        g.save()
+        self.assertEqual(self.inbox_plans(self.band_admin), set())
+        g.status = GigStatusChoices.CONFIRMED
+        g.save()
+        self.assertEqual(len(self.inbox_plans(self.band_admin)), 1)
+
+        # moving the gig into the past takes it out of the list
+        g.date = timezone.now() - timedelta(days=2)
+        g.setdate = g.date
+        g.enddate = g.date + timedelta(hours=1)
+        g.save()
+        self.assertEqual(self.inbox_plans(self.band_admin), set())
+        self.assertEqual(InboxEntry.objects.count(), 1)
+
+    def test_gig_edits_keep_inbox(self):
+        g = self.create_gig(self.band_admin)
+        entry = InboxEntry.objects.get()
+        with patch.object(InboxEntry.objects, 'sync') as sync:
+            g.title = 'new title'
+            g.save()
+            # a new date is copied onto the entries that are already there
+            g.date = g.date + timedelta(days=1)
+            g.save()
+        sync.assert_not_called()
+        self.assertEqual(InboxEntry.objects.get().id, entry.id)
+        self.assertEqual(InboxEntry.objects.get().gig_date, g.date)
+
+    def test_assoc_changes_update_inbox(self):
+        a = Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.CONFIRMED)
+        g = self.create_gig(self.band_admin)
+        self.assertEqual(len(self.inbox_plans(self.joeuser)), 1)
+
+        a.hide_from_schedule = True
+        a.save()
+        self.assertEqual(self.inbox_plans(self.joeuser), set())
+
+        a.hide_from_schedule = False
+        a.is_occasional = True
+        a.save()
+        self.assertEqual(len(self.inbox_plans(self.joeuser)), 1)
+
+        g.invite_occasionals = False
+        g.save()
+        self.assertEqual(self.inbox_plans(self.joeuser), set())
+
+    def test_inbox_matches_plans(self):
+        Assoc.objects.create(member=self.joeuser, band=self.band, status=AssocStatusChoices.CONFIRMED)
+        self.create_gig(self.band_admin)
+        g = self.create_gig(self.band_admin, title="another")
+        g.status = GigStatusChoices.CANCELED
+        g.save()
+        for m in [self.band_admin, self.joeuser]:
+            self.assertEqual(self.inbox_plans(m),
+                             set(Plan.member_plans.future_noplans(m).values_list('id', flat=True)))
+            self.assertEqual(list(m.future_noplans), list(Plan.member_plans.future_noplans(m)))
+
+    def test_rebuild_inbox(self):
+        self.create_gig(self.band_admin)
+        InboxEntry.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_inbox', '--verify-only', stdout=out)
+        self.assertIn('1 inboxes do not match', out.getvalue())
+
+        out = StringIO()
+        call_command('rebuild_inbox', stdout=out)
+        self.assertIn('rebuilt inbox with 1 entries', out.getvalue())
+        self.assertIn('all inboxes match', out.getvalue())
+        self.assertEqual(InboxEntry.objects.count(), 1)
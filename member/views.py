@@ -146,7 +146,7 @@ class PreferencesUpdateView(LoginRequiredMixin, BaseUpdateView):
 
     def __init__(self, **kwargs):
         self.fields = ['language','current_timezone', 'auto_update_timezone', 'share_profile','share_email','calendar_show_only_confirmed',
-                'calendar_show_only_committed', 'hide_canceled_gigs', 'agenda_use_classic']
+                'calendar_show_only_committed', 'hide_canceled_gigs', 'notification_digest', 'agenda_use_classic']
         super().__init__(**kwargs)
     
     def dispatch(self, request, *args, **kwargs):
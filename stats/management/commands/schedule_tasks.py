@@ -55,8 +55,48 @@ class Command(BaseCommand):
                                 repeats=-1
                                 )
 
-        Schedule.objects.create(name='send snooze reminders',
+        Schedule.objects.create(name='send due reminders',
+                                func='gig.tasks.send_due_reminders',
+                                schedule_type=Schedule.MINUTES,
+                                minutes=10,
+                                repeats=-1
+                                )
+
+        Schedule.objects.create(name='reconcile reminders',
                                 func='gig.tasks.send_snooze_reminders',
                                 schedule_type=Schedule.DAILY,
                                 repeats=-1
                                 )
+
+        Schedule.objects.create(name='drain email outbox',
+                                func='lib.email.drain_outbox',
+                                schedule_type=Schedule.MINUTES,
+                                minutes=5,
+                                repeats=-1
+                                )
+
+        Schedule.objects.create(name='delete old outbox messages',
+                                func='lib.email.delete_old_outbox_messages',
+                                schedule_type=Schedule.DAILY,
+                                repeats=-1
+                                )
+
+        Schedule.objects.create(name='resume notification emails',
+                                func='gig.tasks.resume_notifications',
+                                schedule_type=Schedule.MINUTES,
+                                minutes=15,
+                                repeats=-1
+                                )
+
+        Schedule.objects.create(name='delete old notifications',
+                                func='gig.tasks.delete_old_notification_sends',
+                                schedule_type=Schedule.DAILY,
+                                repeats=-1
+                                )
+
+        Schedule.objects.create(name='send notification digests',
+                                func='gig.tasks.send_digests',
+                                schedule_type=Schedule.MINUTES,
+                                minutes=1,
+                                repeats=-1
+                                )